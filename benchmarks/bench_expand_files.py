@@ -0,0 +1,228 @@
+#! /usr/bin/env python
+
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Compares framespec.expand_files against the original per-frame algorithm.
+#
+# Usage:
+#
+#     bench_expand_files.py [--entries 10000 100000 1000000]
+#                           [--legacy-frames 1000] [--full-legacy]
+#
+# The original algorithm tests every file in the directory against every frame,
+# so its cost is frames x entries: a full run at 1M entries would take days.
+# Unless --full-legacy is given, a legacy run that would make more than
+# LEGACY_LIMIT regex matches is timed on only the first --legacy-frames frames
+# (still against the full directory listing), and its time is scaled up to the
+# full number of frames. Since the cost of each frame is the same, the estimate
+# is close, and those rows are marked "est.". The results of the sampled frames
+# are still checked against expand_files.
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "modules"))
+
+from bvzlib import framespec
+
+
+# Any legacy run that would perform more than this many regex matches is only
+# timed on a sample of the frames (the old algorithm is O(frames x files)).
+LEGACY_LIMIT = 2 * 10**8
+
+
+# ------------------------------------------------------------------------------
+def legacy_expand_files(user_pattern,
+                        padding=None):
+    """
+    The original, per-frame implementation of framespec.expand_files. Kept here
+    only as a reference to measure against.
+
+    :param user_pattern: The pattern that describes the files on disk.
+    :param padding: Any padding to use when expanding frame specs.
+
+    :return: A tuple of the matched files and the missing frames.
+    """
+
+    output = list()
+    missing = list()
+
+    parent_d, file_pattern_n = os.path.split(os.path.abspath(user_pattern))
+
+    prefix, fspec, suffix = framespec.find_frame_spec(file_pattern_n)
+    frames = framespec.expand_frame_spec(fspec)
+    actual_padding = framespec.calc_padding(frames, fspec, padding)
+
+    prefix_pattern = framespec.seq_and_udim_ids_to_regex(prefix)
+    suffix_pattern = framespec.seq_and_udim_ids_to_regex(suffix)
+
+    files_n = os.listdir(parent_d)
+
+    for frame in frames:
+        matched = False
+        if not padding:
+            frame_pattern = "0*" + str(frame)
+        else:
+            frame_pattern = str(frame).rjust(actual_padding, "0")
+        pattern = prefix_pattern + frame_pattern + suffix_pattern
+        for file_n in files_n:
+            if re.match(pattern, file_n):
+                output.append(os.path.join(parent_d, file_n))
+                matched = True
+        if not matched:
+            missing.append(frame)
+
+    missing.sort()
+    for i in range(len(missing)):
+        missing[i] = str(missing[i]).rjust(actual_padding, "0")
+
+    output.sort()
+    return output, missing
+
+
+# ------------------------------------------------------------------------------
+def build_fixture(count):
+    """
+    Creates a temp directory holding a sequence of count empty frames (every
+    tenth frame is left out so that there are missing frames to report).
+
+    :param count: The number of directory entries to create.
+
+    :return: The path to the temp directory.
+    """
+
+    fixture_d = tempfile.mkdtemp(prefix="bvzlib_bench_")
+    for frame in range(1, count + 1):
+        if frame % 10:
+            file_n = "render.beauty." + str(frame).rjust(7, "0") + ".exr"
+        else:
+            file_n = "render.other." + str(frame).rjust(7, "0") + ".exr"
+        open(os.path.join(fixture_d, file_n), "w").close()
+    return fixture_d
+
+
+# ------------------------------------------------------------------------------
+def time_call(func, *args):
+    """
+    Times a single call to a function.
+
+    :param func: The function to call.
+    :param args: The arguments to pass to the function.
+
+    :return: A tuple of the elapsed time in seconds and the function's result.
+    """
+
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+# ------------------------------------------------------------------------------
+def time_legacy(fixture_d,
+                count,
+                sample):
+    """
+    Times the legacy algorithm on the first sample frames of the fixture,
+    checks its result against expand_files, and scales the time up to all of
+    the frames.
+
+    :param fixture_d: The fixture directory.
+    :param count: The number of frames in the fixture.
+    :param sample: The number of frames to time.
+
+    :return: The estimated time in seconds for all of the frames.
+    """
+
+    pattern = os.path.join(fixture_d, "render.beauty.1-" + str(sample) + ".exr")
+
+    old_time, old_result = time_call(legacy_expand_files, pattern)
+    assert old_result == framespec.expand_files(pattern)
+
+    return old_time * count / float(sample)
+
+
+# ------------------------------------------------------------------------------
+def main():
+    """
+    Runs the benchmark for each entry count and prints the results.
+
+    :return: Nothing.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Compares expand_files against the per-frame algorithm.")
+    parser.add_argument("--entries", type=int, nargs="+",
+                        default=[10000, 100000, 1000000],
+                        help="The directory entry counts to benchmark.")
+    parser.add_argument("--legacy-frames", type=int, default=1000,
+                        help="The number of frames to time the legacy "
+                             "algorithm on when a full run is too slow.")
+    parser.add_argument("--full-legacy", action="store_true",
+                        help="Always time the legacy algorithm on every "
+                             "frame, however long it takes.")
+    args = parser.parse_args()
+
+    print("%10s %10s %12s %12s %11s" % ("entries", "frames", "legacy (s)",
+                                        "indexed (s)", "speedup"))
+
+    estimated = False
+
+    for count in args.entries:
+
+        fixture_d = build_fixture(count)
+        try:
+            pattern = os.path.join(fixture_d,
+                                   "render.beauty.1-" + str(count) + ".exr")
+
+            new_time, new_result = time_call(framespec.expand_files, pattern)
+
+            sample = min(args.legacy_frames, count)
+            if args.full_legacy or count * count <= LEGACY_LIMIT:
+                old_time, old_result = time_call(legacy_expand_files, pattern)
+                assert old_result == new_result
+                label = " "
+            else:
+                old_time = time_legacy(fixture_d, count, sample)
+                label = "*"
+                estimated = True
+
+            print("%10d %10d %11.3f%s %12.3f %9.1fx%s" % (
+                count, count, old_time, label, new_time,
+                old_time / max(new_time, 1e-9), label))
+            sys.stdout.flush()
+        finally:
+            shutil.rmtree(fixture_d)
+
+    if estimated:
+        print("* est.: the legacy time was measured on the first %d frames "
+              "and scaled up." % args.legacy_frames)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#! /usr/bin/env python
+
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Measures the throughput of filesystem.hash_files against the number of
+# workers, with both thread and process pools.
+#
+# Usage:
+#
+#     bench_hash_files.py [--files 64] [--file-mb 16] [--algorithm md5]
+#                         [--workers 1 2 4 8 16] [--tmp-dir DIR]
+#
+# Note: The fixture files are read from the page cache after the first pass,
+# so on a local disk this measures how fast the CPUs can hash. Point --tmp-dir
+# at the filesystem of interest (and drop the page cache between runs) to
+# measure the storage instead.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "modules"))
+
+from bvzlib import filesystem
+
+
+# ------------------------------------------------------------------------------
+def build_fixture(fixture_d,
+                  count,
+                  size_mb):
+    """
+    Writes count files of pseudo random data.
+
+    :param fixture_d: The directory to write the files to.
+    :param count: The number of files.
+    :param size_mb: The size of each file in MB.
+
+    :return: A list of the paths to the files.
+    """
+
+    output = list()
+    block = os.urandom(2**20)
+
+    for i in range(count):
+        file_p = os.path.join(fixture_d, "file_" + str(i) + ".bin")
+        with open(file_p, "wb") as f:
+            f.write(str(i).encode("ascii"))
+            for j in range(size_mb):
+                f.write(block)
+        output.append(file_p)
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def time_hash_files(files_p,
+                    workers,
+                    algorithm,
+                    use_processes):
+    """
+    Checksums every file once.
+
+    :param files_p: The list of files to checksum.
+    :param workers: The number of workers to use.
+    :param algorithm: The hashlib algorithm to use.
+    :param use_processes: Whether to use a process pool.
+
+    :return: The elapsed time in seconds.
+    """
+
+    start = time.time()
+    results = dict(filesystem.hash_files(files_p,
+                                         workers=workers,
+                                         algorithm=algorithm,
+                                         use_processes=use_processes))
+    assert len(results) == len(files_p)
+    return time.time() - start
+
+
+# ------------------------------------------------------------------------------
+def main():
+    """
+    Builds the fixture and prints the throughput for each number of workers.
+
+    :return: Nothing.
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmarks hash_files.")
+    parser.add_argument("--files", type=int, default=64)
+    parser.add_argument("--file-mb", type=int, default=16)
+    parser.add_argument("--algorithm", default="md5")
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=[1, 2, 4, 8, 16])
+    parser.add_argument("--tmp-dir")
+    args = parser.parse_args()
+
+    fixture_d = tempfile.mkdtemp(prefix="bvzlib_bench_", dir=args.tmp_dir)
+
+    try:
+        files_p = build_fixture(fixture_d, args.files, args.file_mb)
+        total_mb = float(args.files * args.file_mb)
+
+        # Warm the page cache so that every run starts from the same state.
+        time_hash_files(files_p, 1, args.algorithm, False)
+
+        start = time.time()
+        for file_p in files_p:
+            filesystem.hash_file(file_p, args.algorithm)
+        serial = time.time() - start
+
+        print("%-8s %8s %12s %12s" % ("pool", "workers", "MB/s", "speedup"))
+        print("%-8s %8d %12.1f %12s" % ("serial", 1, total_mb / serial, "1.0x"))
+
+        for use_processes in [False, True]:
+            pool = "process" if use_processes else "thread"
+            for workers in args.workers:
+                elapsed = time_hash_files(files_p, workers, args.algorithm,
+                                          use_processes)
+                print("%-8s %8d %12.1f %11.1fx" % (pool, workers,
+                                                   total_mb / elapsed,
+                                                   serial / elapsed))
+                sys.stdout.flush()
+
+    finally:
+        shutil.rmtree(fixture_d)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#! /usr/bin/env python
+
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Measures how seqscan.scan_sequences scales with the number of workers.
+#
+# Usage:
+#
+#     bench_scan_sequences.py [--dirs 400] [--files 200] [--depth 2]
+#                             [--workers 1 2 4 8 16] [--latency-ms 0]
+#                             [--tmp-dir DIR]
+#
+# Listing a directory on a local disk mostly runs from the page cache, holding
+# the GIL, so extra workers help little there. The workers pay off when every
+# listing has to wait on a server. Either point --tmp-dir at a network
+# filesystem, or use --latency-ms to add a sleep (which releases the GIL, like
+# a network round trip does) to the start of every directory listing.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "modules"))
+
+from bvzlib import filesystem
+from bvzlib import seqscan
+
+
+# ------------------------------------------------------------------------------
+def build_fixture(fixture_d,
+                  dirs,
+                  files,
+                  depth):
+    """
+    Builds a tree of directories, each holding a sequence of empty files.
+
+    :param fixture_d: The directory to build the tree in.
+    :param dirs: The number of leaf directories.
+    :param files: The number of files in each leaf directory.
+    :param depth: How many levels of directories to put above each leaf.
+
+    :return: Nothing.
+    """
+
+    for i in range(dirs):
+        parts = ["group_" + str(i % (level + 2)) for level in range(depth)]
+        dir_d = os.path.join(fixture_d, *(parts + ["shot_" + str(i)]))
+        os.makedirs(dir_d)
+        for frame in range(1, files + 1):
+            file_n = "render." + str(frame).rjust(4, "0") + ".exr"
+            open(os.path.join(dir_d, file_n), "w").close()
+
+
+# ------------------------------------------------------------------------------
+def time_scan(fixture_d,
+              workers):
+    """
+    Scans the whole tree once.
+
+    :param fixture_d: The root of the tree.
+    :param workers: The number of workers to use.
+
+    :return: A tuple of the elapsed time in seconds and the number of
+             directories scanned.
+    """
+
+    start = time.time()
+    count = 0
+    for dir_d, sequences in seqscan.scan_sequences(fixture_d, workers=workers):
+        count += 1
+    return time.time() - start, count
+
+
+# ------------------------------------------------------------------------------
+def main():
+    """
+    Builds the fixture and prints the scan time for each number of workers.
+
+    :return: Nothing.
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmarks scan_sequences.")
+    parser.add_argument("--dirs", type=int, default=400)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=[1, 2, 4, 8, 16])
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="A delay added to every directory listing.")
+    parser.add_argument("--tmp-dir")
+    args = parser.parse_args()
+
+    fixture_d = tempfile.mkdtemp(prefix="bvzlib_bench_", dir=args.tmp_dir)
+
+    if args.latency_ms:
+        scandir = filesystem.scandir
+        latency = args.latency_ms / 1000.0
+
+        def slow_scandir(dir_d):
+            time.sleep(latency)
+            return scandir(dir_d)
+
+        filesystem.scandir = slow_scandir
+
+    try:
+        build_fixture(fixture_d, args.dirs, args.files, args.depth)
+
+        # Warm the page cache so that every run starts from the same state.
+        time_scan(fixture_d, 1)
+
+        print("%8s %8s %12s %12s" % ("workers", "dirs", "seconds", "speedup"))
+
+        serial = None
+        for workers in args.workers:
+            elapsed, count = time_scan(fixture_d, workers)
+            if serial is None:
+                serial = elapsed
+            print("%8d %8d %12.3f %11.1fx" % (workers, count, elapsed,
+                                              serial / elapsed))
+            sys.stdout.flush()
+
+    finally:
+        shutil.rmtree(fixture_d)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,863 @@
+#! /usr/bin/env python
+
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Benchmarks the hot paths of the framespec and filesystem modules against
+# synthetic fixtures built in a temp directory, and saves the results as JSON so
+# that runs from different versions of bvzlib can be compared.
+#
+# For each benchmark the suite reports:
+#
+# - The best and median wall clock time.
+# - The peak of the Python heap during a run (via tracemalloc, Python 3 only).
+#   This only covers memory allocated by Python objects. Memory allocated by C
+#   libraries, mmap and the page cache is not included.
+# - The number of read and write system calls made during a run (from
+#   /proc/self/io, Linux only). These only count calls that transfer data.
+# - The number of filesystem calls made during a run, by kind (stat, listdir,
+#   scandir, open, ...). These are counted by wrapping the functions of the os
+#   module (and the functions that bvzlib imported from it) during one extra,
+#   untimed run, so they cover every call made from Python, but not calls
+#   made from inside C code (such as shutil's kernel copies). The stat of a
+#   scandir entry is counted the first time it is asked for.
+#
+# Values that cannot be measured on the current platform are stored as null.
+#
+# The memoize[cached] and memoize[uncached] benchmarks make the same calls to
+# the memoized framespec helpers with and without their cache. If the cached
+# calls are not the faster of the two, a warning is printed and the suite exits
+# with a status of 1.
+#
+# Usage:
+#
+#     bench_suite.py [--preset quick|full] [--output results.json]
+#                    [--compare baseline.json] [--only NAME] ...
+#
+# The "quick" preset (the default) uses sequences of 1k and 100k frames and a
+# 256MB large file. The "full" preset adds a 1M frame sequence and uses a 2GB
+# large file. The individual sizes can be overridden on the command line.
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "modules"))
+
+from bvzlib import dedupindex
+from bvzlib import filesystem
+from bvzlib import framespec
+
+
+PRESETS = {
+    "quick": {"frames": [1000, 100000],
+              "udim_tiles": 10,
+              "udim_frames": 1000,
+              "file_mb": 256,
+              "candidates": 32,
+              "candidate_mb": 4,
+              "repeat": 3},
+    "full": {"frames": [1000, 100000, 1000000],
+             "udim_tiles": 100,
+             "udim_frames": 1000,
+             "file_mb": 2048,
+             "candidates": 256,
+             "candidate_mb": 4,
+             "repeat": 5},
+}
+
+# The size of the blocks used to write the large fixture files.
+BLOCK_SIZE = 2**20
+
+# The number of times each memoized helper is called by the memoize benchmarks.
+MEMOIZE_CALLS = 100000
+
+# The os functions counted as filesystem calls, keyed on the name they are
+# reported under.
+FS_CALLS = {"stat": ["stat", "lstat"],
+            "listdir": ["listdir"],
+            "scandir": ["scandir"],
+            "open": ["open"],
+            "link": ["link", "symlink"],
+            "rename": ["rename", "replace"],
+            "remove": ["remove", "unlink", "rmdir"],
+            "mkdir": ["mkdir"]}
+
+
+# ==============================================================================
+class Benchmark(object):
+    """
+    A single benchmark: A function to time, and an optional setup function
+    that is run (untimed) before every call to build the arguments.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self,
+                 name,
+                 func,
+                 setup=None,
+                 params=None):
+        """
+        Setup.
+
+        :param name: The unique name of the benchmark. Used as the key when
+               comparing results.
+        :param func: The function to time. It is called with the arguments
+               returned by setup.
+        :param setup: A function that takes no arguments and returns a tuple of
+               the arguments to pass to func. If None, func is called with no
+               arguments. Defaults to None.
+        :param params: A dictionary describing the fixture used, stored with
+               the results. Defaults to None.
+
+        :return: Nothing.
+        """
+
+        self.name = name
+        self.func = func
+        self.setup = setup
+        self.params = params or dict()
+
+    # --------------------------------------------------------------------------
+    def args(self):
+        """
+        :return: The arguments for a single call to func.
+        """
+
+        if self.setup is None:
+            return tuple()
+        return self.setup()
+
+
+# ------------------------------------------------------------------------------
+def io_counters():
+    """
+    :return: A tuple of the number of read and write system calls made by this
+             process so far, or (None, None) if they cannot be read.
+    """
+
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(":", 1) for line in f)
+    except (IOError, OSError, ValueError):
+        return None, None
+
+    return int(counters["syscr"]), int(counters["syscw"])
+
+
+# ==============================================================================
+class FsCallCounter(object):
+    """
+    Counts the filesystem calls made from Python while it is active, by
+    replacing the os functions in FS_CALLS (and builtin open) with wrappers.
+    The wrappers are also put in place of any copies of these functions that
+    bvzlib modules imported by name (i.e. "from os import scandir").
+
+    Use as a context manager. The counts are in the counts attribute.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self):
+        """
+        Setup.
+
+        :return: Nothing.
+        """
+
+        self.counts = collections.Counter()
+        self._patched = list()
+
+    # --------------------------------------------------------------------------
+    def _count(self, kind):
+        """
+        Increments the count of a kind of call.
+
+        :param kind: The name the call is reported under.
+
+        :return: Nothing.
+        """
+
+        self.counts[kind] += 1
+
+    # --------------------------------------------------------------------------
+    def _wrap(self, kind, func):
+        """
+        :param kind: The name the call is reported under.
+        :param func: The function to wrap.
+
+        :return: A function that counts each call and then calls func.
+        """
+
+        counter = self
+
+        if kind == "scandir":
+            def wrapper(*args, **kwargs):
+                counter._count(kind)
+                return _CountedScandir(func(*args, **kwargs), counter)
+        else:
+            def wrapper(*args, **kwargs):
+                counter._count(kind)
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    # --------------------------------------------------------------------------
+    def __enter__(self):
+
+        wrappers = dict()
+        for kind, names in FS_CALLS.items():
+            for name in names:
+                func = getattr(os, name, None)
+                if func is not None:
+                    wrappers[id(func)] = (func, self._wrap(kind, func))
+        wrappers[id(builtins.open)] = (builtins.open,
+                                       self._wrap("open", builtins.open))
+
+        modules = [os, builtins] + [module for name, module in
+                                    sorted(sys.modules.items())
+                                    if name.startswith("bvzlib")
+                                    and module is not None]
+
+        for module in modules:
+            for name, value in list(vars(module).items()):
+                if id(value) in wrappers and wrappers[id(value)][0] is value:
+                    setattr(module, name, wrappers[id(value)][1])
+                    self._patched.append((module, name, value))
+
+        return self
+
+    # --------------------------------------------------------------------------
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        for module, name, value in reversed(self._patched):
+            setattr(module, name, value)
+        self._patched = list()
+
+
+# ==============================================================================
+class _CountedScandir(object):
+    """
+    Wraps a scandir iterator so that the stat of each of its entries is
+    counted (the first time it is asked for, since scandir caches it).
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, iterator, counter):
+        self._iterator = iterator
+        self._counter = counter
+
+    # --------------------------------------------------------------------------
+    def __iter__(self):
+        return self
+
+    # --------------------------------------------------------------------------
+    def __next__(self):
+        return _CountedEntry(next(self._iterator), self._counter)
+
+    next = __next__
+
+    # --------------------------------------------------------------------------
+    def close(self):
+        close = getattr(self._iterator, "close", None)
+        if close is not None:
+            close()
+
+    # --------------------------------------------------------------------------
+    def __enter__(self):
+        return self
+
+    # --------------------------------------------------------------------------
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# ==============================================================================
+class _CountedEntry(object):
+    """
+    Wraps a scandir entry so that the first call to its stat is counted.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, entry, counter):
+        self._entry = entry
+        self._counter = counter
+        self._stated = set()
+
+    # --------------------------------------------------------------------------
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+    # --------------------------------------------------------------------------
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks not in self._stated:
+            self._stated.add(follow_symlinks)
+            self._counter._count("stat")
+        return self._entry.stat(follow_symlinks=follow_symlinks)
+
+
+# ------------------------------------------------------------------------------
+def run_benchmark(benchmark,
+                  repeat):
+    """
+    Times a benchmark repeat times, then runs it once more while tracing memory
+    allocations, and once more while counting filesystem calls.
+
+    :param benchmark: The Benchmark to run.
+    :param repeat: The number of timed calls.
+
+    :return: A dictionary of the results.
+    """
+
+    timings = list()
+    reads = list()
+    writes = list()
+
+    for i in range(repeat):
+        args = benchmark.args()
+        read_start, write_start = io_counters()
+        start = time.time()
+        benchmark.func(*args)
+        timings.append(time.time() - start)
+        read_end, write_end = io_counters()
+        if read_start is not None:
+            reads.append(read_end - read_start)
+            writes.append(write_end - write_start)
+
+    peak = None
+    if tracemalloc is not None:
+        args = benchmark.args()
+        tracemalloc.start()
+        try:
+            benchmark.func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    args = benchmark.args()
+    with FsCallCounter() as counter:
+        benchmark.func(*args)
+
+    ordered = sorted(timings)
+
+    return {"name": benchmark.name,
+            "params": benchmark.params,
+            "seconds": timings,
+            "best": ordered[0],
+            "median": ordered[len(ordered) // 2],
+            "python_heap_peak_bytes": peak,
+            "read_syscalls": min(reads) if reads else None,
+            "write_syscalls": min(writes) if writes else None,
+            "fs_calls": dict(counter.counts)}
+
+
+# ------------------------------------------------------------------------------
+def write_file(file_p,
+               size_mb,
+               seed):
+    """
+    Writes a file of pseudo random data.
+
+    :param file_p: The path to the file.
+    :param size_mb: The size of the file in MB.
+    :param seed: Bytes that make the content of this file unique.
+
+    :return: Nothing.
+    """
+
+    block = bytearray(os.urandom(BLOCK_SIZE))
+    block[:len(seed)] = seed
+    block = bytes(block)
+
+    with open(file_p, "wb") as f:
+        for i in range(size_mb):
+            f.write(block)
+
+
+# ------------------------------------------------------------------------------
+def build_sequence(fixture_d,
+                   count):
+    """
+    Creates a directory holding a sequence of count empty frames. Every tenth
+    frame belongs to a different sequence so that there are missing frames to
+    report.
+
+    :param fixture_d: The root of the fixtures.
+    :param count: The number of frames.
+
+    :return: The pattern that matches the sequence.
+    """
+
+    seq_d = os.path.join(fixture_d, "seq_" + str(count))
+    os.mkdir(seq_d)
+
+    for frame in range(1, count + 1):
+        if frame % 10:
+            file_n = "render.beauty." + str(frame).rjust(7, "0") + ".exr"
+        else:
+            file_n = "render.other." + str(frame).rjust(7, "0") + ".exr"
+        open(os.path.join(seq_d, file_n), "w").close()
+
+    return os.path.join(seq_d, "render.beauty.1-" + str(count) + ".exr")
+
+
+# ------------------------------------------------------------------------------
+def build_udims(fixture_d,
+               tiles,
+               frames):
+    """
+    Creates a directory holding a UDIM texture sequence.
+
+    :param fixture_d: The root of the fixtures.
+    :param tiles: The number of UDIM tiles.
+    :param frames: The number of frames per tile.
+
+    :return: The pattern that matches the sequence.
+    """
+
+    udim_d = os.path.join(fixture_d, "udim")
+    os.mkdir(udim_d)
+
+    for tile in range(1001, 1001 + tiles):
+        for frame in range(1, frames + 1):
+            file_n = "tex.%d.%04d.exr" % (tile, frame)
+            open(os.path.join(udim_d, file_n), "w").close()
+
+    return os.path.join(udim_d, "tex.<UDIM>.1-" + str(frames) + ".exr")
+
+
+# ------------------------------------------------------------------------------
+def build_benchmarks(fixture_d,
+                     settings,
+                     only):
+    """
+    Builds the fixtures and the list of benchmarks to run.
+
+    :param fixture_d: The directory to build the fixtures in.
+    :param settings: The dictionary of fixture sizes (see PRESETS).
+    :param only: A list of benchmark name prefixes to build. If empty, all of
+           the benchmarks are built.
+
+    :return: A list of Benchmark objects.
+    """
+
+    def wanted(name):
+        return not only or any(name.startswith(prefix) for prefix in only)
+
+    output = list()
+
+    # --- framespec ------------------------------------------------------------
+    if wanted("find_frame_spec"):
+        names = ["shot_%04d.beauty.%d-%dx2####.exr" % (i, i, i + 100)
+                 for i in range(10000)]
+
+        def setup_find():
+            framespec.PATTERN_CACHE.clear()
+            return (names,)
+
+        output.append(Benchmark("find_frame_spec",
+                                lambda names: [framespec.find_frame_spec(name)
+                                               for name in names],
+                                setup_find,
+                                {"names": len(names)}))
+
+    if wanted("memoize"):
+        calls = [(framespec.seq_id_to_regex, ("file.####.exr",)),
+                 (framespec.udim_id_to_regex, ("file.<UDIM>.exr",)),
+                 (framespec.seq_and_udim_ids_to_regex,
+                  ("file.<UDIM>.####.exr",))]
+        uncached = [(getattr(func, "__wrapped__", None), args)
+                    for func, args in calls]
+        modes = [("cached", calls)]
+        if all(func is not None for func, args in uncached):
+            modes.append(("uncached", uncached))
+
+        def run_calls(calls):
+            for i in range(MEMOIZE_CALLS):
+                for func, args in calls:
+                    func(*args)
+
+        for mode, mode_calls in modes:
+            output.append(Benchmark("memoize[" + mode + "]",
+                                    run_calls,
+                                    lambda mode_calls=mode_calls: (mode_calls,),
+                                    {"calls": MEMOIZE_CALLS * len(calls)}))
+
+    if wanted("expand_frame_spec"):
+        for spec in ["1-1000000", "1-100000x3,200000-300000,5,7,9"]:
+            output.append(Benchmark("expand_frame_spec[" + spec + "]",
+                                    framespec.expand_frame_spec,
+                                    lambda spec=spec: (spec,),
+                                    {"spec": spec}))
+
+    for count in settings["frames"]:
+        name = "expand_files[" + str(count) + "]"
+        if wanted(name):
+            pattern = build_sequence(fixture_d, count)
+            output.append(Benchmark(name,
+                                    framespec.expand_files,
+                                    lambda pattern=pattern: (pattern,),
+                                    {"frames": count}))
+
+    if wanted("expand_files[udim]"):
+        pattern = build_udims(fixture_d,
+                              settings["udim_tiles"],
+                              settings["udim_frames"])
+        output.append(Benchmark("expand_files[udim]",
+                                framespec.expand_files,
+                                lambda: (pattern,),
+                                {"tiles": settings["udim_tiles"],
+                                 "frames": settings["udim_frames"]}))
+
+    # --- filesystem -----------------------------------------------------------
+    file_mb = settings["file_mb"]
+    large_names = ["md5_for_file", "files_are_identical", "verified_copy_file",
+                   "copy_file_deduplicated"]
+
+    if any(wanted(name) for name in large_names):
+
+        large_p = os.path.join(fixture_d, "large.bin")
+        write_file(large_p, file_mb, b"large")
+        copy_p = os.path.join(fixture_d, "large_copy.bin")
+        shutil.copy(large_p, copy_p)
+
+        if wanted("md5_for_file"):
+            output.append(Benchmark("md5_for_file",
+                                    filesystem.md5_for_file,
+                                    lambda: (large_p,),
+                                    {"mb": file_mb}))
+
+        if wanted("files_are_identical"):
+            output.append(Benchmark("files_are_identical",
+                                    filesystem.files_are_identical,
+                                    lambda: (large_p, copy_p),
+                                    {"mb": file_mb}))
+
+        if wanted("verified_copy_file"):
+            target_p = os.path.join(fixture_d, "large_verified.bin")
+
+            def setup_verified():
+                if os.path.exists(target_p):
+                    os.remove(target_p)
+                return large_p, target_p
+
+            output.append(Benchmark("verified_copy_file",
+                                    filesystem.verified_copy_file,
+                                    setup_verified,
+                                    {"mb": file_mb}))
+
+    if wanted("copy_file_deduplicated"):
+        output.extend(build_dedup_benchmarks(fixture_d, settings))
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def build_dedup_benchmarks(fixture_d,
+                           settings):
+    """
+    Builds a data store holding a number of same sized files, plus a source
+    file that matches the last of them (a hit) and one that matches none of
+    them (a miss).
+
+    :param fixture_d: The directory to build the fixtures in.
+    :param settings: The dictionary of fixture sizes (see PRESETS).
+
+    :return: A list of Benchmark objects.
+    """
+
+    output = list()
+
+    data_d = os.path.join(fixture_d, "data")
+    dest_d = os.path.join(fixture_d, "dest")
+    source_d = os.path.join(fixture_d, "source")
+    for path_d in [data_d, dest_d, source_d]:
+        os.mkdir(path_d)
+
+    size_mb = settings["candidate_mb"]
+    count = settings["candidates"]
+
+    for i in range(count):
+        write_file(os.path.join(data_d, "candidate_" + str(i) + ".bin"),
+                   size_mb,
+                   ("candidate_" + str(i)).encode("ascii"))
+
+    hit_p = os.path.join(source_d, "hit.bin")
+    shutil.copy(os.path.join(data_d, "candidate_" + str(count - 1) + ".bin"),
+                hit_p)
+    miss_p = os.path.join(source_d, "miss.bin")
+    write_file(miss_p, size_mb, b"miss")
+
+    data_files = set(os.listdir(data_d))
+
+    def setup_dedup(source_p):
+        # Remove anything a previous run stored so each run starts the same.
+        for file_n in os.listdir(data_d):
+            if file_n not in data_files:
+                os.remove(os.path.join(data_d, file_n))
+        data_sizes = filesystem.dir_files_keyed_by_size(data_d)
+        return source_p, dest_d, data_d, data_sizes
+
+    for name, source_p in [("hit", hit_p), ("miss", miss_p)]:
+        output.append(Benchmark("copy_file_deduplicated[" + name + "]",
+                                filesystem.copy_file_deduplicated,
+                                lambda source_p=source_p: setup_dedup(
+                                    source_p),
+                                {"candidates": count, "mb": size_mb}))
+
+    index = dedupindex.DedupIndex(data_d,
+                                  os.path.join(fixture_d, "dedup.sqlite"))
+    index.rebuild()
+
+    def setup_indexed(source_p):
+        setup_dedup(source_p)
+        index.verify(repair=True)
+        return source_p, dest_d, data_d, None, None, "v", 4, False, index
+
+    for name, source_p in [("hit", hit_p), ("miss", miss_p)]:
+        output.append(Benchmark("copy_file_deduplicated[index " + name + "]",
+                                filesystem.copy_file_deduplicated,
+                                lambda source_p=source_p: setup_indexed(
+                                    source_p),
+                                {"candidates": count, "mb": size_mb}))
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def metadata(settings):
+    """
+    :param settings: The dictionary of fixture sizes used.
+
+    :return: A dictionary describing the machine and the version of bvzlib
+             being measured.
+    """
+
+    repo_d = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+    try:
+        with open(os.devnull, "w") as devnull:
+            revision = subprocess.check_output(
+                ["git", "-C", repo_d, "rev-parse", "HEAD"], stderr=devnull)
+        revision = revision.decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    return {"date": datetime.datetime.now().isoformat(),
+            "revision": revision,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpus": _cpu_count(),
+            "settings": settings}
+
+
+# ------------------------------------------------------------------------------
+def _cpu_count():
+    """
+    :return: The number of CPUs, or None if it cannot be determined.
+    """
+
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return None
+
+
+# ------------------------------------------------------------------------------
+def compare(results,
+            baseline_p):
+    """
+    Prints each benchmark's best time against the same benchmark in a previous
+    results file.
+
+    :param results: The list of result dictionaries from this run.
+    :param baseline_p: The path to a JSON file saved by a previous run.
+
+    :return: Nothing.
+    """
+
+    with open(baseline_p, "r") as f:
+        baseline = dict((result["name"], result)
+                        for result in json.load(f)["results"])
+
+    print("")
+    print("%-50s %12s %12s %9s" % ("compared to " + baseline_p[-38:],
+                                   "before (s)", "after (s)", "ratio"))
+
+    for result in results:
+        before = baseline.get(result["name"])
+        if before is None:
+            print("%-50s %12s %12.4f %9s" % (result["name"], "-",
+                                             result["best"], "new"))
+            continue
+        ratio = result["best"] / max(before["best"], 1e-9)
+        print("%-50s %12.4f %12.4f %8.2fx" % (result["name"], before["best"],
+                                              result["best"], ratio))
+
+
+# ------------------------------------------------------------------------------
+def check_memoize(results):
+    """
+    Checks that the memoized framespec helpers are faster with their cache than
+    without it.
+
+    :param results: The list of result dictionaries from this run.
+
+    :return: False if the cached calls were slower, True otherwise (including
+             when the memoize benchmarks were not run).
+    """
+
+    results = dict((result["name"], result) for result in results)
+    cached = results.get("memoize[cached]")
+    uncached = results.get("memoize[uncached]")
+    if cached is None or uncached is None:
+        return True
+
+    if cached["best"] < uncached["best"]:
+        return True
+
+    print("")
+    print("WARNING: memoized calls took %.4fs, but only %.4fs without the "
+          "cache." % (cached["best"], uncached["best"]))
+    return False
+
+
+# ------------------------------------------------------------------------------
+def format_bytes(value):
+    """
+    :param value: A number of bytes, or None.
+
+    :return: The value formatted for display.
+    """
+
+    if value is None:
+        return "-"
+    for unit in ["B", "KB", "MB"]:
+        if value < 1024:
+            return "%.1f%s" % (value, unit)
+        value /= 1024.0
+    return "%.1fGB" % value
+
+
+# ------------------------------------------------------------------------------
+def main():
+    """
+    Parses the command line, builds the fixtures, runs the benchmarks and
+    saves the results.
+
+    :return: Nothing.
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmarks bvzlib.")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="quick")
+    parser.add_argument("--frames", type=int, nargs="+",
+                        help="The sequence lengths to build.")
+    parser.add_argument("--file-mb", type=int,
+                        help="The size of the large file in MB.")
+    parser.add_argument("--repeat", type=int,
+                        help="The number of timed runs per benchmark.")
+    parser.add_argument("--only", nargs="+", default=list(),
+                        help="Only run benchmarks starting with these names.")
+    parser.add_argument("--tmp-dir",
+                        help="Where to build the fixtures (the filesystem "
+                             "being measured).")
+    parser.add_argument("--output",
+                        help="The JSON file to save the results to.")
+    parser.add_argument("--compare",
+                        help="A JSON file from a previous run to compare to.")
+    args = parser.parse_args()
+
+    settings = dict(PRESETS[args.preset])
+    if args.frames:
+        settings["frames"] = args.frames
+    if args.file_mb:
+        settings["file_mb"] = args.file_mb
+    if args.repeat:
+        settings["repeat"] = args.repeat
+
+    fixture_d = tempfile.mkdtemp(prefix="bvzlib_bench_", dir=args.tmp_dir)
+
+    results = list()
+
+    try:
+        sys.stdout.write("building fixtures in " + fixture_d + "\n")
+        sys.stdout.flush()
+        benchmarks = build_benchmarks(fixture_d, settings, args.only)
+
+        print("%-50s %10s %10s %10s %10s %10s %10s %10s" % (
+            "benchmark", "best (s)", "median (s)", "py heap pk", "reads",
+            "writes", "stats", "fs calls"))
+
+        for benchmark in benchmarks:
+            result = run_benchmark(benchmark, settings["repeat"])
+            results.append(result)
+            print("%-50s %10.4f %10.4f %10s %10s %10s %10d %10d" % (
+                result["name"],
+                result["best"],
+                result["median"],
+                format_bytes(result["python_heap_peak_bytes"]),
+                "-" if result["read_syscalls"] is None
+                else result["read_syscalls"],
+                "-" if result["write_syscalls"] is None
+                else result["write_syscalls"],
+                result["fs_calls"].get("stat", 0),
+                sum(result["fs_calls"].values())))
+            sys.stdout.flush()
+
+    finally:
+        shutil.rmtree(fixture_d)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": metadata(settings), "results": results}, f,
+                      indent=4, sort_keys=True)
+        print("results saved to " + args.output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+    if not check_memoize(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import functools
+import inspect
+import threading
+
+
+# ==============================================================================
+class LRUCache(object):
+    """
+    A simple, thread safe, least recently used cache with a maximum number of
+    entries. Keeps count of hits and misses so that the size can be tuned.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, maxsize=1024, count=True):
+        """
+        Setup.
+
+        :param maxsize: The maximum number of entries to hold. Once full, the
+               least recently used entry is discarded for each new entry. If 0,
+               nothing is ever stored. Defaults to 1024.
+        :param count: If False, hits and misses are not counted (for an owner
+               that keeps its own counts). Defaults to True.
+
+        :return: Nothing.
+        """
+
+        assert type(maxsize) is int and maxsize >= 0
+
+        self._maxsize = maxsize
+        self._count = count
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # --------------------------------------------------------------------------
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    # --------------------------------------------------------------------------
+    def get(self, key, default=None):
+        """
+        Returns the value stored for a key, marking it as the most recently
+        used.
+
+        :param key: The key to look up.
+        :param default: The value to return if the key is not in the cache.
+               Defaults to None.
+
+        :return: The cached value, or default if the key is not cached.
+        """
+
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                if self._count:
+                    self.misses += 1
+                return default
+            self._entries[key] = value
+            if self._count:
+                self.hits += 1
+            return value
+
+    # --------------------------------------------------------------------------
+    def set(self, key, value):
+        """
+        Stores a value, discarding the least recently used entry if the cache
+        is full.
+
+        :param key: The key to store the value under.
+        :param value: The value to store.
+
+        :return: Nothing.
+        """
+
+        with self._lock:
+            self._entries.pop(key, None)
+            if not self._maxsize:
+                return
+            self._entries[key] = value
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    # --------------------------------------------------------------------------
+    def discard(self, key):
+        """
+        Removes a key from the cache if it is there.
+
+        :param key: The key to remove.
+
+        :return: Nothing.
+        """
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    # --------------------------------------------------------------------------
+    def resize(self, maxsize):
+        """
+        Changes the maximum number of entries, discarding the least recently
+        used entries if the cache is now over its limit.
+
+        :param maxsize: The new maximum number of entries.
+
+        :return: Nothing.
+        """
+
+        assert type(maxsize) is int and maxsize >= 0
+
+        with self._lock:
+            self._maxsize = maxsize
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    # --------------------------------------------------------------------------
+    def clear(self):
+        """
+        Empties the cache and resets the hit and miss counters.
+
+        :return: Nothing.
+        """
+
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    # --------------------------------------------------------------------------
+    def stats(self):
+        """
+        :return: A dictionary with the number of hits, misses, the current size
+                 and the maximum size of the cache.
+        """
+
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self._entries),
+                    "maxsize": self._maxsize}
+
+    # --------------------------------------------------------------------------
+    def __len__(self):
+        return len(self._entries)
+
+    # --------------------------------------------------------------------------
+    def __contains__(self, key):
+        return key in self._entries
+
+
+# ------------------------------------------------------------------------------
+def memoize(lru_cache):
+    """
+    A decorator that stores the results of a function in an LRUCache, keyed on
+    the function itself and its arguments. Keyword arguments and missing
+    defaults are turned into positional arguments first, so f(1), f(1, 2)
+    and f(x=1) share an entry when 2 is the default for the second
+    parameter. The arguments must be hashable, and the results should be
+    immutable since the same object is handed back to every caller.
+
+    :param lru_cache: The LRUCache to store the results in. May be shared by
+           several functions.
+
+    :return: The decorator.
+    """
+
+    missing = object()
+
+    def decorator(func):
+
+        make_key = _key_maker(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            output = lru_cache.get(key, missing)
+            if output is missing:
+                output = func(*args, **kwargs)
+                lru_cache.set(key, output)
+            return output
+
+        return wrapper
+
+    return decorator
+
+
+# ------------------------------------------------------------------------------
+def _key_maker(func):
+    """
+    Builds the function that turns a call to func into a memoize key. The
+    parameter names and defaults are worked out once, here, so that building
+    a key is only a little tuple handling per call.
+
+    :param func: The function being memoized.
+
+    :return: A function that takes the args tuple and kwargs dictionary of a
+             call, and returns a hashable key.
+    """
+
+    code = getattr(func, "__code__", None)
+    simple = (code is not None and
+              not code.co_flags & (inspect.CO_VARARGS | inspect.CO_VARKEYWORDS)
+              and not getattr(code, "co_kwonlyargcount", 0))
+
+    if not simple:
+
+        def make_key(args, kwargs):
+            return func, args, tuple(sorted(kwargs.items()))
+
+        return make_key
+
+    names = code.co_varnames[:code.co_argcount]
+    count = len(names)
+    defaults = func.__defaults__ or ()
+    first_default = count - len(defaults)
+
+    def make_key(args, kwargs):
+        given = len(args)
+        if kwargs:
+            # Rare: turn the keywords into positional arguments.
+            args = list(args)
+            used = 0
+            for index in range(given, count):
+                name = names[index]
+                if name in kwargs:
+                    args.append(kwargs[name])
+                    used += 1
+                elif index >= first_default:
+                    args.append(defaults[index - first_default])
+                else:
+                    # Let the call itself raise the TypeError.
+                    return func, tuple(args), tuple(sorted(kwargs.items()))
+            if used != len(kwargs):
+                return func, tuple(args), tuple(sorted(kwargs.items()))
+            return func, tuple(args)
+        if given < count and given >= first_default:
+            return func, args + defaults[given - first_default:]
+        return func, args
+
+    return make_key
@@ -0,0 +1,476 @@
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+
+from bvzlib import dircache
+from bvzlib import filesystem
+
+
+# The name of the index file that is stored inside the data directory. Any
+# file starting with this name (including SQLite's journal files) is never
+# treated as part of the store (see filesystem.is_internal_file).
+INDEX_N = filesystem.DEDUP_INDEX_N
+
+# Bump this if the layout of the tables changes.
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS files (
+        name TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        digest BLOB NOT NULL,
+        ino INTEGER,
+        mtime_ns INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS files_size_digest ON files (size, digest);
+"""
+
+
+# ==============================================================================
+class DedupIndex(object):
+    """
+    A persistent index of the files in a de-duplicated data directory (see
+    filesystem.copy_file_deduplicated), keyed on the size and checksum of each
+    file. Finding out whether a file's contents are already stored is a
+    single indexed query instead of checksumming every stored file of the same
+    size.
+
+    The index is a SQLite database, stored inside the data directory by
+    default. Several processes may share it (SQLite handles the locking), and
+    a single DedupIndex may be shared between threads.
+
+    The index only knows about files that were added through it (or found by
+    rebuild). If files are added to or removed from the data directory by
+    other means, run verify (or rebuild) to bring it up to date.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self,
+                 data_d,
+                 index_p=None,
+                 timeout=60.0,
+                 algorithm=None):
+        """
+        Opens (and creates if needed) the index for a data directory.
+
+        :param data_d: The data directory being indexed.
+        :param index_p: The path to the index database. If None, the index is
+               stored in the data directory as INDEX_N. Defaults to None.
+        :param timeout: How many seconds to wait for another process that is
+               writing to the index before giving up. Defaults to 60.
+        :param algorithm: The hashlib algorithm used for the checksums. This is
+               fixed when the index is created, and a ValueError is raised if
+               an existing index uses a different algorithm. If None, the
+               index's algorithm is used ("md5" for a new index). Defaults to
+               None.
+
+        :return: Nothing.
+        """
+
+        assert os.path.exists(data_d)
+        assert os.path.isdir(data_d)
+
+        self.data_d = os.path.abspath(data_d)
+
+        if index_p is None:
+            index_p = os.path.join(self.data_d, INDEX_N)
+        self.index_p = index_p
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(index_p,
+                                           timeout=timeout,
+                                           check_same_thread=False)
+
+        with self._lock:
+            with self._connection:
+                self._connection.executescript(SCHEMA)
+                self._connection.execute(
+                    "INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)",
+                    ("schema_version", str(SCHEMA_VERSION)))
+                self._connection.execute(
+                    "INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)",
+                    ("algorithm", algorithm or "md5"))
+
+            meta = dict(self._connection.execute("SELECT key, value FROM meta"))
+
+        version = int(meta["schema_version"])
+        self.algorithm = meta["algorithm"]
+
+        if version != SCHEMA_VERSION:
+            self.close()
+            msg = "Unsupported dedup index version " + str(version) + ": "
+            raise ValueError(msg + index_p)
+
+        if algorithm is not None and algorithm != self.algorithm:
+            self.close()
+            msg = "Dedup index uses " + self.algorithm + ", not " + algorithm
+            raise ValueError(msg + ": " + index_p)
+
+    # --------------------------------------------------------------------------
+    def __enter__(self):
+        return self
+
+    # --------------------------------------------------------------------------
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # --------------------------------------------------------------------------
+    def __len__(self):
+        with self._lock:
+            cursor = self._connection.execute("SELECT COUNT(*) FROM files")
+            return cursor.fetchone()[0]
+
+    # --------------------------------------------------------------------------
+    def close(self):
+        """
+        Closes the database.
+
+        :return: Nothing.
+        """
+
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    # --------------------------------------------------------------------------
+    def lookup(self,
+               size,
+               digest):
+        """
+        Finds a stored file with the given size and checksum. A stored file
+        whose size, inode or modification time no longer match the index (it
+        was rewritten or replaced behind the index's back) is checksummed
+        again before it is trusted, and its entry is updated.
+
+        :param size: The size of the file in bytes.
+        :param digest: The checksum of the file, using the index's algorithm
+               (as returned by filesystem.hash_file).
+
+        :return: The full path to the stored file, or None if there is none.
+        """
+
+        with self._lock:
+            cursor = self._connection.execute(
+                "SELECT name, ino, mtime_ns FROM files "
+                "WHERE size = ? AND digest = ?",
+                (size, sqlite3.Binary(digest)))
+            rows = cursor.fetchall()
+
+        for name, ino, mtime in rows:
+            file_p = os.path.join(self.data_d, name)
+            try:
+                stat = os.stat(file_p)
+            except OSError:
+                # The file was removed behind the index's back.
+                self.remove(file_p)
+                continue
+
+            if (stat.st_size, stat.st_ino, dircache.mtime_ns(stat)) == (
+                    size, ino, mtime):
+                return file_p
+
+            # The file was changed behind the index's back, so the entry is
+            # stale. Checksum the file again and keep it if it still matches.
+            self.remove(file_p)
+            try:
+                current = filesystem.hash_file(file_p, self.algorithm)
+                self.add(file_p, current)
+            except (IOError, OSError):
+                continue
+            if stat.st_size == size and current == digest:
+                return file_p
+
+        return None
+
+    # --------------------------------------------------------------------------
+    def add(self,
+            file_p,
+            digest=None):
+        """
+        Adds (or updates) a file in the index.
+
+        :param file_p: The path to the file. It must be directly inside the data
+               directory.
+        :param digest: The checksum of the file if it is already known. If
+               None, the file is checksummed. Defaults to None.
+
+        :return: Nothing.
+        """
+
+        parent_d, file_n = os.path.split(os.path.abspath(file_p))
+        assert parent_d == self.data_d
+
+        stat = os.stat(file_p)
+        if digest is None:
+            digest = filesystem.hash_file(file_p, self.algorithm)
+
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO files "
+                    "(name, size, digest, ino, mtime_ns) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (file_n, stat.st_size, sqlite3.Binary(digest), stat.st_ino,
+                     dircache.mtime_ns(stat)))
+
+    # --------------------------------------------------------------------------
+    def remove(self,
+               file_p):
+        """
+        Removes a file from the index (the file itself is not touched).
+
+        :param file_p: The path to the file, or just its name.
+
+        :return: Nothing.
+        """
+
+        file_n = os.path.split(file_p)[1]
+
+        with self._lock:
+            with self._connection:
+                self._connection.execute("DELETE FROM files WHERE name = ?",
+                                         (file_n,))
+
+    # --------------------------------------------------------------------------
+    def _stored_files(self):
+        """
+        :return: A dictionary of the regular files in the data directory, keyed
+                 on name. The value is the stat result of the file.
+        """
+
+        output = dict()
+
+        for entry in dircache.scan_entries(self.data_d):
+            # Skip the index itself and files that are still being copied in.
+            if not entry.is_file or filesystem.is_internal_file(entry.name):
+                continue
+            file_p = os.path.join(self.data_d, entry.name)
+            if os.path.islink(file_p):
+                continue
+            try:
+                output[entry.name] = os.stat(file_p)
+            except OSError:
+                pass
+
+        return output
+
+    # --------------------------------------------------------------------------
+    def _indexed_files(self):
+        """
+        :return: A dictionary of the files in the index, keyed on name. The
+                 value is a tuple of the size, inode, modification time and
+                 checksum recorded when the file was indexed.
+        """
+
+        with self._lock:
+            cursor = self._connection.execute(
+                "SELECT name, size, ino, mtime_ns, digest FROM files")
+            return dict((row[0], row[1:]) for row in cursor)
+
+    # --------------------------------------------------------------------------
+    def rebuild(self,
+                progress=None,
+                workers=4):
+        """
+        Throws away the index and rebuilds it by checksumming every file in the
+        data directory.
+
+        :param progress: An optional function that is called with the path of
+               each file once it has been checksummed. Defaults to None.
+        :param workers: The number of files to checksum at the same time.
+               Defaults to 4.
+
+        :return: The number of files indexed.
+        """
+
+        stored = self._stored_files()
+
+        rows = list()
+        for file_p, digest in self._checksum(sorted(stored), workers, progress):
+            file_n = os.path.split(file_p)[1]
+            stat = stored[file_n]
+            rows.append((file_n, stat.st_size, sqlite3.Binary(digest),
+                         stat.st_ino, dircache.mtime_ns(stat)))
+
+        with self._lock:
+            with self._connection:
+                self._connection.execute("DELETE FROM files")
+                self._connection.executemany(
+                    "INSERT INTO files (name, size, digest, ino, mtime_ns) "
+                    "VALUES (?, ?, ?, ?, ?)", rows)
+
+        return len(rows)
+
+    # --------------------------------------------------------------------------
+    def verify(self,
+               repair=False,
+               rehash=False,
+               progress=None,
+               workers=4):
+        """
+        Compares the index against the files actually in the data directory.
+
+        :param repair: If True, the index is updated to match the data
+               directory. Defaults to False.
+        :param rehash: If True, every indexed file is checksummed again and
+               compared to the index. Otherwise, only files whose size, inode
+               or modification time changed are reported. Defaults to False.
+        :param progress: An optional function that is called with the path of
+               each file once it has been checksummed. Defaults to None.
+        :param workers: The number of files to checksum at the same time.
+               Defaults to 4.
+
+        :return: A dictionary with three lists of file names: "missing" (in the
+                 index but not on disk), "unindexed" (on disk but not in the
+                 index), and "changed" (on disk, but different from what the
+                 index recorded).
+        """
+
+        stored = self._stored_files()
+        indexed = self._indexed_files()
+
+        output = {"missing": sorted(set(indexed) - set(stored)),
+                  "unindexed": sorted(set(stored) - set(indexed)),
+                  "changed": list()}
+
+        unchanged = list()
+        for file_n in sorted(set(stored) & set(indexed)):
+            stat = stored[file_n]
+            size, ino, mtime, digest = indexed[file_n]
+            if (size, ino, mtime) != (stat.st_size, stat.st_ino,
+                                      dircache.mtime_ns(stat)):
+                output["changed"].append(file_n)
+            else:
+                unchanged.append(file_n)
+
+        if rehash:
+            for file_p, digest in self._checksum(unchanged, workers, progress):
+                file_n = os.path.split(file_p)[1]
+                if digest != bytes(indexed[file_n][3]):
+                    output["changed"].append(file_n)
+            output["changed"].sort()
+
+        if repair:
+            for file_n in output["missing"]:
+                self.remove(file_n)
+            to_add = output["unindexed"] + output["changed"]
+            for file_p, digest in self._checksum(to_add, workers, progress):
+                self.add(file_p, digest)
+
+        return output
+
+    # --------------------------------------------------------------------------
+    def _checksum(self,
+                  files_n,
+                  workers,
+                  progress):
+        """
+        Checksums files in the data directory in parallel.
+
+        :param files_n: A list of file names in the data directory.
+        :param workers: The number of files to checksum at the same time.
+        :param progress: An optional function that is called with the path of
+               each file once it has been checksummed.
+
+        :return: A generator that yields (path, checksum) tuples.
+        """
+
+        files_p = [os.path.join(self.data_d, file_n) for file_n in files_n]
+
+        for file_p, digest in filesystem.hash_files(files_p, workers,
+                                                    self.algorithm):
+            if progress is not None:
+                progress(file_p)
+            yield file_p, digest
+
+
+# ------------------------------------------------------------------------------
+def main(argv=None):
+    """
+    A command line interface to rebuild or verify the index of a data
+    directory:
+
+        python -m bvzlib.dedupindex rebuild /path/to/data
+        python -m bvzlib.dedupindex verify [--repair] [--rehash] /path/to/data
+
+    :param argv: The list of command line arguments. If None, sys.argv is used.
+           Defaults to None.
+
+    :return: The exit code: 0 on success, 1 if verify found problems that were
+             not repaired.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Rebuild or verify a de-duplicated data store's index.")
+    parser.add_argument("command", choices=["rebuild", "verify"])
+    parser.add_argument("data_d", help="The data directory.")
+    parser.add_argument("--index", default=None,
+                        help="The index file (defaults to one stored in the "
+                             "data directory).")
+    parser.add_argument("--repair", action="store_true",
+                        help="Update the index to match the data directory.")
+    parser.add_argument("--rehash", action="store_true",
+                        help="Checksum every file instead of trusting the "
+                             "size and modification time.")
+    parser.add_argument("--algorithm", default=None,
+                        help="The checksum algorithm of a new index (md5, "
+                             "sha1, blake2b, ...). Defaults to md5.")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="The number of files to checksum at once.")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Print each file as it is checksummed.")
+    args = parser.parse_args(argv)
+
+    progress = None
+    if args.verbose:
+        progress = lambda file_p: sys.stdout.write(file_p + "\n")
+
+    with DedupIndex(args.data_d, args.index,
+                    algorithm=args.algorithm) as index:
+
+        if args.command == "rebuild":
+            count = index.rebuild(progress, args.workers)
+            print("indexed " + str(count) + " files")
+            return 0
+
+        problems = index.verify(args.repair, args.rehash, progress,
+                                args.workers)
+        for key in ["missing", "unindexed", "changed"]:
+            for file_n in problems[key]:
+                print(key + ": " + file_n)
+
+        if any(problems.values()) and not args.repair:
+            return 1
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
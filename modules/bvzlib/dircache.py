@@ -0,0 +1,366 @@
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import os
+import threading
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+from bvzlib import cache
+
+
+# A directory whose modification time is this close (in seconds) to the
+# current time may still be changing within the same timestamp tick, so its
+# listing is never cached.
+RACY_SECONDS = 2.0
+
+# A single directory entry. size is None if the sizes were not requested, or
+# if the entry could not be stat'ed (a broken symlink for example).
+Entry = collections.namedtuple("Entry", ["name", "is_dir", "is_file", "size"])
+
+# The cache in use, or None if caching is disabled (the default).
+_ACTIVE_CACHE = None
+
+
+# ==============================================================================
+class DirCache(object):
+    """
+    A cache of directory listings (and optionally the sizes of the entries).
+    Each listing is stored with the inode and modification time of the
+    directory, and is only used again if both are unchanged. Checking this
+    costs a single stat call on the directory instead of listing it (and
+    stat'ing every entry) again.
+
+    Note: A directory's modification time only changes when entries are added,
+    removed or renamed. The cached sizes will not notice a file that is
+    rewritten in place.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, maxsize=1024):
+        """
+        Setup.
+
+        :param maxsize: The maximum number of directories to hold. Defaults to
+               1024.
+
+        :return: Nothing.
+        """
+
+        self._listings = cache.LRUCache(maxsize, count=False)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    # --------------------------------------------------------------------------
+    def _count(self, counter):
+        """
+        Increments one of the counters.
+
+        :param counter: The name of the counter to increment.
+
+        :return: Nothing.
+        """
+
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    # --------------------------------------------------------------------------
+    def _lookup(self, path_d):
+        """
+        Finds the cached listing for a directory if it is still valid.
+
+        :param path_d: The directory.
+
+        :return: A tuple of the absolute path to the directory, its stat result,
+                 and the cached listing (or None if there is no valid listing).
+        """
+
+        path_d = os.path.abspath(path_d)
+        stat = os.stat(path_d)
+
+        listing = self._listings.get(path_d)
+
+        if listing is not None:
+            if (listing["ino"] == stat.st_ino and
+                    listing["mtime"] == mtime_ns(stat)):
+                return path_d, stat, listing
+            self._count("invalidations")
+            self._listings.discard(path_d)
+
+        return path_d, stat, None
+
+    # --------------------------------------------------------------------------
+    def _store(self, path_d, stat, names=None, entries=None):
+        """
+        Stores a listing, unless the directory was modified too recently for
+        its modification time to be trusted.
+
+        :param path_d: The absolute path to the directory.
+        :param stat: The stat result of the directory (taken before listing).
+        :param names: The list of names in the directory.
+        :param entries: The list of Entry tuples in the directory, or None.
+
+        :return: Nothing.
+        """
+
+        if time.time() - stat.st_mtime < RACY_SECONDS:
+            return
+
+        self._listings.set(path_d, {"ino": stat.st_ino,
+                                    "mtime": mtime_ns(stat),
+                                    "names": names,
+                                    "entries": entries})
+
+    # --------------------------------------------------------------------------
+    def listdir(self, path_d):
+        """
+        A cached version of os.listdir.
+
+        :param path_d: The directory to list.
+
+        :return: A list of the names in the directory (in arbitrary order).
+        """
+
+        path_d, stat, listing = self._lookup(path_d)
+
+        if listing is not None:
+            self._count("hits")
+            return list(listing["names"])
+
+        self._count("misses")
+        names = os.listdir(path_d)
+        self._store(path_d, stat, names=tuple(names))
+
+        return names
+
+    # --------------------------------------------------------------------------
+    def entries(self, path_d, sizes=False):
+        """
+        A cached listing of a directory that also holds the type (and
+        optionally the size) of each entry.
+
+        :param path_d: The directory to list.
+        :param sizes: If True, the size of each entry is included (following
+               symlinks, just like os.path.getsize). This costs one stat call
+               per entry the first time. Defaults to False.
+
+        :return: A list of Entry tuples.
+        """
+
+        path_d, stat, listing = self._lookup(path_d)
+
+        if listing is not None and listing["entries"] is not None:
+            entries = listing["entries"]
+            if not sizes or entries["sized"]:
+                self._count("hits")
+                return list(entries["items"])
+
+        self._count("misses")
+        items = scan_entries(path_d, sizes)
+        names = tuple(entry.name for entry in items)
+        self._store(path_d, stat, names=names,
+                    entries={"items": tuple(items), "sized": sizes})
+
+        return items
+
+    # --------------------------------------------------------------------------
+    def invalidate(self, path_d=None):
+        """
+        Forgets the listing for a directory (or all directories).
+
+        :param path_d: The directory to forget. If None, the whole cache is
+               cleared. Defaults to None.
+
+        :return: Nothing.
+        """
+
+        if path_d is None:
+            self._listings.clear()
+        else:
+            self._listings.discard(os.path.abspath(path_d))
+
+    # --------------------------------------------------------------------------
+    def stats(self):
+        """
+        :return: A dictionary with the number of hits, misses, invalidations
+                 (listings that were found to be out of date), and the current
+                 and maximum number of directories held.
+        """
+
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "invalidations": self.invalidations,
+                    "size": len(self._listings),
+                    "maxsize": self._listings.maxsize}
+
+
+# ------------------------------------------------------------------------------
+def mtime_ns(stat):
+    """
+    :param stat: A stat result.
+
+    :return: The modification time in integer nanoseconds (falling back to the
+             float modification time on Python versions without st_mtime_ns).
+    """
+
+    try:
+        return stat.st_mtime_ns
+    except AttributeError:
+        return int(stat.st_mtime * 10**9)
+
+
+# ------------------------------------------------------------------------------
+def scan_entries(path_d, sizes=False):
+    """
+    Lists a directory with scandir, without any caching.
+
+    :param path_d: The directory to list.
+    :param sizes: If True, the size of each entry is included. Defaults to
+           False.
+
+    :return: A list of Entry tuples.
+    """
+
+    output = list()
+
+    for entry in scandir(path_d):
+        size = None
+        if sizes:
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                size = None
+        output.append(Entry(entry.name, entry.is_dir(), entry.is_file(), size))
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def enable(maxsize=1024):
+    """
+    Turns on listing caching for every function in bvzlib that uses this
+    module. If caching is already on, the existing cache is kept (and resized).
+
+    :param maxsize: The maximum number of directories to hold. Defaults to
+           1024.
+
+    :return: The active DirCache.
+    """
+
+    global _ACTIVE_CACHE
+
+    if _ACTIVE_CACHE is None:
+        _ACTIVE_CACHE = DirCache(maxsize)
+    else:
+        _ACTIVE_CACHE._listings.resize(maxsize)
+
+    return _ACTIVE_CACHE
+
+
+# ------------------------------------------------------------------------------
+def disable():
+    """
+    Turns off listing caching and discards the cache.
+
+    :return: Nothing.
+    """
+
+    global _ACTIVE_CACHE
+    _ACTIVE_CACHE = None
+
+
+# ------------------------------------------------------------------------------
+def active_cache():
+    """
+    :return: The active DirCache, or None if caching is disabled.
+    """
+
+    return _ACTIVE_CACHE
+
+
+# ------------------------------------------------------------------------------
+def stats():
+    """
+    :return: The statistics of the active cache (see DirCache.stats), or None
+             if caching is disabled.
+    """
+
+    if _ACTIVE_CACHE is None:
+        return None
+    return _ACTIVE_CACHE.stats()
+
+
+# ------------------------------------------------------------------------------
+def invalidate(path_d=None):
+    """
+    Forgets the cached listing for a directory (or all directories) if
+    caching is enabled.
+
+    :param path_d: The directory to forget. If None, the whole cache is
+           cleared. Defaults to None.
+
+    :return: Nothing.
+    """
+
+    if _ACTIVE_CACHE is not None:
+        _ACTIVE_CACHE.invalidate(path_d)
+
+
+# ------------------------------------------------------------------------------
+def listdir(path_d):
+    """
+    Lists a directory, using the cache if caching is enabled.
+
+    :param path_d: The directory to list.
+
+    :return: A list of the names in the directory.
+    """
+
+    if _ACTIVE_CACHE is None:
+        return os.listdir(path_d)
+    return _ACTIVE_CACHE.listdir(path_d)
+
+
+# ------------------------------------------------------------------------------
+def entries(path_d, sizes=False):
+    """
+    Lists a directory along with the type (and optionally size) of each
+    entry, using the cache if caching is enabled.
+
+    :param path_d: The directory to list.
+    :param sizes: If True, the size of each entry is included. Defaults to
+           False.
+
+    :return: A list of Entry tuples.
+    """
+
+    if _ACTIVE_CACHE is None:
+        return scan_entries(path_d, sizes)
+    return _ACTIVE_CACHE.entries(path_d, sizes)
@@ -20,10 +20,71 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import array
+import bisect
+import collections
+import concurrent.futures
+import errno
+import fnmatch
 import hashlib
+import heapq
+import mmap
 import os
 import re
 import shutil
+import sys
+import threading
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+from bvzlib import cache
+from bvzlib import dircache
+from bvzlib import hashcache
+
+
+# How much of the start, middle and end of a file is read when comparing
+# samples of files (see find_duplicate_file).
+SAMPLE_SIZE = 2**16
+
+# The errors that mean a kernel copy is not possible between two files (rather
+# than that something went wrong).
+_KERNEL_COPY_UNSUPPORTED = set([errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF])
+
+# The ioctl request number that makes a file a reflink of another (Linux).
+FICLONE = 0x40049409
+
+# The errors that mean a reflink is not possible between two files.
+_CLONE_UNSUPPORTED = set([errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                          errno.ENOTSUP, errno.ENOTTY, errno.EBADF,
+                          errno.EPERM, errno.EISDIR])
+
+# Matches the names of the temp files that copy_and_add_ver_num copies to
+# before giving them their versioned names, and of the files it reserves names
+# with where hard links are not supported.
+PUBLISH_TEMP_PATTERN = re.compile(r"\..*\.(?:[0-9a-f]{32}\.tmp|reserved)\Z",
+                                  re.DOTALL)
+
+# The name of the dedup index that is stored inside a de-duplicated data
+# directory (see dedupindex). Its SQLite journal files start with the same name.
+DEDUP_INDEX_N = ".bvzlib_dedup.sqlite"
+
+# The ways that a file in a de-duplicated data directory can be linked into its
+# destination (see link_data_file).
+LINK_MODES = ["symlink", "hardlink", "reflink"]
+
+# Counters for each stage of find_duplicate_file (see dedup_stats).
+_DEDUP_COUNTERS = collections.Counter()
+_DEDUP_LOCK = threading.Lock()
 
 
 # --------------------------------------------------------------------------
@@ -51,17 +112,16 @@ def invert_dir_list(parent_d,
     assert type(subdirs_n) is list
     assert pattern is None or type(pattern) is str
 
-    items_n = os.listdir(parent_d)
     output = list()
 
-    for item_n in items_n:
-        if os.path.isdir(os.path.join(parent_d, item_n)):
-            if item_n not in subdirs_n:
+    for entry in dircache.entries(parent_d):
+        if entry.is_dir:
+            if entry.name not in subdirs_n:
                 result = True
                 if pattern:
-                    result = re.match(pattern, item_n)
+                    result = re.match(pattern, entry.name)
                 if result:
-                    output.append(item_n)
+                    output.append(entry.name)
 
     return output
 
@@ -110,7 +170,9 @@ def symlinks_to_real_paths(symlinks_p):
 # ------------------------------------------------------------------------------
 def recursively_list_files_in_dirs(source_dirs_d):
     """
-    Recursively list all files in a directory or directories
+    Recursively list all files in a directory or directories. For very large
+    trees, use walk_files instead, which does not build the whole list in
+    memory.
 
     :param source_dirs_d: a list of directories we want to recursively list.
 
@@ -122,13 +184,359 @@ def recursively_list_files_in_dirs(source_dirs_d):
     for source_dir_d in source_dirs_d:
         assert os.path.exists(source_dir_d)
 
-    output = list()
+    return [entry.path for entry in walk_files(source_dirs_d)]
+
+
+# ------------------------------------------------------------------------------
+def walk_files(source_dirs_d,
+               pattern=None,
+               glob=None,
+               prune=None,
+               follow_symlinks=False,
+               max_depth=None,
+               workers=None,
+               onerror=None):
+    """
+    Recursively walks one or more directories and yields every file found, as
+    it is found. Each file is yielded as the DirEntry object returned by
+    scandir, so its path, name and type are available without any further
+    system calls, and entry.stat() is only called (and then cached) when it is
+    needed. Anything that is not a directory is treated as a file (just like
+    os.walk), including symlinks to files and broken symlinks.
+
+    :param source_dirs_d: A directory, or a list of directories, to walk.
+    :param pattern: An optional regex pattern. Only files whose name matches
+           this pattern (using re.search) are yielded. Defaults to None.
+    :param glob: An optional shell style wildcard pattern (i.e. "*.exr"). Only
+           files whose name matches it are yielded. Defaults to None.
+    :param prune: An optional function that is called with the DirEntry of
+           each sub-directory. If it returns True, that directory is not
+           walked. Defaults to None.
+    :param follow_symlinks: If True, symlinks to directories are walked as
+           well. Each directory is only walked once, so symlink loops are
+           safe. Defaults to False.
+    :param max_depth: How many levels below the source dirs to descend. 0 will
+           only list the source dirs themselves. If None, there is no limit.
+           Defaults to None.
+    :param workers: If given, directories are listed by a pool of this many
+           threads (useful on network filesystems). Files are then yielded in
+           no particular order. If None, the walk is done in this thread, depth
+           first. Defaults to None.
+    :param onerror: An optional function that is called with the OSError if a
+           directory cannot be listed, or fails part way through being listed
+           (just like os.walk). If None, then directories that cannot be listed
+           are skipped silently. Defaults to None.
+
+    :return: A generator that yields a DirEntry for each file.
+    """
+
+    if type(source_dirs_d) is not list:
+        source_dirs_d = [source_dirs_d]
+    assert pattern is None or type(pattern) is str
+    assert glob is None or type(glob) is str
+    assert max_depth is None or type(max_depth) is int
+    assert workers is None or (type(workers) is int and workers > 0)
+
+    name_filter = _name_filter(pattern, glob)
+    walker = _DirWalker(name_filter, prune, follow_symlinks, onerror)
+
+    if workers is None:
+        stack = [(source_dir_d, 0) for source_dir_d in reversed(source_dirs_d)]
+        while stack:
+            dir_d, depth = stack.pop()
+            subdirs_d = list()
+            entries = walker.scan(dir_d, subdirs_d)
+            try:
+                for entry in entries:
+                    yield entry
+            finally:
+                entries.close()
+            if max_depth is None or depth < max_depth:
+                for subdir_d in reversed(subdirs_d):
+                    stack.append((subdir_d, depth + 1))
+        return
+
+    for dir_d, files in _walk_listings(walker, source_dirs_d, max_depth,
+                                       workers):
+        for entry in files:
+            yield entry
+
+
+# ------------------------------------------------------------------------------
+def walk_dirs(source_dirs_d,
+              pattern=None,
+              glob=None,
+              prune=None,
+              follow_symlinks=False,
+              max_depth=None,
+              workers=None,
+              onerror=None):
+    """
+    Just like walk_files, but yields each directory once it has been listed in
+    full, along with the files in it. Directories with no files are yielded as
+    well. Directories that cannot be listed (and directories reached a second
+    time through a symlink) are not.
+
+    :param source_dirs_d: See walk_files.
+    :param pattern: See walk_files.
+    :param glob: See walk_files.
+    :param prune: See walk_files.
+    :param follow_symlinks: See walk_files.
+    :param max_depth: See walk_files.
+    :param workers: See walk_files. With workers, the directories are yielded
+           in no particular order. Otherwise the walk is depth first.
+    :param onerror: See walk_files.
+
+    :return: A generator that yields a tuple for each directory: The path to
+             the directory, and a list of the DirEntry objects of its files.
+    """
+
+    if type(source_dirs_d) is not list:
+        source_dirs_d = [source_dirs_d]
+    assert pattern is None or type(pattern) is str
+    assert glob is None or type(glob) is str
+    assert max_depth is None or type(max_depth) is int
+    assert workers is None or (type(workers) is int and workers > 0)
+
+    name_filter = _name_filter(pattern, glob)
+    walker = _DirWalker(name_filter, prune, follow_symlinks, onerror)
+
+    return _walk_listings(walker, source_dirs_d, max_depth, workers)
+
+
+# ------------------------------------------------------------------------------
+def _walk_listings(walker,
+                   source_dirs_d,
+                   max_depth,
+                   workers):
+    """
+    Lists every directory of a walk in full. Shared by walk_files (when it has
+    workers) and walk_dirs.
+
+    :param walker: The _DirWalker of the walk.
+    :param source_dirs_d: A list of the directories to walk.
+    :param max_depth: See walk_files.
+    :param workers: See walk_files.
+
+    :return: A generator that yields a tuple of the path to each directory that
+             could be listed, and a list of the DirEntry objects of its files.
+    """
+
+    if workers is None:
+        stack = [(source_dir_d, 0) for source_dir_d in reversed(source_dirs_d)]
+        while stack:
+            dir_d, depth = stack.pop()
+            files, subdirs_d = walker.list(dir_d)
+            if files is None:
+                continue
+            yield dir_d, files
+            if max_depth is None or depth < max_depth:
+                for subdir_d in reversed(subdirs_d):
+                    stack.append((subdir_d, depth + 1))
+        return
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    pending = dict()
+
+    try:
+
+        for source_dir_d in source_dirs_d:
+            future = executor.submit(walker.list, source_dir_d)
+            pending[future] = (source_dir_d, 0)
+
+        while pending:
+
+            done, not_done = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                dir_d, depth = pending.pop(future)
+                files, subdirs_d = future.result()
+                if files is None:
+                    continue
+                if max_depth is None or depth < max_depth:
+                    for subdir_d in subdirs_d:
+                        future = executor.submit(walker.list, subdir_d)
+                        pending[future] = (subdir_d, depth + 1)
+                yield dir_d, files
+
+    finally:
+
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+# ------------------------------------------------------------------------------
+def _name_filter(pattern,
+                 glob):
+    """
+    Builds a single function that tests a file name against an optional regex
+    pattern and an optional shell style wildcard pattern.
+
+    :param pattern: A regex pattern or None.
+    :param glob: A shell style wildcard pattern or None.
+
+    :return: A function that takes a file name and returns True if it passes
+             both patterns, or None if there are no patterns.
+    """
+
+    tests = list()
+    if pattern is not None:
+        tests.append(re.compile(pattern).search)
+    if glob is not None:
+        tests.append(re.compile(fnmatch.translate(glob)).match)
+
+    if not tests:
+        return None
+
+    return lambda name: all(test(name) for test in tests)
 
-    for source_dir_d in source_dirs_d:
-        for dir_d, sub_dirs_n, files_n in os.walk(source_dir_d):
-            for file_n in files_n:
-                output.append(os.path.join(dir_d, dir_d, file_n))
-    return output
+
+# ==============================================================================
+class _DirWalker(object):
+    """
+    Lists the directories of a single walk_files call, and remembers which
+    directories were already walked when symlinks are followed.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self,
+                 name_filter,
+                 prune,
+                 follow_symlinks,
+                 onerror):
+        """
+        Setup. See walk_files for a description of the arguments.
+
+        :return: Nothing.
+        """
+
+        self.name_filter = name_filter
+        self.prune = prune
+        self.follow_symlinks = follow_symlinks
+        self.onerror = onerror
+        self.visited = set()
+        self.lock = threading.Lock()
+
+    # --------------------------------------------------------------------------
+    def _first_visit(self,
+                     dir_d):
+        """
+        :param dir_d: A directory about to be walked.
+
+        :return: False if symlinks are being followed and this directory (by
+                 device and inode) was already walked. True otherwise.
+        """
+
+        if not self.follow_symlinks:
+            return True
+
+        stat = os.stat(dir_d)
+        key = (stat.st_dev, stat.st_ino)
+        with self.lock:
+            if key in self.visited:
+                return False
+            self.visited.add(key)
+        return True
+
+    # --------------------------------------------------------------------------
+    def open(self,
+             dir_d):
+        """
+        Opens a single directory for listing.
+
+        :param dir_d: The directory to open.
+
+        :return: The scandir iterator, or None if the directory could not be
+                 opened (onerror is called) or was already walked.
+        """
+
+        try:
+            if not self._first_visit(dir_d):
+                return None
+            return scandir(dir_d)
+        except OSError as err:
+            if self.onerror is not None:
+                self.onerror(err)
+            return None
+
+    # --------------------------------------------------------------------------
+    def scan(self,
+             dir_d,
+             subdirs_d,
+             entries=None):
+        """
+        Lists a single directory.
+
+        :param dir_d: The directory to list.
+        :param subdirs_d: A list that the paths of the sub-directories to walk
+               are appended to.
+        :param entries: The scandir iterator of the directory, if it was
+               already opened. Defaults to None.
+
+        :return: A generator that yields a DirEntry for each file that passes
+                 the filters. The directory is closed when the generator is
+                 finished or closed.
+        """
+
+        if entries is None:
+            entries = self.open(dir_d)
+            if entries is None:
+                return
+
+        try:
+
+            while True:
+
+                try:
+                    entry = next(entries)
+                except StopIteration:
+                    return
+                except OSError as err:
+                    if self.onerror is not None:
+                        self.onerror(err)
+                    return
+
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    if not self.follow_symlinks and entry.is_symlink():
+                        continue
+                    if self.prune is not None and self.prune(entry):
+                        continue
+                    subdirs_d.append(entry.path)
+                elif self.name_filter is None or self.name_filter(entry.name):
+                    yield entry
+
+        finally:
+
+            # Python 3.5 and the scandir backport have no close().
+            close = getattr(entries, "close", None)
+            if close is not None:
+                close()
+
+    # --------------------------------------------------------------------------
+    def list(self,
+             dir_d):
+        """
+        Lists a single directory in full. Runs in a worker thread.
+
+        :param dir_d: The directory to list.
+
+        :return: A tuple of a list of DirEntry objects for the files that pass
+                 the filters (None if the directory could not be opened or was
+                 already walked), and a list of the sub-directories to walk.
+        """
+
+        subdirs_d = list()
+        entries = self.open(dir_d)
+        if entries is None:
+            return None, subdirs_d
+        files = list(self.scan(dir_d, subdirs_d, entries))
+        return files, subdirs_d
 
 
 # ------------------------------------------------------------------------------
@@ -136,7 +544,9 @@ def md5_for_file(file_p,
                  block_size=2**20):
     """
     Create an md5 checksum for a file without reading the whole file in in a
-    single chunk.
+    single chunk. If hashcache is enabled, and the file has not changed since
+    it was last checksummed, the cached checksum is returned without reading
+    the file at all.
 
     :param file_p: The path to the file we are checksumming.
     :param block_size: How much to read in in a single chunk. Defaults to 1MB
@@ -147,31 +557,215 @@ def md5_for_file(file_p,
     assert os.path.exists(file_p)
     assert type(block_size) is int
 
-    md5 = hashlib.md5()
+    return hash_file(file_p, "md5", block_size)
+
+
+# ------------------------------------------------------------------------------
+def hash_file(file_p,
+              algorithm="md5",
+              block_size=2**20):
+    """
+    Create a checksum for a file without reading the whole file in in a single
+    chunk, using any algorithm supported by hashlib. Uses hashcache if it is
+    enabled.
+
+    :param file_p: The path to the file we are checksumming.
+    :param algorithm: The name of the hashlib algorithm to use (i.e. "md5",
+           "sha1" or "blake2b"). Defaults to "md5".
+    :param block_size: How much to read in in a single chunk. Defaults to 1MB
+
+    :return: The checksum.
+    """
+
+    assert os.path.exists(file_p)
+    assert type(block_size) is int
+
+    return hashcache.digest(file_p, algorithm, _hash_file, algorithm,
+                            block_size)
+
+
+# ------------------------------------------------------------------------------
+def _hash_file(file_p,
+               algorithm,
+               block_size):
+    """
+    Reads a file and creates its checksum (without using the hash cache). This
+    is a module level function so that it can be sent to a process pool.
+
+    :param file_p: The path to the file we are checksumming.
+    :param algorithm: The name of the hashlib algorithm to use.
+    :param block_size: How much to read in in a single chunk.
+
+    :return: The checksum.
+    """
+
+    checksum = hashlib.new(algorithm)
     with open(file_p, "rb") as f:
         while True:
             data = f.read(block_size)
             if not data:
                 break
-            md5.update(data)
+            checksum.update(data)
 
-    return md5.digest()
+    return checksum.digest()
+
+
+# ------------------------------------------------------------------------------
+def hash_files(files_p,
+               workers=4,
+               algorithm="md5",
+               block_size=2**20,
+               use_processes=False,
+               max_pending=None,
+               onerror=None):
+    """
+    Checksums many files at once in a pool of workers. hashlib releases the GIL
+    while it hashes large buffers, so a pool of threads (the default) can keep
+    several disks or network connections busy at the same time. A process pool
+    may be used instead for small files, where the time spent holding the GIL
+    matters more.
+
+    Results are yielded as soon as each file is done, so they will not be in
+    the same order as files_p. Only up to max_pending files are handed to the
+    pool at a time, and each worker only holds a single block of its file in
+    memory, so files_p may be a generator over any number of files.
+
+    If hashcache is enabled, cached checksums are yielded straight away without
+    being sent to the pool, and new checksums are added to the cache.
+
+    :param files_p: An iterable of paths to checksum.
+    :param workers: The number of files to checksum at the same time. Defaults
+           to 4.
+    :param algorithm: The name of the hashlib algorithm to use. Defaults to
+           "md5".
+    :param block_size: How much to read in in a single chunk. Defaults to 1MB
+    :param use_processes: If True, a process pool is used instead of a thread
+           pool. Defaults to False.
+    :param max_pending: The maximum number of files handed to the pool at a
+           time. If None, twice the number of workers is used. Defaults to
+           None.
+    :param onerror: An optional function that is called with the error if a
+           file cannot be read. The file is then skipped. If None, the error is
+           raised. Defaults to None.
+
+    :return: A generator that yields a tuple of (path, checksum) for each file.
+    """
+
+    assert type(workers) is int and workers > 0
+    assert type(block_size) is int
+    assert max_pending is None or (type(max_pending) is int and max_pending > 0)
+
+    if max_pending is None:
+        max_pending = workers * 2
+
+    checksum_cache = hashcache.active_cache()
+
+    if use_processes:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    # Future -> (path, stat result before reading or None).
+    pending = dict()
+    files_p = iter(files_p)
+    exhausted = False
+
+    try:
+
+        while True:
+
+            while not exhausted and len(pending) < max_pending:
+
+                try:
+                    file_p = next(files_p)
+                except StopIteration:
+                    exhausted = True
+                    break
+
+                stat = None
+                if checksum_cache is not None:
+                    try:
+                        stat = os.stat(file_p)
+                    except OSError as err:
+                        if onerror is None:
+                            raise
+                        onerror(err)
+                        continue
+                    digest = checksum_cache.get(stat, algorithm)
+                    if digest is not None:
+                        yield file_p, digest
+                        continue
+
+                future = executor.submit(_hash_file, file_p, algorithm,
+                                         block_size)
+                pending[future] = (file_p, stat)
+
+            if not pending:
+                break
+
+            done, not_done = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+
+                file_p, stat = pending.pop(future)
+
+                try:
+                    digest = future.result()
+                except (IOError, OSError) as err:
+                    if onerror is None:
+                        raise
+                    onerror(err)
+                    continue
+
+                if stat is not None:
+                    checksum_cache.set_if_unchanged(file_p, stat, algorithm,
+                                                    digest)
+
+                yield file_p, digest
+
+    finally:
+
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
 
 
 # ------------------------------------------------------------------------------
 def files_are_identical(file_a_p,
                         file_b_p,
-                        block_size=2**20):
+                        block_size=2**20,
+                        method="stream",
+                        digest_a=None,
+                        algorithm="md5"):
     """
     Compares two files to see if they are identical. First compares sizes. If
-    the sizes match, then it does an md5 checksum on the files to see if they
-    match. Ignores all metadata when comparing (name, creation or modification
-    dates, etc.) Returns True if they match, False otherwise.
+    the sizes match, then it compares the contents of the files. Ignores all
+    metadata when comparing (name, creation or modification dates, etc.)
+    Returns True if they match, False otherwise.
+
+    The contents may be compared in one of three ways:
+
+    "stream": Both files are read at the same time, one block at a time, and
+    the comparison stops at the first block that differs. The cost depends on
+    where the first difference is rather than on the size of the files.
+    "mmap": The same as "stream", but the files are memory mapped instead of
+    read. This can be faster for files that are already in the page cache.
+    "checksum": Both files are checksummed in full (using hashcache if it is
+    enabled) and the checksums are compared.
+
+    If the checksum of the first file is already known, pass it as digest_a.
+    Then only the second file is read (and checksummed), whatever the method.
 
     :param file_a_p: The path to the first file we are comparing.
     :param file_b_p: The path to the second file we are comparing
-    :param block_size: How much to read in in a single chunk when doing the md5
-           checksum. Defaults to 1MB
+    :param block_size: How much to read in in a single chunk. Defaults to 1MB
+    :param method: How to compare the contents: "stream", "mmap" or
+           "checksum". Defaults to "stream".
+    :param digest_a: The known checksum of the first file, or None. Defaults to
+           None.
+    :param algorithm: The hashlib algorithm used for digest_a, or for the
+           "checksum" method. Defaults to "md5".
 
     :return: True if the files match, False otherwise.
     """
@@ -180,30 +774,294 @@ def files_are_identical(file_a_p,
     assert os.path.isfile(file_a_p)
     assert os.path.exists(file_b_p)
     assert os.path.isfile(file_b_p)
+    assert method in ["stream", "mmap", "checksum"]
+
+    size = os.path.getsize(file_a_p)
+    if size != os.path.getsize(file_b_p):
+        return False
+
+    if digest_a is not None:
+        return hash_file(file_b_p, algorithm, block_size) == digest_a
+
+    if method == "checksum":
+        digest_a = hash_file(file_a_p, algorithm, block_size)
+        return hash_file(file_b_p, algorithm, block_size) == digest_a
+
+    with open(file_a_p, "rb") as file_a, open(file_b_p, "rb") as file_b:
+
+        if method == "mmap" and size > 0:
+            return _mapped_files_are_identical(file_a, file_b, size,
+                                               block_size)
+
+        while True:
+            data_a = file_a.read(block_size)
+            if data_a != file_b.read(block_size):
+                return False
+            if not data_a:
+                return True
+
+
+# ------------------------------------------------------------------------------
+def _mapped_files_are_identical(file_a,
+                                file_b,
+                                size,
+                                block_size):
+    """
+    Memory maps two open files of the same (non-zero) size and compares them
+    one block at a time, stopping at the first block that differs.
+
+    :param file_a: The first open file.
+    :param file_b: The second open file.
+    :param size: The size of both files.
+    :param block_size: How much to compare in a single chunk.
+
+    :return: True if the files match, False otherwise.
+    """
+
+    map_a = mmap.mmap(file_a.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        map_b = mmap.mmap(file_b.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in range(0, size, block_size):
+                end = offset + block_size
+                if map_a[offset:end] != map_b[offset:end]:
+                    return False
+            return True
+        finally:
+            map_b.close()
+    finally:
+        map_a.close()
+
+
+# ------------------------------------------------------------------------------
+def sample_hash_file(file_p,
+                     algorithm="md5",
+                     sample_size=SAMPLE_SIZE):
+    """
+    Create a checksum of a sample of a file: sample_size bytes from the start,
+    the middle and the end of the file (along with its size). Two files with
+    different samples are definitely different, so this is a cheap way to rule
+    out most non-matching files before checksumming them in full. Files that
+    are no larger than the three samples are checksummed in full, and the
+    result is then the same as hash_file. Uses hashcache if it is enabled.
+
+    :param file_p: The path to the file we are checksumming.
+    :param algorithm: The name of the hashlib algorithm to use. Defaults to
+           "md5".
+    :param sample_size: How many bytes to read from each of the three places in
+           the file. Defaults to SAMPLE_SIZE (64KB).
+
+    :return: The checksum of the sample.
+    """
+
+    assert os.path.exists(file_p)
+    assert type(sample_size) is int and sample_size > 0
+
+    cache_key = "sample:" + algorithm + ":" + str(sample_size)
+
+    return hashcache.digest(file_p, cache_key, _sample_hash_file, algorithm,
+                            sample_size)
+
+
+# ------------------------------------------------------------------------------
+def _sample_hash_file(file_p,
+                      algorithm,
+                      sample_size):
+    """
+    Reads a sample of a file and creates its checksum (without using the hash
+    cache). See sample_hash_file.
+
+    :param file_p: The path to the file we are checksumming.
+    :param algorithm: The name of the hashlib algorithm to use.
+    :param sample_size: How many bytes to read from each place in the file.
+
+    :return: The checksum of the sample.
+    """
+
+    checksum = hashlib.new(algorithm)
+
+    with open(file_p, "rb") as f:
+
+        size = os.fstat(f.fileno()).st_size
+
+        if size <= 3 * sample_size:
+            checksum.update(f.read())
+            return checksum.digest()
+
+        checksum.update(str(size).encode("ascii"))
+        for offset in [0, (size - sample_size) // 2, size - sample_size]:
+            f.seek(offset)
+            checksum.update(f.read(sample_size))
+
+    return checksum.digest()
+
+
+# ------------------------------------------------------------------------------
+def find_duplicate_file(source_p,
+                        candidates_p,
+                        algorithm="md5",
+                        sample_size=SAMPLE_SIZE,
+                        digest=None):
+    """
+    Finds a file with exactly the same contents as the source file in a list
+    of candidates. The comparison is done in stages, so that as little data as
+    possible is read:
+
+    1) Candidates that are not the same size as the source are ruled out
+       without reading anything.
+    2) A checksum of a sample of the start, middle and end of each remaining
+       file is compared (see sample_hash_file).
+    3) Only candidates whose samples match are checksummed in full.
+
+    The number of files ruled out at each stage (and the number of bytes
+    read and skipped) are added to the counters returned by dedup_stats.
+
+    :param source_p: The path to the file to find a duplicate of.
+    :param candidates_p: A list of paths to possible duplicates.
+    :param algorithm: The name of the hashlib algorithm to use. Defaults to
+           "md5".
+    :param sample_size: How many bytes to read from each of the three places in
+           each file in the sample stage. Defaults to SAMPLE_SIZE (64KB).
+    :param digest: The full checksum of the source if it is already known.
+           Defaults to None.
+
+    :return: A tuple containing the path to the first matching candidate (or
+             None if there was no match) and the full checksum of the source if
+             it was known or calculated (or None if it was never needed).
+    """
+
+    assert os.path.exists(source_p)
+    assert os.path.isfile(source_p)
+
+    counters = collections.Counter()
+    counters["searches"] += 1
+
+    size = os.path.getsize(source_p)
+    full_compare = size <= 3 * sample_size
+    sample_bytes = size if full_compare else 3 * sample_size
+
+    same_size_p = list()
+    for candidate_p in candidates_p:
+        try:
+            if os.path.getsize(candidate_p) == size:
+                same_size_p.append(candidate_p)
+                continue
+        except OSError:
+            pass
+        counters["size_rejected"] += 1
+
+    matched_p = None
+    source_digest = digest
 
-    if os.path.getsize(file_a_p) == os.path.getsize(file_b_p):
-        md5_a = md5_for_file(file_a_p, block_size)
-        md5_b = md5_for_file(file_b_p, block_size)
-        return md5_a == md5_b
+    if same_size_p:
 
-    return False
+        source_sample = sample_hash_file(source_p, algorithm, sample_size)
+        counters["bytes_sampled"] += sample_bytes
+
+        # A sample of a small file is the whole file, so it is also the full
+        # checksum.
+        if full_compare and source_digest is None:
+            source_digest = source_sample
+
+        for candidate_p in same_size_p:
+
+            counters["sampled"] += 1
+            counters["bytes_sampled"] += sample_bytes
+            if sample_hash_file(candidate_p, algorithm,
+                                sample_size) != source_sample:
+                counters["sample_rejected"] += 1
+                counters["bytes_skipped"] += size - sample_bytes
+                continue
+
+            if full_compare:
+                matched_p = candidate_p
+                break
+
+            if source_digest is None:
+                source_digest = hash_file(source_p, algorithm)
+                counters["bytes_hashed"] += size
+
+            counters["full_hashed"] += 1
+            counters["bytes_hashed"] += size
+            if hash_file(candidate_p, algorithm) == source_digest:
+                matched_p = candidate_p
+                break
+            counters["full_rejected"] += 1
+
+    if matched_p is not None:
+        counters["matches"] += 1
+
+    with _DEDUP_LOCK:
+        _DEDUP_COUNTERS.update(counters)
+
+    return matched_p, source_digest
+
+
+# ------------------------------------------------------------------------------
+def dedup_stats():
+    """
+    :return: A dictionary of the counters kept by find_duplicate_file since the
+             last call to reset_dedup_stats:
+             searches: The number of searches.
+             matches: The number of searches that found a duplicate.
+             size_rejected: Candidates ruled out by their size.
+             sampled: Candidates whose samples were checksummed.
+             sample_rejected: Candidates ruled out by their samples.
+             full_hashed: Candidates that were checksummed in full.
+             full_rejected: Candidates ruled out by their full checksum.
+             bytes_sampled: Bytes read to checksum samples.
+             bytes_hashed: Bytes read to checksum whole files.
+             bytes_skipped: Bytes that a full checksum would have read, but
+             that were never read because the sample ruled the file out.
+    """
+
+    keys = ["searches", "matches", "size_rejected", "sampled",
+            "sample_rejected", "full_hashed", "full_rejected", "bytes_sampled",
+            "bytes_hashed", "bytes_skipped"]
+
+    with _DEDUP_LOCK:
+        return dict((key, _DEDUP_COUNTERS[key]) for key in keys)
+
+
+# ------------------------------------------------------------------------------
+def reset_dedup_stats():
+    """
+    Resets the counters kept by find_duplicate_file.
+
+    :return: Nothing.
+    """
+
+    with _DEDUP_LOCK:
+        _DEDUP_COUNTERS.clear()
 
 
 # ------------------------------------------------------------------------------
 def verified_copy_file(src,
-                       dst):
+                       dst,
+                       algorithm="md5",
+                       drop_cache=False,
+                       digest=None):
     """
     Given a source file and a destination, copies the file, and then checksum's
     both files to ensure that the copy matches the source. Raises an error if
-    the copied file's md5 checksum does not match the source file's md5
-    checksum.
+    the copied file's checksum does not match the source file's checksum.
+
+    The source is checksummed while it is being copied, so it is only read
+    once (see copy_file_hashed).
 
     :param src: The source file to be copied.
     :param dst: The destination file name where the file will be copied. If the
            destination file already exists, an error will be raised. You must
            supply the destination file name, not just the destination dir.
-
-    :return: Nothing.
+    :param algorithm: The hashlib algorithm to use. Defaults to "md5".
+    :param drop_cache: If True, the copy is flushed to disk and dropped from
+           the page cache before it is checked, so that the check reads what
+           is actually on disk. Defaults to False.
+    :param digest: The checksum of the source, if it is already known. Lets
+           the copy be done by the kernel without reading the source at all.
+           Defaults to None.
+
+    :return: The checksum of the source file.
     """
 
     assert os.path.exists(src)
@@ -211,55 +1069,598 @@ def verified_copy_file(src,
     assert os.path.exists(os.path.split(dst)[0])
     assert os.path.isdir(os.path.split(dst)[0])
 
-    shutil.copy(src, dst)
+    return copy_file_hashed(src, dst, algorithm, verify=True,
+                            drop_cache=drop_cache, digest=digest)
 
-    if not files_are_identical(src, dst):
-        msg = "Verification of copy failed (md5 checksums to not match): "
-        raise IOError(msg + src + " --> " + dst)
+
+# ------------------------------------------------------------------------------
+def copy_file_hashed(src,
+                     dst,
+                     algorithm="md5",
+                     verify=False,
+                     drop_cache=False,
+                     digest=None,
+                     block_size=2**20):
+    """
+    Copies a file and returns its checksum, reading the source only once. The
+    permission bits are copied as well (like shutil.copy).
+
+    If the checksum of the source is not known, each block is checksummed as it
+    is copied. If it is known (passed as digest), the copy is left to the
+    kernel (os.copy_file_range or os.sendfile where available), which avoids
+    copying the data through python and lets some filesystems copy on the
+    server or share the blocks.
+
+    If verify is True, the copy is then read back and its checksum compared to
+    the source's. With drop_cache, the copy is flushed to disk and dropped from
+    the page cache (with posix_fadvise, where available) first, so that the
+    check reads the data back from the disk rather than from memory.
+
+    :param src: The source file to be copied.
+    :param dst: The destination file name. If it already exists, an OSError is
+           raised.
+    :param algorithm: The hashlib algorithm to use. Defaults to "md5".
+    :param verify: If True, the copy is read back and checked. An IOError is
+           raised if it does not match. Defaults to False.
+    :param drop_cache: If True, the copy is dropped from the page cache before
+           it is checked. Only used if verify is True. Defaults to False.
+    :param digest: The checksum of the source, if it is already known. Defaults
+           to None.
+    :param block_size: How much to read in in a single chunk. Defaults to 1MB
+
+    :return: The checksum of the source file.
+    """
+
+    assert os.path.exists(src)
+    assert os.path.isfile(src)
+    assert type(block_size) is int
+
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+
+    with open(src, "rb") as source:
+
+        dst_fd = os.open(dst, flags, 0o666)
+        with os.fdopen(dst_fd, "wb") as dest:
+
+            if digest is None or not _kernel_copy(source, dest):
+                checksum = hashlib.new(algorithm)
+                while True:
+                    data = source.read(block_size)
+                    if not data:
+                        break
+                    checksum.update(data)
+                    dest.write(data)
+                if digest is None:
+                    digest = checksum.digest()
+
+            dest.flush()
+            if verify and drop_cache:
+                os.fsync(dest.fileno())
+                _drop_cache(dest.fileno())
+
+    shutil.copymode(src, dst)
+
+    if verify:
+        if drop_cache:
+            copied_digest = _uncached_hash_file(dst, algorithm, block_size)
+        else:
+            copied_digest = _hash_file(dst, algorithm, block_size)
+        if copied_digest != digest:
+            msg = "Verification of copy failed (checksums do not match): "
+            raise IOError(msg + src + " --> " + dst)
+
+    return digest
+
+
+# ------------------------------------------------------------------------------
+def _kernel_copy(source,
+                 dest):
+    """
+    Copies the whole of one open file into another inside the kernel. A
+    reflink (a copy that shares the data blocks until either file is changed)
+    is tried first, then os.copy_file_range or os.sendfile.
+
+    :param source: The open source file.
+    :param dest: The open destination file (which must be empty).
+
+    :return: True if the file was copied, False if neither call is available
+             (or supported between these two files, or the source reports a
+             size of zero or copies nothing, like the files in /proc do), in
+             which case nothing was written. An IOError is raised if the copy
+             stops part of the way through.
+    """
+
+    if _clone_fd(source.fileno(), dest.fileno()):
+        return True
+
+    copy_file_range = getattr(os, "copy_file_range", None)
+    sendfile = getattr(os, "sendfile", None)
+
+    if copy_file_range is None and sendfile is None:
+        return False
+
+    source_fd = source.fileno()
+    dest_fd = dest.fileno()
+    size = os.fstat(source_fd).st_size
+    offset = 0
+
+    # Files in /proc and /sys report a size of zero but are not empty, so they
+    # are left to the caller to read.
+    if not size:
+        return False
+
+    while offset < size:
+        count = min(size - offset, 2**30)
+        try:
+            if copy_file_range is not None:
+                copied = copy_file_range(source_fd, dest_fd, count, offset)
+            else:
+                copied = sendfile(dest_fd, source_fd, offset, count)
+        except OSError as err:
+            if offset == 0 and err.errno in _KERNEL_COPY_UNSUPPORTED:
+                if copy_file_range is not None and sendfile is not None:
+                    copy_file_range = None
+                    continue
+                return False
+            raise
+        if not copied:
+            # The source is shorter than it claims (or shrank). If nothing was
+            # copied yet, the caller can still read it. Otherwise the copy is
+            # incomplete.
+            if offset == 0:
+                return False
+            msg = "Copy stopped at " + str(offset) + " of " + str(size)
+            raise IOError(msg + " bytes")
+        offset += copied
+
+    return True
+
+
+# ------------------------------------------------------------------------------
+def _copy_file(src,
+               dst,
+               block_size=2**20):
+    """
+    Copies a file and its permission bits (like shutil.copy) without
+    checksumming it, letting the kernel do the copy where possible (see
+    _kernel_copy).
+
+    :param src: The source file to be copied.
+    :param dst: The destination file name. If it already exists, an OSError is
+           raised.
+    :param block_size: How much to read in in a single chunk if the kernel
+           cannot do the copy. Defaults to 1MB
+
+    :return: Nothing.
+    """
+
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+
+    with open(src, "rb") as source:
+        dst_fd = os.open(dst, flags, 0o666)
+        with os.fdopen(dst_fd, "wb") as dest:
+            if not _kernel_copy(source, dest):
+                shutil.copyfileobj(source, dest, block_size)
+
+    shutil.copymode(src, dst)
+
+
+# ------------------------------------------------------------------------------
+def _clone_fd(source_fd,
+              dest_fd):
+    """
+    Makes one open file a reflink of another, using the FICLONE ioctl. Only
+    some filesystems (Btrfs, XFS, OCFS2, bcachefs...) support this, and only
+    between files on the same filesystem.
+
+    :param source_fd: The file descriptor of the source file.
+    :param dest_fd: The file descriptor of the (empty) destination file.
+
+    :return: True if the destination is now a reflink of the source, False if
+             reflinks are not supported here (the destination is untouched).
+    """
+
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+
+    try:
+        fcntl.ioctl(dest_fd, FICLONE, source_fd)
+    except (IOError, OSError) as err:
+        if err.errno in _CLONE_UNSUPPORTED:
+            return False
+        raise
+
+    return True
+
+
+# ------------------------------------------------------------------------------
+def _drop_cache(fd):
+    """
+    Asks the kernel to drop a file's (clean) pages from the page cache. Does
+    nothing where posix_fadvise is not available.
+
+    :param fd: An open file descriptor.
+
+    :return: Nothing.
+    """
+
+    fadvise = getattr(os, "posix_fadvise", None)
+    if fadvise is not None:
+        fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+# ------------------------------------------------------------------------------
+def _uncached_hash_file(file_p,
+                        algorithm,
+                        block_size):
+    """
+    Checksums a file after dropping it from the page cache (and drops each
+    block again after reading it), so that the data is read from disk. Does not
+    use the hash cache.
+
+    :param file_p: The path to the file we are checksumming.
+    :param algorithm: The name of the hashlib algorithm to use.
+    :param block_size: How much to read in in a single chunk.
+
+    :return: The checksum.
+    """
+
+    checksum = hashlib.new(algorithm)
+
+    with open(file_p, "rb") as f:
+        _drop_cache(f.fileno())
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            checksum.update(data)
+        _drop_cache(f.fileno())
+
+    return checksum.digest()
 
 
 # --------------------------------------------------------------------------
-def dir_files_keyed_by_size(path_d):
+def dir_files_keyed_by_size(path_d,
+                            recursive=False,
+                            compact=False):
     """
     Builds a dictionary of file sizes in a directory. The key is the file size,
-    the value is a list of file names.
-
-    :param path_d: The dir that contains the files we are evaluating. Does not
-           traverse into sub-directories.
+    the value is a list of file names. Only regular files (or symlinks to
+    regular files) are included, and bvzlib's own files (see is_internal_file)
+    are skipped.
+
+    :param path_d: The dir that contains the files we are evaluating, or a list
+           of dirs (in which case the files of all of them are combined).
+    :param recursive: If True, files in sub-directories are included as well
+           (see walk_files). If False, does not traverse into sub-directories.
+           Defaults to False.
+    :param compact: If True, a read-only SizeIndex is returned instead of a
+           dict. It answers the same lookups, but holds all of the paths in a
+           few flat arrays, which takes a fraction of the memory when there are
+           millions of files. Defaults to False.
 
     :return: A dict where the key is the file size, the value is a list of paths
-             to the files of this size.
+             to the files of this size (or a SizeIndex if compact is True).
     """
 
-    assert os.path.exists(path_d)
+    if type(path_d) is list:
+        paths_d = path_d
+    else:
+        paths_d = [path_d]
+    for dir_d in paths_d:
+        assert os.path.exists(dir_d)
 
-    output = dict()
+    if compact:
+        return SizeIndex(_iter_file_sizes(paths_d, recursive))
 
-    files_n = os.listdir(path_d)
-    for file_n in files_n:
-        file_p = os.path.join(path_d, file_n)
-        file_size = os.path.getsize(file_p)
-        if file_size not in output.keys():
-            output[file_size] = [file_p]
-        else:
-            existing_files = output[file_size]
-            existing_files.append(file_p)
-            output[file_size] = existing_files
+    output = dict()
+    for file_p, file_size in _iter_file_sizes(paths_d, recursive):
+        output.setdefault(file_size, []).append(file_p)
     return output
 
 
+# ------------------------------------------------------------------------------
+def _iter_file_sizes(paths_d,
+                     recursive):
+    """
+    Lists the regular files in a list of directories, along with their sizes.
+    Sizes are taken from the scandir entries, so each file is only stat'ed
+    once.
+
+    :param paths_d: A list of directories.
+    :param recursive: If True, sub-directories are included as well.
+
+    :return: A generator that yields a tuple of the path and size of each file.
+    """
+
+    if recursive:
+        for entry in walk_files(paths_d):
+            if is_internal_file(entry.name):
+                continue
+            try:
+                if entry.is_file():
+                    yield entry.path, entry.stat().st_size
+            except OSError:
+                continue
+        return
+
+    for dir_d in paths_d:
+        for entry in dircache.entries(dir_d, sizes=True):
+            if is_internal_file(entry.name):
+                continue
+            if entry.is_file and entry.size is not None:
+                yield os.path.join(dir_d, entry.name), entry.size
+
+
+# ------------------------------------------------------------------------------
+def is_internal_file(file_n):
+    """
+    :param file_n: The name of a file in a de-duplicated data directory.
+
+    :return: True if the file is one of bvzlib's own files (the dedup index and
+             its journals, or the temp and reservation files of a publish that
+             is still in progress, see copy_and_add_ver_num) rather than a
+             stored file.
+    """
+
+    return (file_n.startswith(DEDUP_INDEX_N) or
+            PUBLISH_TEMP_PATTERN.match(file_n) is not None)
+
+
+# ==============================================================================
+class SizeIndex(object):
+    """
+    A read-only, memory efficient map of file sizes to lists of paths. It
+    answers the same lookups as the dict returned by dir_files_keyed_by_size
+    (index[size], index.get(size), size in index, keys, items), but rather
+    than one list and one string object per file, it holds a sorted array of
+    sizes, arrays of offsets and a single block of encoded paths. Lookups
+    are a binary search, and the path strings are only built when asked for.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self,
+                 files):
+        """
+        Setup.
+
+        :param files: An iterable of tuples of a path and its size.
+
+        :return: Nothing.
+        """
+
+        sizes = array.array("q")
+        offsets = array.array("q", [0])
+        blob = bytearray()
+
+        for file_p, file_size in files:
+            blob.extend(_fs_encode(file_p))
+            sizes.append(file_size)
+            offsets.append(len(blob))
+
+        # The paths stay where they are in the blob, only the sizes and the
+        # positions of the paths are sorted.
+        self._sizes = array.array("q")
+        self._starts = array.array("q")
+        self._ends = array.array("q")
+        for file_size, i in _sorted_sizes(sizes):
+            self._sizes.append(file_size)
+            self._starts.append(offsets[i])
+            self._ends.append(offsets[i + 1])
+        self._blob = blob
+        self._count = sum(1 for group in self._groups())
+
+    # --------------------------------------------------------------------------
+    def _range(self,
+               size):
+        """
+        :param size: A file size.
+
+        :return: A tuple of the first and last (exclusive) positions of the
+                 files of this size in the sorted arrays.
+        """
+
+        return (bisect.bisect_left(self._sizes, size),
+                bisect.bisect_right(self._sizes, size))
+
+    # --------------------------------------------------------------------------
+    def _paths(self,
+               first,
+               last):
+        """
+        :param first: The first position in the sorted arrays.
+        :param last: The last (exclusive) position in the sorted arrays.
+
+        :return: A list of the paths in this range.
+        """
+
+        return [_fs_decode(bytes(self._blob[self._starts[i]:self._ends[i]]))
+                for i in range(first, last)]
+
+    # --------------------------------------------------------------------------
+    def __getitem__(self,
+                    size):
+        """
+        :param size: A file size.
+
+        :return: A list of the paths to the files of this size. Raises a
+                 KeyError if there are none.
+        """
+
+        first, last = self._range(size)
+        if first == last:
+            raise KeyError(size)
+        return self._paths(first, last)
+
+    # --------------------------------------------------------------------------
+    def get(self,
+            size,
+            default=None):
+        """
+        :param size: A file size.
+        :param default: What to return if there are no files of this size.
+               Defaults to None.
+
+        :return: A list of the paths to the files of this size, or default.
+        """
+
+        try:
+            return self[size]
+        except KeyError:
+            return default
+
+    # --------------------------------------------------------------------------
+    def __contains__(self,
+                     size):
+        """
+        :param size: A file size.
+
+        :return: True if there are any files of this size.
+        """
+
+        first, last = self._range(size)
+        return first != last
+
+    # --------------------------------------------------------------------------
+    def __len__(self):
+        """
+        :return: The number of distinct file sizes (like len of the dict).
+        """
+
+        return self._count
+
+    # --------------------------------------------------------------------------
+    def __iter__(self):
+        """
+        :return: An iterator over the distinct file sizes, smallest first.
+        """
+
+        return self.keys()
+
+    # --------------------------------------------------------------------------
+    def keys(self):
+        """
+        :return: An iterator over the distinct file sizes, smallest first.
+        """
+
+        for size, first, last in self._groups():
+            yield size
+
+    # --------------------------------------------------------------------------
+    def items(self):
+        """
+        :return: An iterator over tuples of each distinct file size and the
+                 list of paths of that size, smallest first.
+        """
+
+        for size, first, last in self._groups():
+            yield size, self._paths(first, last)
+
+    # --------------------------------------------------------------------------
+    def _groups(self):
+        """
+        :return: An iterator over tuples of each distinct file size and its
+                 first and last (exclusive) positions in the sorted arrays.
+        """
+
+        first = 0
+        while first < len(self._sizes):
+            last = bisect.bisect_right(self._sizes, self._sizes[first], first)
+            yield self._sizes[first], first, last
+            first = last
+
+    # --------------------------------------------------------------------------
+    def file_count(self):
+        """
+        :return: The total number of files in the index.
+        """
+
+        return len(self._sizes)
+
+
+# ------------------------------------------------------------------------------
+def _sorted_sizes(sizes,
+                  chunk_size=65536):
+    """
+    Sorts an array of sizes without building a list of every size at once:
+    Each chunk of the array is sorted on its own into a compact array of
+    positions, then the chunks are merged.
+
+    :param sizes: An array.array of sizes.
+    :param chunk_size: The number of sizes to sort at once. Defaults to 65536.
+
+    :return: A generator that yields a tuple of the size and its position in
+             sizes, in order of size (and position, for equal sizes).
+    """
+
+    chunks = list()
+    for first in range(0, len(sizes), chunk_size):
+        last = min(first + chunk_size, len(sizes))
+        chunks.append(array.array("q", sorted(range(first, last),
+                                              key=sizes.__getitem__)))
+
+    def pairs(chunk):
+        for i in chunk:
+            yield sizes[i], i
+
+    return heapq.merge(*[pairs(chunk) for chunk in chunks])
+
+
+# ------------------------------------------------------------------------------
+def _fs_encode(path):
+    """
+    :param path: A path.
+
+    :return: The path as bytes, encoded the same way the OS encodes file names.
+    """
+
+    if type(path) is bytes:
+        return path
+    if str is bytes:
+        # Python 2 has no os.fsencode. Only unicode paths get here.
+        return path.encode(sys.getfilesystemencoding() or "utf-8")
+    return os.fsencode(path)
+
+
+# ------------------------------------------------------------------------------
+def _fs_decode(path):
+    """
+    :param path: A path as bytes.
+
+    :return: The path as a native string (unchanged on Python 2).
+    """
+
+    if str is bytes:
+        return path
+    return os.fsdecode(path)
+
+
 # ------------------------------------------------------------------------------
 def copy_and_add_ver_num(source_p,
                          dest_d,
                          dest_n=None,
                          ver_prefix="v",
                          num_digits=4,
-                         do_verified_copy=False):
+                         do_verified_copy=False,
+                         digest=None,
+                         algorithm="md5"):
     """
     Copies a source file to the dest dir, adding a version number to the file
-    right before the extension. If a file with that version number already
-    exists, the file being copied will have its version number incremented so as
-    not to overwrite.  Returns a full path to the file that was copied.
+    right before the extension. The version number is one higher than the
+    highest version of that file already in dest_d (found with a single listing
+    of dest_d, see list_versions), so versions that were deleted are never
+    reused. Returns a full path to the file that was copied.
+
+    This is safe to call from any number of threads or processes (or machines,
+    on network filesystems with atomic hard links) publishing to the same
+    dest_d at once: The file is first copied to a hidden temp file in dest_d,
+    which is then hard linked to its versioned name. Creating the link fails
+    if another publisher took that version first, in which case the next
+    version is tried. So a version is never overwritten, and never visible
+    before it is completely copied. Where hard links are not supported, the
+    versioned name is reserved by creating a hidden ".<name>.reserved" file
+    with O_CREAT|O_EXCL, and the temp file is then renamed to the versioned
+    name (which is just as atomic for readers).
 
     :param source_p: The full path to the file to copy.
     :param dest_d: The directory to copy to.
@@ -274,6 +1675,10 @@ def copy_and_add_ver_num(source_p,
            versions like: v001. Defaults to 4.
     :param do_verified_copy: If True, then a verified copy will be performed.
            Defaults to False.
+    :param digest: The checksum of the source file if it is already known. Used
+           by the verified copy (see verified_copy_file). Defaults to None.
+    :param algorithm: The hashlib algorithm used by the verified copy (and of
+           digest). Defaults to "md5".
 
     :return: A full path to the file that was copied.
     """
@@ -290,23 +1695,162 @@ def copy_and_add_ver_num(source_p,
 
     base, ext = os.path.splitext(dest_n)
 
+    versions = _parse_versions(dircache.listdir(dest_d), dest_n, ver_prefix)
+
     v = 1
-    while True:
+    if versions:
+        v = versions[-1][0] + 1
 
-        version = "." + ver_prefix + str(v).rjust(num_digits, "0")
-        dest_p = os.path.join(dest_d, base + version + ext)
+    temp_p = os.path.join(dest_d, "." + dest_n + "." + uuid.uuid4().hex +
+                          ".tmp")
 
-        # This is not race condition safe, but it works for most cases...
-        if os.path.exists(dest_p):
-            v += 1
-            continue
+    try:
 
         if do_verified_copy:
-            verified_copy_file(source_p, dest_p)
+            verified_copy_file(source_p, temp_p, algorithm, digest=digest)
         else:
-            shutil.copy(source_p, dest_p)
+            _copy_file(source_p, temp_p)
+
+        while True:
+
+            version = "." + ver_prefix + str(v).rjust(num_digits, "0")
+            dest_p = os.path.join(dest_d, base + version + ext)
+
+            if _publish_file(temp_p, dest_p):
+                return dest_p
+
+            # Another publisher got this version first.
+            v += 1
+
+    finally:
+        if os.path.lexists(temp_p):
+            os.remove(temp_p)
 
-        return dest_p
+
+# ------------------------------------------------------------------------------
+def _publish_file(temp_p,
+                  dest_p):
+    """
+    Atomically gives a completely written temp file its final name, unless a
+    file with that name already exists.
+
+    :param temp_p: The path to the temp file. If it is still there afterwards
+           (the link was made, or the name was taken), it must be removed by
+           the caller.
+    :param dest_p: The final path, in the same directory.
+
+    :return: True if the file was published, False if dest_p already exists.
+    """
+
+    if hasattr(os, "link"):
+        try:
+            os.link(temp_p, dest_p)
+            return True
+        except OSError as err:
+            if err.errno == errno.EEXIST:
+                return False
+            if err.errno not in _CLONE_UNSUPPORTED | set([errno.ENOSYS]):
+                raise
+
+    # No hard links here, so reserve the name with a hidden sidecar file (so
+    # that the final name never exists before it holds the whole file), then
+    # rename the temp file to it. Only the publisher holding the reservation
+    # may rename, so the rename can not overwrite another publisher's file.
+    dest_d, dest_n = os.path.split(dest_p)
+    reserve_p = os.path.join(dest_d, "." + dest_n + ".reserved")
+
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+    try:
+        os.close(os.open(reserve_p, flags, 0o644))
+    except OSError as err:
+        if err.errno == errno.EEXIST:
+            return False
+        raise
+
+    try:
+        if os.path.lexists(dest_p):
+            return False
+        os.rename(temp_p, dest_p)
+    finally:
+        os.remove(reserve_p)
+
+    return True
+
+
+# ------------------------------------------------------------------------------
+def list_versions(dest_d,
+                  file_n,
+                  ver_prefix="v"):
+    """
+    Lists the versions of a file created by copy_and_add_ver_num. The directory
+    is listed once, and the names are matched against a single pattern, so
+    this costs the same no matter how many versions there are.
+
+    :param dest_d: The directory holding the versions.
+    :param file_n: The name of the file without a version number (i.e.
+           "asset.exr" to find "asset.v0001.exr", "asset.v0002.exr"...).
+    :param ver_prefix: The prefix in front of the version number. Defaults to
+           "v".
+
+    :return: A list of (version number, full path) tuples, sorted by version
+             number.
+    """
+
+    assert os.path.isdir(dest_d)
+
+    return [(version, os.path.join(dest_d, version_n)) for version, version_n in
+            _parse_versions(dircache.listdir(dest_d), file_n, ver_prefix)]
+
+
+# ------------------------------------------------------------------------------
+def latest_version(dest_d,
+                   file_n,
+                   ver_prefix="v"):
+    """
+    Finds the highest version of a file created by copy_and_add_ver_num.
+
+    :param dest_d: The directory holding the versions.
+    :param file_n: The name of the file without a version number.
+    :param ver_prefix: The prefix in front of the version number. Defaults to
+           "v".
+
+    :return: A tuple of the version number and the full path to that version,
+             or None if there are no versions.
+    """
+
+    versions = list_versions(dest_d, file_n, ver_prefix)
+    if not versions:
+        return None
+    return versions[-1]
+
+
+# ------------------------------------------------------------------------------
+def _parse_versions(files_n,
+                    file_n,
+                    ver_prefix):
+    """
+    Picks out the versions of a file from a list of file names.
+
+    :param files_n: The list of file names to search.
+    :param file_n: The name of the file without a version number.
+    :param ver_prefix: The prefix in front of the version number.
+
+    :return: A list of (version number, versioned file name) tuples, sorted by
+             version number.
+    """
+
+    base, ext = os.path.splitext(file_n)
+    pattern = re.compile(re.escape(base + "." + ver_prefix) + r"(\d+)" +
+                         re.escape(ext) + r"\Z")
+
+    output = list()
+    for name in files_n:
+        result = pattern.match(name)
+        if result:
+            output.append((int(result.group(1)), name))
+
+    output.sort()
+    return output
 
 
 # TODO: Make this windows safe
@@ -318,7 +1862,11 @@ def copy_file_deduplicated(source_p,
                            dest_n=None,
                            ver_prefix="v",
                            num_digits=4,
-                           do_verified_copy=False):
+                           do_verified_copy=False,
+                           dedup_index=None,
+                           algorithm="md5",
+                           link_mode="symlink",
+                           return_link=False):
     """
     Given a full path to a source file, copy that file into the data directory
     and make a symlink in dest_p that points to this file. Does de-duplication
@@ -334,7 +1882,8 @@ def copy_file_deduplicated(source_p,
            stored.
     :param data_sizes: A dictionary of all the files in the data_d keyed on file
            size. The key is the file size, the value is a list of files in
-           data_d that are of that size.
+           data_d that are of that size (a SizeIndex may be used instead). May
+           be None if dedup_index is given.
     :param dest_n: An optional name to rename the copied file to. If None, then
            the copied file will have the same name as the source file. Defaults
            to None.
@@ -346,8 +1895,24 @@ def copy_file_deduplicated(source_p,
            versions like: v001. Defaults to 4.
     :param do_verified_copy: If True, then a verified copy will be performed.
            Defaults to False.
-
-    :return: The path to the actual de-duplicated file in data_d.
+    :param dedup_index: An optional dedupindex.DedupIndex for data_d. If given,
+           it is used to find a matching file (instead of data_sizes) without
+           checksumming any of the files in data_d, and any newly stored file
+           is added to it. Defaults to None.
+    :param algorithm: The hashlib algorithm used to compare files when
+           searching data_sizes (see find_duplicate_file). Ignored if a
+           dedup_index is given, since it always uses its own algorithm.
+           Defaults to "md5".
+    :param link_mode: How the file in dest_d points at the file in data_d:
+           "symlink", "hardlink" or "reflink" (see link_data_file). Defaults to
+           "symlink".
+    :param return_link: If True, the path to the link and the kind of link
+           that was actually made (which may not be link_mode, see
+           link_data_file) are returned as well. Defaults to False.
+
+    :return: The path to the actual de-duplicated file in data_d. If
+             return_link is True, a tuple of that path, the path to the link,
+             and the kind of link made.
     """
 
     assert not dest_d.startswith(data_d)
@@ -357,31 +1922,37 @@ def copy_file_deduplicated(source_p,
     assert os.path.isdir(data_d)
     assert os.path.exists(dest_d)
     assert os.path.isdir(dest_d)
-    assert type(data_sizes) == dict
-    for key in data_sizes:
-        assert type(data_sizes[key]) == list
+    assert (dedup_index is not None
+            or isinstance(data_sizes, (dict, SizeIndex)))
+    if type(data_sizes) == dict:
+        for key in data_sizes:
+            assert type(data_sizes[key]) == list
     assert type(num_digits) is int
     assert type(do_verified_copy) is bool
+    assert link_mode in LINK_MODES
 
     size = os.path.getsize(source_p)
 
     if not dest_n:
         dest_n = os.path.split(source_p)[1]
 
-    # Check to see if there is a list of files of that size in the .data dir
-    try:
-        possible_matches_p = data_sizes[size]
-    except KeyError:
-        possible_matches_p = []
+    if dedup_index is not None:
+        algorithm = dedup_index.algorithm
+        source_digest = hash_file(source_p, algorithm)
+        matched_p = dedup_index.lookup(size, source_digest)
 
-    # For each of these, try to find a matching file
-    matched_p = None
-    source_md5 = md5_for_file(source_p)
-    for possible_match_p in possible_matches_p:
-        possible_match_md5 = md5_for_file(possible_match_p)
-        if source_md5 == possible_match_md5:
-            matched_p = possible_match_p
-            break
+    else:
+
+        # Check to see if there is a list of files of that size in the .data dir
+        try:
+            possible_matches_p = data_sizes[size]
+        except KeyError:
+            possible_matches_p = []
+
+        # Compare samples of each before comparing full checksums.
+        matched_p, source_digest = find_duplicate_file(source_p,
+                                                       possible_matches_p,
+                                                       algorithm)
 
     # If we did not find a matching file, then copy the file to the
     # data_d dir, with an added version number that ensures that we do
@@ -392,27 +1963,120 @@ def copy_file_deduplicated(source_p,
                                          dest_n=dest_n,
                                          ver_prefix=ver_prefix,
                                          num_digits=num_digits,
-                                         do_verified_copy=do_verified_copy)
+                                         do_verified_copy=do_verified_copy,
+                                         digest=source_digest,
+                                         algorithm=algorithm)
+        if dedup_index is not None:
+            dedup_index.add(matched_p, source_digest)
 
-    os.chmod(matched_p, 0o644)
+    link_p, link_mode = link_data_file(matched_p, dest_d, dest_n, link_mode)
+
+    if return_link:
+        return matched_p, link_p, link_mode
+    return matched_p
+
+
+# ------------------------------------------------------------------------------
+def link_data_file(data_p,
+                   dest_d,
+                   dest_n,
+                   link_mode="symlink"):
+    """
+    Makes a file stored in a de-duplicated data directory read-only for
+    everyone but its owner, and links to it from the destination directory
+    (replacing anything already there with that name). The link may be:
+
+    "symlink": A relative symlink to the stored file.
+    "hardlink": A hard link to the stored file. Readers do not have to resolve
+    a symlink, but both must be on the same filesystem. Note that the link
+    shares the stored file's permissions and contents, so writing to it changes
+    the stored file as well.
+    "reflink": A copy that shares the stored file's data blocks (on
+    filesystems that support it, like Btrfs and XFS), so it costs no space or
+    copying, and is an independent file as far as readers and writers are
+    concerned.
+
+    If a reflink or hardlink cannot be made here, a symlink is made instead.
+    A reflink never falls back to a hardlink: the caller asked for an
+    independent file, and a write through a hardlink would change the stored
+    file for everyone else who links to the same contents. Check the kind of
+    link returned to see what was made.
+
+    :param data_p: The full path to the file in the data directory.
+    :param dest_d: The directory to create the link in.
+    :param dest_n: The name of the link.
+    :param link_mode: One of "symlink", "hardlink" or "reflink". Defaults to
+           "symlink".
+
+    :return: A tuple of the path to the link and the kind of link that was
+             actually made.
+    """
+
+    assert link_mode in LINK_MODES
+
+    os.chmod(data_p, 0o644)
+
+    dest_d = dest_d.rstrip(os.path.sep)
+    link_p = os.path.join(dest_d, dest_n)
+    if os.path.lexists(link_p):
+        os.unlink(link_p)
+
+    if link_mode == "reflink":
+        if _reflink_file(data_p, link_p):
+            return link_p, "reflink"
+
+    elif link_mode == "hardlink" and hasattr(os, "link"):
+        try:
+            os.link(data_p, link_p)
+            return link_p, "hardlink"
+        except OSError as err:
+            if err.errno not in _CLONE_UNSUPPORTED | set([errno.EMLINK]):
+                raise
 
     # Build a relative path from where the symlink will go to the file in
     # the data dir. Then create a symlink to this file in the destination.
-    dest_d = dest_d.rstrip(os.path.sep)
-    matched_file_n = os.path.split(matched_p.rstrip(os.path.sep))[1]
-    relative_d = os.path.relpath(data_d, dest_d)
-    relative_p = os.path.join(relative_d, matched_file_n)
-    if os.path.exists(os.path.join(dest_d, dest_n)):
-        os.unlink(os.path.join(dest_d, dest_n))
-    os.symlink(relative_p, os.path.join(dest_d, dest_n))
+    data_d, data_n = os.path.split(data_p.rstrip(os.path.sep))
+    relative_p = os.path.join(os.path.relpath(data_d, dest_d), data_n)
+    os.symlink(relative_p, link_p)
 
-    return matched_p
+    return link_p, "symlink"
+
+
+# ------------------------------------------------------------------------------
+def _reflink_file(source_p,
+                  dest_p):
+    """
+    Creates a new file that is a reflink of another.
+
+    :param source_p: The file to reflink.
+    :param dest_p: The path of the new file. It must not exist.
+
+    :return: True if the reflink was made. False if reflinks are not supported
+             here, in which case no file is left at dest_p.
+    """
+
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+
+    with open(source_p, "rb") as source:
+        dest_fd = os.open(dest_p, flags, 0o644)
+        try:
+            cloned = _clone_fd(source.fileno(), dest_fd)
+        finally:
+            os.close(dest_fd)
+
+    if not cloned:
+        os.remove(dest_p)
+    else:
+        shutil.copymode(source_p, dest_p)
+
+    return cloned
 
 
 # ------------------------------------------------------------------------------
 def ancestor_contains_file(path_p,
                            files_n,
-                           depth=None):
+                           depth=None,
+                           ancestor_cache=None):
     """
     Returns the path of any parent directory (evaluated recursively up the
     hierarchy) that contains any of the files in the list: files_n. This is
@@ -429,6 +2093,8 @@ def ancestor_contains_file(path_p,
            None. For example: a depth of 1 will only check the immediate parent
            of the given path. 2 will check the immediate parent and its parent.
            Searches will never progress "past" the root, regardless of depth.
+    :param ancestor_cache: An optional AncestorCache to look up (and store)
+           which directories contain which files. Defaults to None.
 
     :return: The path of the first parent that contains any one of these files.
              If no ancestors contain any of these files, returns None.
@@ -447,33 +2113,207 @@ def ancestor_contains_file(path_p,
     if not os.path.isdir(path_p):
         path_p = os.path.dirname(path_p)
 
+    for test_p in _ancestor_dirs(path_p, depth):
+        if ancestor_cache is None:
+            for file_n in files_n:
+                if os.path.exists(os.path.join(test_p, file_n)):
+                    return test_p
+        elif ancestor_cache.contains_any(test_p, files_n):
+            return test_p
+
+    return None
+
+
+# ------------------------------------------------------------------------------
+def ancestors_contain_file(paths_p,
+                           files_n,
+                           depth=None,
+                           ancestor_cache=None):
+    """
+    Does the same search as ancestor_contains_file, but for many paths at
+    once. Paths usually share most of their ancestors (i.e. every file in a
+    publish), so each distinct directory is only checked once for the files,
+    and paths that share a parent directory share one search.
+
+    Unlike ancestor_contains_file, the paths are not checked to exist and may
+    be files as well as directories. In both cases the search starts at the
+    parent of the path (so for a file, its own directory is checked first).
+
+    :param paths_p: A list of the paths we are testing.
+    :param files_n: A file name, or a list of file names, we are looking for.
+    :param depth: Limit the number of levels up to look (see
+           ancestor_contains_file). Defaults to None.
+    :param ancestor_cache: An optional AncestorCache to keep the results of
+           the checks in between calls. If None, a new one is used for this call
+           only. Defaults to None.
+
+    :return: A dictionary where the key is each path, and the value is the path
+             of the first parent that contains any one of the files, or None.
+    """
+
+    assert type(paths_p) is list
+    assert depth is None or type(depth) is int
+    assert type(files_n) is str or type(files_n) is list
+
+    if type(files_n) != list:
+        files_n = [files_n]
+
+    if ancestor_cache is None:
+        ancestor_cache = AncestorCache()
+
+    output = dict()
+    searches = dict()
+
+    for path_p in paths_p:
+        parent_d = os.path.dirname(path_p.rstrip(os.path.sep))
+        try:
+            output[path_p] = searches[parent_d]
+            continue
+        except KeyError:
+            pass
+
+        result = None
+        for test_p in _ancestor_dirs(path_p, depth):
+            if ancestor_cache.contains_any(test_p, files_n):
+                result = test_p
+                break
+
+        searches[parent_d] = result
+        output[path_p] = result
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def _ancestor_dirs(path_p,
+                   depth):
+    """
+    Lists the directories that ancestor_contains_file searches, in order.
+
+    :param path_p: The path we are testing.
+    :param depth: The number of levels up to look, or None (or 0) to go all the
+           way up to the root.
+
+    :return: A generator that yields the parent of the path, then its parent,
+             and so on, ending at the root (which is yielded once).
+    """
+
+    path_p = path_p.rstrip(os.path.sep)
+
     already_at_root = False
     count = 0
 
     test_p = os.path.dirname(path_p)
     while True:
 
-        # Check each of the test files.
-        for file_n in files_n:
-            if os.path.exists(os.path.join(test_p, file_n)):
-                return test_p
+        yield test_p
 
-        # If nothing is found, move up to the next parent dir.
+        # Move up to the next parent dir.
         test_p = os.path.dirname(test_p)
 
         # Increment the count and bail if we have hit our max depth.
         count += 1
         if depth and count >= depth:
-            return None
+            return
 
         # TODO: Probably not windows safe
         # Check to see if we are at the root level (bail if we are)
         if os.path.dirname(test_p) == test_p:
             if already_at_root:
-                return None
+                return
             already_at_root = True
 
 
+# ==============================================================================
+class AncestorCache(object):
+    """
+    Remembers which directories contain which files, for
+    ancestor_contains_file and ancestors_contain_file. Only the names that
+    were asked about are remembered, each with one os.path.exists call. The
+    results are not validated, so a directory must be invalidated if any of
+    these files are added to or removed from it. Safe to share between
+    threads.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self,
+                 maxsize=65536):
+        """
+        Setup.
+
+        :param maxsize: The maximum number of directories to remember. Defaults
+               to 65536.
+
+        :return: Nothing.
+        """
+
+        self._dirs = cache.LRUCache(maxsize)
+        self._lock = threading.Lock()
+        self.checks = 0
+
+    # --------------------------------------------------------------------------
+    def contains_any(self,
+                     dir_d,
+                     files_n):
+        """
+        :param dir_d: The directory to check.
+        :param files_n: A list of file names.
+
+        :return: True if the directory contains any one of the files.
+        """
+
+        with self._lock:
+            found = self._dirs.get(dir_d)
+            if found is None:
+                found = dict()
+                self._dirs.set(dir_d, found)
+
+        for file_n in files_n:
+            with self._lock:
+                exists = found.get(file_n)
+            if exists is None:
+                # Checked without the lock held. Two threads may both check
+                # the same file, but they store the same answer.
+                exists = os.path.exists(os.path.join(dir_d, file_n))
+                with self._lock:
+                    found[file_n] = exists
+                    self.checks += 1
+            if exists:
+                return True
+
+        return False
+
+    # --------------------------------------------------------------------------
+    def invalidate(self,
+                   dir_d=None):
+        """
+        Forgets what a directory (or every directory) contains.
+
+        :param dir_d: The directory to forget. If None, everything is
+               forgotten. Defaults to None.
+
+        :return: Nothing.
+        """
+
+        if dir_d is None:
+            self._dirs.clear()
+        else:
+            self._dirs.discard(dir_d.rstrip(os.path.sep) or os.path.sep)
+
+    # --------------------------------------------------------------------------
+    def stats(self):
+        """
+        :return: A dictionary with the number of directory hits and misses,
+                 the number of exists checks done, and the current and maximum
+                 number of directories held.
+        """
+
+        output = self._dirs.stats()
+        with self._lock:
+            output["checks"] = self.checks
+        return output
+
+
 # ------------------------------------------------------------------------------
 def lock_dir(path_d):
     """
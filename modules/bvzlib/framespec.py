@@ -1,12 +1,68 @@
+import array
+import bisect
+import itertools
 import os
 import re
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from bvzlib import cache
+from bvzlib import dircache
+
+
+# Holds the results of the regex builders and framespec parsers below. These
+# are called with the same few patterns over and over, so memoizing them saves
+# rebuilding and recompiling the same regular expressions. Use
+# PATTERN_CACHE.stats() to see how well the cache is working and
+# PATTERN_CACHE.resize() to tune it.
+PATTERN_CACHE = cache.LRUCache(maxsize=4096)
+
+# A framespec (see find_frame_spec for how this pattern is built).
+FRAME_SPEC_PATTERN = re.compile(r"(?:(?<=\.)|(?<=^))"
+                                r"(?:(?:(?<!\.),)?\d+(?:-\d+(?:[x:]-?\d+)?)?)+"
+                                r"(?:@+|#+)?"
+                                r"(?=\.|$)")
+
+# A single start-end:step portion of a framespec.
+FRAME_RANGE_PATTERN = re.compile(r"(\d+)(?:(?:-(\d+))(?:[x:](-?\d+))?)?")
+
+# Sequence identifiers in the printf (%04d) and hash (.####) formats.
+SEQ_PRINTF_TEST_PATTERN = re.compile(r'[\._]%\d+d')
+SEQ_PRINTF_PATTERN = re.compile(r'.*?()(%\d+d).*')  # Blank group is intentional
+SEQ_HASH_PATTERN = re.compile(r'.*?([\._])(#+).*')
+
+# The earliest point where either kind of sequence identifier may start.
+SEQ_ID_START_PATTERN = re.compile(r'%\d+d|[\._]#')
+
+# A run of digits bounded by a period (or the start of the string) on the
+# left and a period on the right. Used to locate candidate frame numbers.
+DIGITS_PATTERN = re.compile(r"(?:(?<=\.)|(?<=^))\d+(?=\.)")
+
+# Splits a file name around the last run of digits that is bounded by periods
+# (or the start or end of the name). Used to find the frame number of a file.
+SEQUENCE_NAME_PATTERN = re.compile(r"((?:.*\.)?)(\d+)((?:\.[^.]*)*)\Z",
+                                   re.DOTALL)
+
+# A four digit UDIM tile at the end of the prefix of a sequence (see
+# find_sequences): a period or underscore before it, and the period in front of
+# the frame number after it.
+UDIM_TOKEN_PATTERN = re.compile(r"(?<=[._])[1-9]\d{3}(?=\.\Z)")
+
+# A four digit UDIM tile in a file name with no frame number: a period or
+# underscore before it, and the period in front of the extension after it.
+UDIM_NAME_PATTERN = re.compile(r"(?<=[._])[1-9]\d{3}(?=\.[^.]*\Z)")
+
 
 # ------------------------------------------------------------------------------
+@cache.memoize(PATTERN_CACHE)
 def seq_and_udim_ids_to_regex(path,
                               match_hash_length=False,
                               udim_identifier=None,
-                              strict_udim_format=True):
+                              strict_udim_format=True,
+                              udim_group=None):
     """
     Given a file string that may have a UDIM identifier and/or a sequence
     identifier in it, return the same string, but converted to a regex pattern
@@ -46,6 +102,9 @@ def seq_and_udim_ids_to_regex(path,
            this to False may lead to somewhat erroneous identification of UDIM's
            in files, so - unless absolutely needed - this should be se to True.
            Defaults to True.
+    :param udim_group: If not None, the UDIM regex pattern will be wrapped in a
+           named group with this name so that the UDIM tile can be extracted
+           from a match. Defaults to None.
 
     :return: A string where the UDIM identifier, if it exists, is replaced with
              a regex pattern that matches this identifier.
@@ -67,7 +126,10 @@ def seq_and_udim_ids_to_regex(path,
     output = re.escape(os.path.join(parent_d, prefix_seq_split[0]))
     output += prefix_seq_split[1]  # <- might have seq regex pattern in it.
     output += re.escape(prefix_seq_split[2])
-    output += udim_split[1]  # <- might have UDIM regex pattern it in.
+    if udim_group and udim_split[1]:
+        output += "(?P<" + udim_group + ">" + udim_split[1] + ")"
+    else:
+        output += udim_split[1]  # <- might have UDIM regex pattern it in.
     output += re.escape(suffix_seq_split[0])
     output += suffix_seq_split[1]  # <- might have seq regex pattern in it.
     output += re.escape(suffix_seq_split[2])
@@ -76,6 +138,7 @@ def seq_and_udim_ids_to_regex(path,
 
 
 # ------------------------------------------------------------------------------
+@cache.memoize(PATTERN_CACHE)
 def udim_id_to_regex(string,
                      udim_identifier=None,
                      strict_udim_format=True):
@@ -140,6 +203,7 @@ def udim_id_to_regex(string,
 
 
 # ------------------------------------------------------------------------------
+@cache.memoize(PATTERN_CACHE)
 def seq_id_to_regex(string,
                     match_hash_length=False):
     """
@@ -181,15 +245,11 @@ def seq_id_to_regex(string,
              blank strings in the other two elements.
     """
 
-    test_pattern = r'[\._]%\d+d'
-    printf_input_pattern = r'.*?()(%\d+d).*'  # Blank group is intentional
-    hash_input_pattern = r'.*?([\._])(#+).*'
-
-    do_printf = re.search(test_pattern, string)
+    do_printf = SEQ_PRINTF_TEST_PATTERN.search(string)
     if do_printf:
-        result = re.match(printf_input_pattern, string)
+        result = SEQ_PRINTF_PATTERN.match(string)
     else:
-        result = re.match(hash_input_pattern, string)
+        result = SEQ_HASH_PATTERN.match(string)
 
     if result:
         delim, identifier = result.groups()
@@ -215,6 +275,7 @@ def seq_id_to_regex(string,
 
 
 # ------------------------------------------------------------------------------
+@cache.memoize(PATTERN_CACHE)
 def find_frame_spec(string):
     """
     Finds the framespec in a string. Does NOT break it out into its constituent
@@ -227,28 +288,25 @@ def find_frame_spec(string):
              framespec. For example: ("filename", ".1-10x2,20,30,32-40.", "tif")
     """
 
-    # Complete regex pattern is here, rebuilt in pieces below
-    # (?:(?<=\.)|(?<=^))(?:(?:(?<!\.),)?\d+(?:-\d+(?:[x:]-?\d+)?)?)+(?:@+|#+)?(?=\.|$)
-
+    # The pattern (FRAME_SPEC_PATTERN) is built from these pieces:
+    #
     # Always start with a dot or beginning of line (negative lookbehind).
-    fspec_pattern = r"(?:(?<=\.)|(?<=^))"
-
+    # (?:(?<=\.)|(?<=^))
+    #
     # Actual framespec (repeat as many times as needed)
-    fspec_pattern += r"(?:(?:(?<!\.),)?\d+(?:-\d+(?:[x:]-?\d+)?)?)+"
-
+    # (?:(?:(?<!\.),)?\d+(?:-\d+(?:[x:]-?\d+)?)?)+
+    #
     # May contain an optional string of # or @ symbols at the end.
-    fspec_pattern += r"(?:@+|#+)?"
-
+    # (?:@+|#+)?
+    #
     # And is followed with a dot or the end of the line (positive lookahead)
-    fspec_pattern += r"(?=\.|$)"
-
-    compiled_pattern = re.compile(fspec_pattern)
+    # (?=\.|$)
 
     # Separate the last framespec in the file name (only the last one counts)
     match_start = None
     match_end = None
 
-    for match in compiled_pattern.finditer(string):
+    for match in FRAME_SPEC_PATTERN.finditer(string):
 
         if match_start:
             match_start = max(match_start, match.start())
@@ -270,54 +328,471 @@ def find_frame_spec(string):
     return prefix, framespec, suffix
 
 
-# ------------------------------------------------------------------------------
-def expand_frame_spec(framespec):
+# ==============================================================================
+class FrameSet(object):
+    """
+    A compact, immutable set of frame numbers. Rather than holding every frame,
+    the set is stored as a sorted list of non-overlapping runs, each of which is
+    a (start, end, step) tuple. For example, the framespec 1-1000000x1,5-9 is
+    held as a single run: (1, 1000000, 1).
+
+    Runs are always normalized the same way (greedily, lowest frame first,
+    where a run must hold at least three frames) so two FrameSets holding the
+    same frames will always hold the same runs.
+
+    A FrameSet may be built from a framespec string, another FrameSet, or any
+    iterable of integers:
+
+    FrameSet("1-10x2,20")
+    FrameSet([1, 3, 5, 7, 9, 20])
+
+    Length, membership, indexing and slicing, iteration, and the union,
+    intersection and difference operations all work on the runs directly
+    without expanding the full list of frames. The only exception is the union
+    or difference of two runs whose steps interleave without forming a single
+    run (1-100x2 | 1-100x3 for example). Only the overlapping portion of those
+    runs is expanded.
     """
-    Given a framespec, return a list of frame numbers that match. For example:
-    Given 1-5x2,8, return [1,3,5,8]
 
-    Expects a valid framespec. If you give it something that contains non-valid
-    framespec values, the result is undefined.
+    # --------------------------------------------------------------------------
+    def __init__(self, frames=None):
+        """
+        Setup.
 
-    :param framespec: The framespec string
+        :param frames: Either a framespec string (example: "1-10x2,20"), another
+               FrameSet, or an iterable of integers. If None, the FrameSet will
+               be empty. Defaults to None.
 
-    :return: A list of numbers this framespec evaluates to.
-    """
+        :return: Nothing.
+        """
 
-    fspec_pattern = r"(\d+)(?:(?:-(\d+))(?:[x:](-?\d+))?)?"
-    compiled_pattern = re.compile(fspec_pattern)
+        if frames is None:
+            runs = list()
+        elif isinstance(frames, FrameSet):
+            runs = list(frames.runs)
+        elif isinstance(frames, str):
+            runs = _union_all_runs(_frame_spec_runs(frames))
+        else:
+            runs = _runs_from_frames(sorted(set(frames)))
 
-    output = set()
+        self._set_runs(_canonical_runs(runs))
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    def _from_runs(cls, runs):
+        """
+        Builds a FrameSet directly from a list of sorted, non-overlapping runs.
+
+        :param runs: The list of (start, end, step) tuples.
+
+        :return: A new FrameSet.
+        """
 
-    for subspec in framespec.split(","):
+        output = cls.__new__(cls)
+        output._set_runs(_canonical_runs(runs))
+        return output
+
+    # --------------------------------------------------------------------------
+    def _set_runs(self, runs):
+        """
+        Stores the runs along with the lookup tables used for membership and
+        indexing.
+
+        :param runs: The list of canonical (start, end, step) tuples.
 
-        for matches in compiled_pattern.finditer(subspec):
+        :return: Nothing.
+        """
 
-            start, end, step = matches.groups()
+        self._runs = tuple(runs)
+        self._starts = [run[0] for run in runs]
+        self._offsets = list()
 
-            start = int(start)
+        count = 0
+        for run in runs:
+            self._offsets.append(count)
+            count += _run_count(run)
+        self._count = count
+
+    # --------------------------------------------------------------------------
+    @property
+    def runs(self):
+        """
+        :return: A tuple of the (start, end, step) runs that make up this set.
+        """
 
-            if not end:
-                end = start
-            else:
-                end = int(end)
+        return self._runs
+
+    # --------------------------------------------------------------------------
+    @property
+    def first(self):
+        """
+        :return: The lowest frame in the set, or None if the set is empty.
+        """
 
-            if not step:
-                step = 1
-            else:
-                step = int(step)
+        if not self._runs:
+            return None
+        return self._runs[0][0]
 
-            if step > 0:
-                offset = 1
+    # --------------------------------------------------------------------------
+    @property
+    def last(self):
+        """
+        :return: The highest frame in the set, or None if the set is empty.
+        """
+
+        if not self._runs:
+            return None
+        return self._runs[-1][1]
+
+    # --------------------------------------------------------------------------
+    def __len__(self):
+        """
+        :return: The number of frames in the set.
+        """
+
+        return self._count
+
+    # --------------------------------------------------------------------------
+    def __bool__(self):
+        """
+        :return: True if the set contains any frames.
+        """
+
+        return bool(self._runs)
+
+    __nonzero__ = __bool__
+
+    # --------------------------------------------------------------------------
+    def __contains__(self, frame):
+        """
+        :param frame: The frame number to test.
+
+        :return: True if the frame is in the set, False otherwise.
+        """
+
+        if not isinstance(frame, int):
+            return False
+
+        i = bisect.bisect_right(self._starts, frame) - 1
+        if i < 0:
+            return False
+        return _run_contains(self._runs[i], frame)
+
+    # --------------------------------------------------------------------------
+    def __iter__(self):
+        """
+        Iterates over the frames in ascending order.
+        """
+
+        for start, end, step in self._runs:
+            for frame in range(start, end + 1, step):
+                yield frame
+
+    # --------------------------------------------------------------------------
+    def __getitem__(self, index):
+        """
+        Returns the frame at an index (in ascending order), or a FrameSet of the
+        frames selected by a slice.
+
+        :param index: An integer index or a slice.
+
+        :return: An integer if index is an integer, a FrameSet if it is a slice.
+        """
+
+        if isinstance(index, slice):
+            return self._slice(index)
+
+        if index < 0:
+            index += self._count
+        if index < 0 or index >= self._count:
+            raise IndexError("FrameSet index out of range")
+
+        i = bisect.bisect_right(self._offsets, index) - 1
+        start, end, step = self._runs[i]
+        return start + (index - self._offsets[i]) * step
+
+    # --------------------------------------------------------------------------
+    def _slice(self, index):
+        """
+        Returns a FrameSet of the frames selected by a slice. Since a FrameSet
+        is always in ascending order, a negative slice step selects the same
+        frames as the equivalent positive slice.
+
+        :param index: The slice object.
+
+        :return: A FrameSet.
+        """
+
+        start, stop, step = index.indices(self._count)
+
+        if step > 0:
+            count = max(0, (stop - start + step - 1) // step)
+        else:
+            count = max(0, (start - stop - step - 1) // -step)
+
+        if not count:
+            return FrameSet()
+
+        if step < 0:
+            start, step = start + (count - 1) * step, -step
+        stop = start + (count - 1) * step
+
+        runs = list()
+        i = bisect.bisect_right(self._offsets, start) - 1
+        while i < len(self._runs) and self._offsets[i] <= stop:
+
+            offset = self._offsets[i]
+            run_start, run_end, run_step = self._runs[i]
+
+            first = max(offset, start)
+            first += (start - first) % step
+            last = min(offset + _run_count(self._runs[i]) - 1, stop)
+
+            if first <= last:
+                last = first + ((last - first) // step) * step
+                runs.append(_make_run(run_start + (first - offset) * run_step,
+                                      run_start + (last - offset) * run_step,
+                                      run_step * step))
+            i += 1
+
+        return FrameSet._from_runs(runs)
+
+    # --------------------------------------------------------------------------
+    def __eq__(self, other):
+        if not isinstance(other, FrameSet):
+            return NotImplemented
+        return self._runs == other.runs
+
+    # --------------------------------------------------------------------------
+    def __ne__(self, other):
+        if not isinstance(other, FrameSet):
+            return NotImplemented
+        return self._runs != other.runs
+
+    # --------------------------------------------------------------------------
+    def __hash__(self):
+        return hash(self._runs)
+
+    # --------------------------------------------------------------------------
+    def __or__(self, other):
+        if not isinstance(other, FrameSet):
+            return NotImplemented
+        return self.union(other)
+
+    # --------------------------------------------------------------------------
+    def __and__(self, other):
+        if not isinstance(other, FrameSet):
+            return NotImplemented
+        return self.intersection(other)
+
+    # --------------------------------------------------------------------------
+    def __sub__(self, other):
+        if not isinstance(other, FrameSet):
+            return NotImplemented
+        return self.difference(other)
+
+    # --------------------------------------------------------------------------
+    def union(self, other):
+        """
+        :param other: A FrameSet, framespec string or iterable of integers.
+
+        :return: A new FrameSet with the frames that are in either set.
+        """
+
+        runs = _combine_runs(self._runs, FrameSet(other).runs, "union")
+        return FrameSet._from_runs(runs)
+
+    # --------------------------------------------------------------------------
+    def intersection(self, other):
+        """
+        :param other: A FrameSet, framespec string or iterable of integers.
+
+        :return: A new FrameSet with the frames that are in both sets.
+        """
+
+        runs = _combine_runs(self._runs, FrameSet(other).runs, "intersection")
+        return FrameSet._from_runs(runs)
+
+    # --------------------------------------------------------------------------
+    def difference(self, other):
+        """
+        :param other: A FrameSet, framespec string or iterable of integers.
+
+        :return: A new FrameSet with the frames that are in this set but not in
+                 the other.
+        """
+
+        runs = _combine_runs(self._runs, FrameSet(other).runs, "difference")
+        return FrameSet._from_runs(runs)
+
+    # --------------------------------------------------------------------------
+    def to_framespec(self, padding=None):
+        """
+        Converts the set back into a framespec string in the same format that
+        find_frame_spec and expand_frame_spec understand. For example:
+        "1-10x2,20-30".
+
+        :param padding: If not None, a string of this many # symbols will be
+               appended to the framespec to indicate its padding. Defaults to
+               None.
+
+        :return: A framespec string. Empty if the set is empty.
+        """
+
+        output = list()
+        for start, end, step in self._runs:
+            if start == end:
+                output.append(str(start))
+            elif step == 1:
+                output.append(str(start) + "-" + str(end))
             else:
-                offset = -1
+                output.append(str(start) + "-" + str(end) + "x" + str(step))
 
-            for i in range(start, end + offset, step):
-                output.add(i)
+        output = ",".join(output)
 
-    output = sorted(output)
+        if padding and output:
+            output += "#" * padding
 
-    return output
+        return output
+
+    # --------------------------------------------------------------------------
+    def __str__(self):
+        """
+        :return: The framespec representation of the set.
+        """
+
+        return self.to_framespec()
+
+    # --------------------------------------------------------------------------
+    def __repr__(self):
+        return "FrameSet(" + repr(self.to_framespec()) + ")"
+
+
+# ==============================================================================
+class FileSequence(object):
+    """
+    A sequence of files found on disk (see find_sequences). Holds the parts of
+    the file name around the frame number, the frames themselves (as a
+    FrameSet), the padding of the frame numbers, and any UDIM tiles.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self,
+                 parent_d,
+                 prefix,
+                 suffix,
+                 padding,
+                 frames,
+                 udims,
+                 udim_identifier=None):
+        """
+        Setup.
+
+        :param parent_d: The directory holding the files. May be None if the
+               sequence was built from a list of file names.
+        :param prefix: The portion of the file name before the frame number. If
+               the files have UDIM tiles, the tile number is replaced with the
+               udim_identifier.
+        :param suffix: The portion of the file name after the frame number.
+        :param padding: The number of digits the frame numbers are padded to. 1
+               if they are not padded. None if the files have no frame numbers
+               (UDIM tiles only).
+        :param frames: A FrameSet of the frame numbers.
+        :param udims: A sorted list of the UDIM tile numbers (as integers).
+               Empty if the files have no UDIM tiles.
+        :param udim_identifier: The string that is used as the UDIM identifier.
+               If None, then the pattern "<UDIM>" will be used. Defaults to
+               None.
+
+        :return: Nothing.
+        """
+
+        if udim_identifier is None:
+            udim_identifier = "<UDIM>"
+
+        self.parent_d = parent_d
+        self.prefix = prefix
+        self.suffix = suffix
+        self.padding = padding
+        self.frames = frames
+        self.udims = udims
+        self.udim_identifier = udim_identifier
+
+    # --------------------------------------------------------------------------
+    @property
+    def framespec(self):
+        """
+        :return: The frames in a compact framespec format (example: 1-100x2,200)
+        """
+
+        return self.frames.to_framespec()
+
+    # --------------------------------------------------------------------------
+    @property
+    def pattern(self):
+        """
+        The sequence as a single pattern that expand_files understands. For
+        example: /tmp/render_<UDIM>.1-100####.exr
+
+        :return: The pattern string.
+        """
+
+        if self.frames:
+            framespec = self.frames.to_framespec()
+            if self.padding > 1:
+                framespec += "#" * self.padding
+        else:
+            framespec = ""
+
+        file_n = self.prefix + framespec + self.suffix
+
+        if self.parent_d is None:
+            return file_n
+        return os.path.join(self.parent_d, file_n)
+
+    # --------------------------------------------------------------------------
+    def __len__(self):
+        """
+        :return: The number of files in the sequence (assuming every UDIM tile
+                 holds every frame).
+        """
+
+        return max(len(self.frames), 1) * max(len(self.udims), 1)
+
+    # --------------------------------------------------------------------------
+    def __str__(self):
+        return self.pattern
+
+    # --------------------------------------------------------------------------
+    def __repr__(self):
+        return "FileSequence(" + repr(self.pattern) + ")"
+
+
+# ------------------------------------------------------------------------------
+def expand_frame_spec(framespec,
+                      as_frameset=False):
+    """
+    Given a framespec, return a list of frame numbers that match. For example:
+    Given 1-5x2,8, return [1,3,5,8]
+
+    Expects a valid framespec. If you give it something that contains non-valid
+    framespec values, the result is undefined.
+
+    :param framespec: The framespec string (or a FrameSet).
+    :param as_frameset: If True, then a FrameSet will be returned instead of a
+           list. This avoids building a list of every frame, which matters for
+           large framespecs like 1-1000000. Defaults to False.
+
+    :return: A list of numbers this framespec evaluates to (or a FrameSet if
+             as_frameset is True).
+    """
+
+    frames = _parse_frame_spec(framespec)
+
+    if as_frameset:
+        return frames
+
+    return list(frames)
 
 
 # ------------------------------------------------------------------------------
@@ -332,7 +807,7 @@ def calc_padding(frames, framespec=None, padding=None):
     If framespec is None, thenIf padding is None, returns a padding of 1 (i.e.
     no padding). Defaults to None.
 
-    :param frames: A list of integers.
+    :param frames: A list of integers or a FrameSet.
     :param framespec: A framespec string. Defaults to None.
     :param padding: How many digits to pad out to. Defaults to None.
 
@@ -343,6 +818,8 @@ def calc_padding(frames, framespec=None, padding=None):
         return 1
 
     if padding == 0:
+        if isinstance(frames, FrameSet):
+            return len(str(frames.last)) if frames else 1
         if frames:
             return len(str(max(frames)))
         else:
@@ -407,25 +884,71 @@ def expand_frame_sequence(file_n,
     :return: A list of files. These files may or may not exist on disk.
     """
 
-    output = list()
+    return list(iter_frame_sequence(file_n, padding))
+
+
+# ------------------------------------------------------------------------------
+def iter_frame_sequence(file_n,
+                        padding=None):
+    """
+    A generator version of expand_frame_sequence. Yields the expanded file
+    names one at a time instead of building the whole list first, so that
+    memory use stays constant regardless of the number of frames. Accepts the
+    same formats and applies the same padding rules as expand_frame_sequence.
+
+    :param file_n: The string representing the file sequence.
+    :param padding: The number of digits to pad the frame numbers to. See
+           expand_frame_sequence for details. Defaults to None.
+
+    :return: A generator that yields each file name in frame order. These files
+             may or may not exist on disk.
+    """
 
     path, name = os.path.split(file_n)
 
     prefix, framespec, suffix = find_frame_spec(name)
 
-    frames = expand_frame_spec(framespec)
+    frames = expand_frame_spec(framespec, as_frameset=True)
 
     if not frames:
-        return [file_n]
+        yield file_n
+        return
 
     padding = calc_padding(frames, framespec, padding)
 
     for frame in frames:
 
         file_out_n = prefix + str(frame).rjust(padding, "0") + suffix
-        output.append(os.path.join(path, file_out_n))
+        yield os.path.join(path, file_out_n)
 
-    return output
+
+# ------------------------------------------------------------------------------
+def iter_frame_sequence_chunks(file_n,
+                               chunk_size,
+                               padding=None):
+    """
+    A batched version of iter_frame_sequence. Yields lists of up to chunk_size
+    file names at a time (the last list may be shorter). Useful when handing
+    frames off to something that works in batches, like a render farm
+    submission.
+
+    :param file_n: The string representing the file sequence.
+    :param chunk_size: The maximum number of file names in each list.
+    :param padding: The number of digits to pad the frame numbers to. See
+           expand_frame_sequence for details. Defaults to None.
+
+    :return: A generator that yields lists of file names in frame order.
+    """
+
+    assert type(chunk_size) is int and chunk_size > 0
+
+    files_n = iter_frame_sequence(file_n, padding)
+
+    while True:
+        chunk = list(itertools.islice(files_n, chunk_size))
+        if not chunk:
+            return
+        yield chunk
 
 
 # ------------------------------------------------------------------------------
@@ -433,7 +956,8 @@ def expand_files(user_pattern,
                  padding=None,
                  udim_identifier=None,
                  strict_udim_format=True,
-                 match_hash_length=False):
+                 match_hash_length=False,
+                 structured=False):
     """
     Given a single pattern that may include frame specs, UDIM identifiers,
     and/or sequence identifiers, returns a list of actual files on disk that
@@ -464,7 +988,10 @@ def expand_files(user_pattern,
            UDIM patterns (example: <UDIM>),
            sequence identifiers (example: .### or %03d)
 
-           See above for an example of an actual pattern.
+           See above for an example of an actual pattern. The framespec may
+           also end the file name (/tmp/render.1-3####), unless it is a single
+           number with no padding (/tmp/notes.2), which is taken as a literal
+           file name.
     :param padding: Any padding to use when expanding frame specs. If None, then
            no padding will be used. Defaults to None.
     :param udim_identifier: The string that is used as the UDIM identifier. If
@@ -483,68 +1010,1268 @@ def expand_files(user_pattern,
            a single digit sequence number. If False, then any sequence number,
            no matter how long, would match. If the sequence identifier is in the
            printf format, this argument is ignored.
+    :param structured: If True, then instead of a flat list of paths, the files
+           are returned in a dictionary keyed on the UDIM tile (an integer, or
+           None if the pattern has no UDIM identifier). Each value is another
+           dictionary keyed on the frame number (an integer). Each of those
+           values is a list of paths (normally only one, but a pattern with a
+           sequence identifier or without padding may match more than one file
+           for the same tile and frame). The tile and frame numbers are parsed
+           while matching, so there is no need to parse the paths again.
+           Defaults to False.
+
+    :return: A tuple: A list of absolute paths to the files represented by the
+             pattern (or a dictionary if structured is True), and a list of the
+             missing frames (as padded strings).
+    """
+
+    pattern_match = _PatternMatch(user_pattern,
+                                  padding,
+                                  udim_identifier,
+                                  strict_udim_format,
+                                  match_hash_length)
+
+    if pattern_match.frames:
+        pattern_match.index = dict()
+        for file_n in dircache.listdir(pattern_match.parent_d):
+            pattern_match.add_file(file_n)
+
+    if structured:
+        return pattern_match.structured_results()
+    return pattern_match.results()
 
-    :return: A list of absolute paths to the files represented by the pattern.
+
+# ------------------------------------------------------------------------------
+def expand_files_batch(user_patterns,
+                       padding=None,
+                       udim_identifier=None,
+                       strict_udim_format=True,
+                       match_hash_length=False,
+                       structured=False):
+    """
+    Runs expand_files on a list of patterns at once. The patterns are grouped
+    by the directory they live in, and each directory is only listed a single
+    time no matter how many patterns point to it. Each file name in a
+    directory is only tested against the patterns that share its literal
+    leading text (the part of the file name before any frame spec, UDIM or
+    sequence identifier), so adding patterns to the same directory is cheap.
+
+    :param user_patterns: A list of patterns, each of which is in the same
+           format accepted by expand_files.
+    :param padding: Any padding to use when expanding frame specs. See
+           expand_files. Defaults to None.
+    :param udim_identifier: The string that is used as the UDIM identifier. See
+           expand_files. Defaults to None.
+    :param strict_udim_format: See expand_files. Defaults to True.
+    :param match_hash_length: See expand_files. Defaults to False.
+    :param structured: See expand_files. Defaults to False.
+
+    :return: A list with one item per pattern (in the same order as
+             user_patterns). Each item is the same tuple of matching files and
+             missing frames that expand_files would return for that pattern.
+    """
+
+    assert type(user_patterns) is list
+
+    pattern_matches = list()
+    by_dir = dict()
+
+    for user_pattern in user_patterns:
+        pattern_match = _PatternMatch(user_pattern,
+                                      padding,
+                                      udim_identifier,
+                                      strict_udim_format,
+                                      match_hash_length)
+        pattern_matches.append(pattern_match)
+        if pattern_match.frames:
+            pattern_match.index = dict()
+            by_dir.setdefault(pattern_match.parent_d, []).append(pattern_match)
+
+    for parent_d, dir_matches in by_dir.items():
+
+        # Index the patterns by the length of their literal text, then by the
+        # text itself, so that each file only needs one lookup per length.
+        literals = dict()
+        for pattern_match in dir_matches:
+            by_text = literals.setdefault(len(pattern_match.literal), dict())
+            by_text.setdefault(pattern_match.literal, []).append(pattern_match)
+        lengths = sorted(literals.keys())
+
+        for file_n in dircache.listdir(parent_d):
+            for length in lengths:
+                candidates = literals[length].get(file_n[:length])
+                if candidates:
+                    for pattern_match in candidates:
+                        pattern_match.add_file(file_n)
+
+    if structured:
+        return [pm.structured_results() for pm in pattern_matches]
+    return [pm.results() for pm in pattern_matches]
+
+
+# ------------------------------------------------------------------------------
+def analyze_frames(expected,
+                   present,
+                   use_numpy=None):
+    """
+    Compares the frames a sequence should have against the frames actually
+    found on disk. Reports the missing frames, the frames that were found more
+    than once (the same frame number at different paddings: file.1.exr and
+    file.0001.exr), the frames that were found but not expected, and the gaps
+    (each stretch of missing frames that are next to each other in the expected
+    frames).
+
+    Everything is reported as ranges rather than as lists of individual frames.
+    If NumPy is installed, the comparison is done with array operations, which
+    is much faster for sequences with many thousands of frames. Otherwise the
+    FrameSet operations are used.
+
+    :param expected: The frames that should exist. Either a framespec string or
+           a FrameSet.
+    :param present: An iterable of the frame numbers found on disk. Each item
+           may be an integer or the digits as they appear in the file name
+           (example: "0001"). A frame that is listed more than once counts as
+           a duplicate.
+    :param use_numpy: If True, NumPy is required. If False, NumPy is never used.
+           If None, NumPy is used if it is installed. Defaults to None.
+
+    :return: A dictionary with the following keys:
+
+             "missing": A FrameSet of the expected frames that were not found.
+             "duplicates": A FrameSet of the frames that were found more than
+             once.
+             "extra": A FrameSet of the frames that were found but not
+             expected.
+             "gaps": A list of (first, last, count) tuples, one for each run of
+             missing frames that are next to each other in the expected frames.
+             For example, if 1-100x2 was expected and 5, 7 and 9 are missing,
+             the gap is (5, 9, 3).
+    """
+
+    if use_numpy is None:
+        use_numpy = numpy is not None
+
+    if use_numpy and numpy is None:
+        raise ImportError("NumPy is required when use_numpy is True.")
+
+    expected = expand_frame_spec(expected, as_frameset=True)
+
+    if use_numpy:
+        return _analyze_frames_numpy(expected, present)
+
+    counts = dict()
+    for frame in present:
+        frame = int(frame)
+        counts[frame] = counts.get(frame, 0) + 1
+
+    found = FrameSet(counts.keys())
+    missing = expected - found
+
+    gaps = list()
+    if missing:
+        gap = None
+        for frame in expected:
+            if frame in missing:
+                if gap is None:
+                    gap = [frame, frame, 0]
+                gap[1] = frame
+                gap[2] += 1
+            elif gap is not None:
+                gaps.append(tuple(gap))
+                gap = None
+        if gap is not None:
+            gaps.append(tuple(gap))
+
+    return {"missing": missing,
+            "duplicates": FrameSet(f for f in counts if counts[f] > 1),
+            "extra": found - expected,
+            "gaps": gaps}
+
+
+# ------------------------------------------------------------------------------
+def find_sequences(source,
+                   udim_identifier=None,
+                   parent_d=None):
     """
+    The inverse of expand_files: Given a directory (or a list of file names),
+    groups the files into sequences in a single pass. For example, a directory
+    holding:
+
+    render.0001.exr
+    render.0003.exr
+    render.0005.exr
+    render.0010.exr
+    tex_1001.0001.exr
+    tex_1001.0002.exr
+    tex_1002.0001.exr
+    tex_1002.0002.exr
+    readme.txt
+
+    is collapsed into two sequences: render.1-5x2,10####.exr and
+    tex_<UDIM>.1-2####.exr. Files that have no frame number (readme.txt) are
+    ignored, unless they have a UDIM tile.
+
+    The frame number is the last group of digits in the file name that has a
+    period before it (or is at the very start of the name) and a period after
+    it (or is at the very end of the name). This is the same rule that
+    find_frame_spec uses. A UDIM tile is a four digit number between 1001 and
+    9999 that has a period or underscore before it, and the period in front of
+    the frame number (or, for files with no frame number, the period in front
+    of the extension) right after it. Any other four digit number (a year, for
+    example) is just part of the name. Since a UDIM tile that is set off by
+    periods on both sides and is not followed by a frame number (tex.1001.tif)
+    looks just like a frame number, it is treated as one.
+
+    Every sequence's pattern expands (with expand_files) to exactly the files
+    it was built from. To keep it that way, the frames of each UDIM tile are
+    kept separately. Tiles are only collapsed into a single sequence with the
+    UDIM identifier if there is more than one of them and they all hold the
+    same frames. Otherwise each tile is returned as a sequence of its own, with
+    the tile number left in the prefix. Files with a UDIM tile but no frame
+    number are returned one per sequence (with their full name as the prefix),
+    since expand_files does not expand a UDIM identifier without a framespec.
+    Files with no extension (render.0001) are fine: their pattern ends in the
+    framespec (render.1-3####), which expand_files accepts.
+
+    Files with the same prefix and suffix but with frame numbers padded to a
+    different number of digits are returned as separate sequences. Only the
+    frame numbers (not the file names) are held in memory while scanning, and
+    the frames of each sequence are sorted once, without building a set.
+
+    :param source: Either the path to a directory to scan (sub-directories are
+           not scanned) or an iterable of file names.
+    :param udim_identifier: The string that will replace the UDIM tile in the
+           prefix of a sequence. If None, then the pattern "<UDIM>" will be
+           used. Defaults to None.
+    :param parent_d: The directory that the file names belong to when source
+           is an iterable of file names. Ignored if source is a directory.
+           Defaults to None.
+
+    :return: A list of FileSequence objects, sorted by prefix, suffix and
+             padding.
+    """
+
+    if udim_identifier is None:
+        udim_identifier = "<UDIM>"
+
+    if isinstance(source, str):
+        parent_d = source
+        assert os.path.isdir(parent_d)
+        files_n = (entry.name for entry in dircache.entries(parent_d)
+                   if entry.is_file)
+    else:
+        files_n = source
+
+    # Key: (prefix before the UDIM tile, prefix after the UDIM tile, suffix).
+    # The prefix after the tile is None if there is no tile. Value: A dict
+    # keyed on the width of the frame numbers that start with a zero (and so
+    # must be padded), 0 for those that do not, or None for files with no frame
+    # number. Each value is a list holding a dict of arrays of frames keyed on
+    # the UDIM tile (None if there is no tile), and the length of the shortest
+    # frame number.
+    groups = dict()
+
+    for file_n in files_n:
+
+        result = SEQUENCE_NAME_PATTERN.match(file_n)
+        if result:
+            prefix, digits, suffix = result.groups()
+            udim = UDIM_TOKEN_PATTERN.search(prefix)
+        else:
+            udim = UDIM_NAME_PATTERN.search(file_n)
+            if not udim:
+                continue
+            prefix, digits, suffix = file_n, None, ""
+
+        if udim:
+            tile = int(udim.group())
+            key = (prefix[:udim.start()], prefix[udim.end():], suffix)
+        else:
+            tile = None
+            key = (prefix, None, suffix)
+
+        if digits is None:
+            width = None
+        elif len(digits) > 1 and digits[0] == "0":
+            width = len(digits)
+        else:
+            width = 0
+
+        widths = groups.setdefault(key, dict())
+        try:
+            group = widths[width]
+        except KeyError:
+            group = [dict(), None]
+            widths[width] = group
+
+        try:
+            frames = group[0][tile]
+        except KeyError:
+            frames = array.array("l")
+            group[0][tile] = frames
+
+        if digits is not None:
+            frames.append(int(digits))
+            if group[1] is None or len(digits) < group[1]:
+                group[1] = len(digits)
 
     output = list()
-    missing = list()
 
-    parent_d, file_pattern_n = os.path.split(os.path.abspath(user_pattern))
+    for key, widths in groups.items():
+
+        # Frame numbers that are not zero padded (1000, 10000) also belong to a
+        # padded sequence (0998, 0999) as long as they are at least as long as
+        # the padding. Merge them into the widest padded sequence they fit.
+        if 0 in widths:
+            fits = [w for w in widths if w and w <= widths[0][1]]
+            if fits:
+                target = widths[max(fits)][0]
+                for tile, frames in widths[0][0].items():
+                    target.setdefault(tile, array.array("l")).extend(frames)
+                del widths[0]
+
+        for width, group in widths.items():
+
+            if width is None:
+                padding = None
+            else:
+                padding = max(width, 1)
+
+            output.extend(_tile_sequences(key, group[0], padding, parent_d,
+                                          udim_identifier))
+
+    output.sort(key=lambda sequence: (sequence.prefix,
+                                      sequence.suffix,
+                                      -1 if sequence.padding is None
+                                      else sequence.padding))
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def _tile_sequences(key,
+                    tiles,
+                    padding,
+                    parent_d,
+                    udim_identifier):
+    """
+    Builds the FileSequence objects for a single group of find_sequences. See
+    find_sequences for when the UDIM tiles are collapsed into one sequence.
+
+    :param key: The tuple of the prefix before the UDIM tile, the prefix after
+           it (None if there is no tile) and the suffix.
+    :param tiles: A dict of arrays of frames keyed on the UDIM tile.
+    :param padding: The padding of the frame numbers (None if there are none).
+    :param parent_d: The directory holding the files, or None.
+    :param udim_identifier: The string that replaces the UDIM tile.
+
+    :return: A list of FileSequence objects.
+    """
+
+    head, tail, suffix = key
+
+    frames = dict((tile, _frameset_from_unsorted(tile_frames))
+                  for tile, tile_frames in tiles.items())
+
+    if tail is None:
+        return [FileSequence(parent_d=parent_d,
+                             prefix=head,
+                             suffix=suffix,
+                             padding=padding,
+                             frames=frames[None],
+                             udims=[],
+                             udim_identifier=udim_identifier)]
+
+    first = next(iter(frames.values()))
+    if (padding is not None and len(frames) > 1
+            and all(tile_frames == first for tile_frames in frames.values())):
+        return [FileSequence(parent_d=parent_d,
+                             prefix=head + udim_identifier + tail,
+                             suffix=suffix,
+                             padding=padding,
+                             frames=first,
+                             udims=sorted(frames),
+                             udim_identifier=udim_identifier)]
+
+    return [FileSequence(parent_d=parent_d,
+                         prefix=head + str(tile) + tail,
+                         suffix=suffix,
+                         padding=padding,
+                         frames=frames[tile],
+                         udims=[tile],
+                         udim_identifier=udim_identifier)
+            for tile in sorted(frames)]
+
+
+# ------------------------------------------------------------------------------
+def _frameset_from_unsorted(frames):
+    """
+    Builds a FrameSet from an array of frames in any order (possibly with
+    duplicates). With NumPy the array is sorted without converting the frames
+    to Python integers. Otherwise it is sorted once and streamed into the runs,
+    skipping duplicates, without building a set.
+
+    :param frames: An array.array of frames.
+
+    :return: A FrameSet.
+    """
+
+    if numpy is not None:
+        values = numpy.frombuffer(frames, dtype="i" + str(frames.itemsize))
+        return _frameset_from_array(numpy.unique(values))
 
-    assert os.path.exists(parent_d)
-    assert os.path.isdir(parent_d)
+    return FrameSet._from_runs(_runs_from_frames(_unique_sorted(
+        sorted(frames))))
 
-    prefix, framespec, suffix = find_frame_spec(file_pattern_n)
 
-    if not framespec or not suffix:
-        frames = list()
+# ------------------------------------------------------------------------------
+def _unique_sorted(frames):
+    """
+    :param frames: A sorted iterable of frames.
+
+    :return: A generator that yields each frame once.
+    """
+
+    previous = None
+    for frame in frames:
+        if frame != previous:
+            yield frame
+            previous = frame
+
+
+# ------------------------------------------------------------------------------
+def _analyze_frames_numpy(expected,
+                          present):
+    """
+    The NumPy implementation of analyze_frames.
+
+    :param expected: A FrameSet of the frames that should exist.
+    :param present: See analyze_frames.
+
+    :return: See analyze_frames.
+    """
+
+    present = numpy.asarray(list(present)).astype(numpy.int64).ravel()
+
+    found, counts = numpy.unique(present, return_counts=True)
+
+    if expected:
+        expected_frames = numpy.concatenate(
+            [numpy.arange(start, end + 1, step, dtype=numpy.int64)
+             for start, end, step in expected.runs])
     else:
-        frames = expand_frame_spec(framespec)
+        expected_frames = numpy.zeros(0, dtype=numpy.int64)
+
+    is_missing = ~numpy.isin(expected_frames, found, assume_unique=True)
+
+    # Gaps start where a missing frame follows a found one (or the start) and
+    # end where a found frame follows a missing one (or the end).
+    edges = numpy.diff(numpy.concatenate(([0], is_missing.view(numpy.int8),
+                                          [0])))
+    gap_starts = numpy.flatnonzero(edges == 1)
+    gap_ends = numpy.flatnonzero(edges == -1) - 1
 
-    actual_padding = calc_padding(frames, framespec, padding)
+    gaps = list()
+    for first, last in zip(gap_starts.tolist(), gap_ends.tolist()):
+        gaps.append((int(expected_frames[first]),
+                     int(expected_frames[last]),
+                     last - first + 1))
 
-    prefix_pattern = seq_and_udim_ids_to_regex(prefix,
-                                               match_hash_length,
-                                               udim_identifier,
-                                               strict_udim_format)
+    extra = numpy.setdiff1d(found, expected_frames, assume_unique=True)
 
-    suffix_pattern = seq_and_udim_ids_to_regex(suffix,
-                                               match_hash_length,
-                                               udim_identifier,
-                                               strict_udim_format)
+    return {"missing": _frameset_from_array(expected_frames[is_missing]),
+            "duplicates": _frameset_from_array(found[counts > 1]),
+            "extra": _frameset_from_array(extra),
+            "gaps": gaps}
 
-    files_n = os.listdir(parent_d)
 
-    if frames:
+# ------------------------------------------------------------------------------
+def _frameset_from_array(frames):
+    """
+    Builds a FrameSet from a sorted NumPy array of unique frames without
+    looping over the frames in Python. Only the runs of consecutive frames are
+    handed to the FrameSet, which then merges them further.
+
+    :param frames: A sorted NumPy array of unique frames.
+
+    :return: A FrameSet.
+    """
+
+    if not len(frames):
+        return FrameSet()
+
+    breaks = numpy.flatnonzero(numpy.diff(frames) != 1) + 1
+    starts = frames[numpy.concatenate(([0], breaks))].tolist()
+    ends = frames[numpy.concatenate((breaks - 1, [len(frames) - 1]))].tolist()
+
+    return FrameSet._from_runs([_make_run(start, end, 1)
+                                for start, end in zip(starts, ends)])
+
+
+# ==============================================================================
+class _PatternMatch(object):
+    """
+    Holds everything needed to match the files in a directory against a single
+    user pattern (as given to expand_files), and collects the matches.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self,
+                 user_pattern,
+                 padding,
+                 udim_identifier,
+                 strict_udim_format,
+                 match_hash_length):
+        """
+        Setup. See expand_files for a description of the arguments.
+
+        :return: Nothing.
+        """
 
-        for frame in frames:
+        self.padding = padding
 
-            matched = False
+        parent_d, file_pattern_n = os.path.split(os.path.abspath(user_pattern))
 
-            if not padding:
-                frame_pattern = "0*" + str(frame)
+        assert os.path.exists(parent_d)
+        assert os.path.isdir(parent_d)
+
+        self.parent_d = parent_d
+        self.file_pattern_n = file_pattern_n
+
+        prefix, framespec, suffix = find_frame_spec(file_pattern_n)
+
+        # A file name with no extension may still end in a framespec
+        # (render.1-3####), but a bare number there (notes.2) is read as part
+        # of a literal file name.
+        if not framespec or (not suffix and framespec.isdigit()):
+            self.frames = FrameSet()
+        else:
+            self.frames = expand_frame_spec(framespec, as_frameset=True)
+
+        self.actual_padding = calc_padding(self.frames, framespec, padding)
+
+        prefix_pattern = seq_and_udim_ids_to_regex(prefix,
+                                                   match_hash_length,
+                                                   udim_identifier,
+                                                   strict_udim_format,
+                                                   "prefix_udim")
+
+        suffix_pattern = seq_and_udim_ids_to_regex(suffix,
+                                                   match_hash_length,
+                                                   udim_identifier,
+                                                   strict_udim_format,
+                                                   "suffix_udim")
+
+        self.matcher = _compile_frame_matcher(prefix_pattern, suffix_pattern)
+
+        # The literal text at the start of every matching file name.
+        if udim_identifier is None:
+            udim_identifier = "<UDIM>"
+        self.literal = prefix.split(udim_identifier, 1)[0]
+        result = SEQ_ID_START_PATTERN.search(self.literal)
+        if result:
+            self.literal = self.literal[:result.start()]
+
+        # Frame number -> list of (file name, UDIM tile) tuples.
+        self.index = None
+
+    # --------------------------------------------------------------------------
+    def add_file(self, file_n):
+        """
+        Tests a single file name and adds it to the index if it matches.
+
+        :param file_n: The file name to test.
+
+        :return: A set of the frames that the file was indexed under.
+        """
+
+        frames = set()
+
+        for digits, tile in _frame_numbers_in_file(file_n, self.matcher):
+            frame = int(digits)
+            if (self.padding and
+                    digits != str(frame).rjust(self.actual_padding, "0")):
+                continue
+            if frame in frames:
+                continue
+            frames.add(frame)
+            self.index.setdefault(frame, []).append((file_n, tile))
+
+        return frames
+
+    # --------------------------------------------------------------------------
+    def remove_file(self, file_n):
+        """
+        Removes a single file name from the index (if it was matched).
+
+        :param file_n: The file name to remove.
+
+        :return: A set of the frames that the file was indexed under.
+        """
+
+        output = set()
+
+        for digits, tile in _frame_numbers_in_file(file_n, self.matcher):
+            frame = int(digits)
+            matches = self.index.get(frame)
+            if not matches:
+                continue
+            remaining = [match for match in matches if match[0] != file_n]
+            if len(remaining) == len(matches):
+                continue
+            output.add(frame)
+            if remaining:
+                self.index[frame] = remaining
             else:
-                frame_pattern = str(frame).rjust(actual_padding, "0")
+                del self.index[frame]
 
-            pattern = prefix_pattern + frame_pattern + suffix_pattern
+        return output
 
-            for file_n in files_n:
+    # --------------------------------------------------------------------------
+    def results(self):
+        """
+        :return: The tuple of matching files and missing frames, in the same
+                 format as returned by expand_files.
+        """
 
-                if re.match(pattern, file_n):
-                    output.append(os.path.join(parent_d, file_n))
-                    matched = True
+        output = list()
+        missing = list()
 
-            if not matched:
-                missing.append(frame)
+        if self.frames:
 
-    else:
+            for frame in self.frames:
+                try:
+                    for file_n, tile in self.index[frame]:
+                        output.append(os.path.join(self.parent_d, file_n))
+                except KeyError:
+                    missing.append(str(frame).rjust(self.actual_padding, "0"))
+
+        else:
 
-        output = [os.path.join(parent_d, file_pattern_n)]
+            output = [os.path.join(self.parent_d, self.file_pattern_n)]
 
-    missing.sort()
-    for i in range(len(missing)):
-        missing[i] = str(missing[i]).rjust(actual_padding, "0")
+        output.sort()
+        return output, missing
+
+    # --------------------------------------------------------------------------
+    def structured_results(self):
+        """
+        :return: The tuple of matching files (keyed on UDIM tile, then frame)
+                 and missing frames, in the same format as returned by
+                 expand_files when structured is True.
+        """
+
+        output = dict()
+
+        if self.frames:
+
+            for frame, matches in self.index.items():
+                if frame not in self.frames:
+                    continue
+                for file_n, tile in matches:
+                    file_p = os.path.join(self.parent_d, file_n)
+                    frames = output.setdefault(tile, dict())
+                    frames.setdefault(frame, []).append(file_p)
+
+        else:
 
-    output.sort()
-    return output, missing
+            file_p = os.path.join(self.parent_d, self.file_pattern_n)
+            output[None] = {None: [file_p]}
+
+        return output, self._padded_missing()
+
+    # --------------------------------------------------------------------------
+    def _padded_missing(self):
+        """
+        :return: A sorted list of the frames that had no matching files, padded
+                 to the actual padding.
+        """
+
+        missing = list()
+
+        if self.frames:
+            for start, end, step in self.frames.runs:
+                for frame in range(start, end + 1, step):
+                    if frame not in self.index:
+                        missing.append(str(frame).rjust(self.actual_padding,
+                                                        "0"))
+
+        return missing
+
+
+# ------------------------------------------------------------------------------
+@cache.memoize(PATTERN_CACHE)
+def _parse_frame_spec(framespec):
+    """
+    Memoized parsing of a framespec into a FrameSet. Safe to share between
+    callers since a FrameSet is immutable.
+
+    :param framespec: The framespec string (or a FrameSet).
+
+    :return: A FrameSet.
+    """
+
+    return FrameSet(framespec)
+
+
+# ------------------------------------------------------------------------------
+@cache.memoize(PATTERN_CACHE)
+def _compile_frame_matcher(prefix_pattern,
+                           suffix_pattern):
+    """
+    Given the regex patterns for the portion of a file name before and after a
+    framespec (as returned by seq_and_udim_ids_to_regex), compile a single
+    pattern that captures the frame number in between.
+
+    If the prefix pattern contains an open ended (.*) UDIM pattern, the same
+    file name may be matched with the frame number in more than one position.
+    In that case the matcher is flagged as ambiguous and every possible position
+    is tested individually (see _frame_numbers_in_file).
+
+    :param prefix_pattern: The regex pattern for the text before the framespec.
+    :param suffix_pattern: The regex pattern for the text after the framespec.
+
+    :return: A tuple containing four items: The compiled pattern with a named
+             group (frame) for the frame number, whether the matcher is
+             ambiguous, the compiled prefix pattern (anchored to the end), and
+             the compiled suffix pattern. The last two are only used when the
+             matcher is ambiguous.
+    """
+
+    compiled_pattern = re.compile(prefix_pattern + r"(?P<frame>\d+)" +
+                                  suffix_pattern)
+
+    ambiguous = ".*" in prefix_pattern
+
+    compiled_prefix = re.compile(r"(?:" + prefix_pattern + r")\Z")
+    compiled_suffix = re.compile(suffix_pattern)
+
+    return compiled_pattern, ambiguous, compiled_prefix, compiled_suffix
+
+
+# ------------------------------------------------------------------------------
+def _frame_numbers_in_file(file_n,
+                           matcher):
+    """
+    Returns the frame numbers that a file name matches, given a matcher built
+    by _compile_frame_matcher. Normally this is a single item. If the matcher
+    is ambiguous, the file may match at more than one position and so may
+    return more than one item.
+
+    :param file_n: The file name to test.
+    :param matcher: The matcher tuple built by _compile_frame_matcher.
+
+    :return: A list of tuples, each holding the digit string of the frame (as
+             it appears in the file name) and the UDIM tile as an integer (or
+             None if there is no UDIM). Empty if the file does not match.
+    """
+
+    compiled_pattern, ambiguous, compiled_prefix, compiled_suffix = matcher
+
+    result = compiled_pattern.match(file_n)
+    if not result:
+        return []
+
+    if not ambiguous:
+        return [(result.group("frame"), _udim_tile(result))]
+
+    output = list()
+    for digits in DIGITS_PATTERN.finditer(file_n):
+        prefix_result = compiled_prefix.match(file_n, 0, digits.start())
+        if not prefix_result:
+            continue
+        suffix_result = compiled_suffix.match(file_n, digits.end())
+        if not suffix_result:
+            continue
+        tile = _udim_tile(prefix_result)
+        if tile is None:
+            tile = _udim_tile(suffix_result)
+        output.append((digits.group(), tile))
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def _udim_tile(result):
+    """
+    Extracts the UDIM tile from a match against a pattern built with the
+    prefix_udim and/or suffix_udim groups.
+
+    :param result: The regex match object.
+
+    :return: The UDIM tile as an integer, or None if there was no UDIM.
+    """
+
+    groups = result.groupdict()
+    tile = groups.get("prefix_udim") or groups.get("suffix_udim")
+    if tile is None:
+        return None
+    return int(tile[:4])
+
+
+# ------------------------------------------------------------------------------
+def _frame_spec_runs(framespec):
+    """
+    Parses a framespec into a list of runs. The runs are not merged and may
+    overlap.
+
+    :param framespec: The framespec string.
+
+    :return: A list of (start, end, step) tuples with a positive step.
+    """
+
+    output = list()
+
+    for subspec in framespec.split(","):
+
+        for matches in FRAME_RANGE_PATTERN.finditer(subspec):
+
+            start, end, step = matches.groups()
+
+            start = int(start)
+
+            if not end:
+                end = start
+            else:
+                end = int(end)
+
+            if not step:
+                step = 1
+            else:
+                step = int(step)
+
+            if step == 0:
+                raise ValueError("Framespec step may not be zero: " + framespec)
+
+            count = (end - start) // step + 1
+            if count <= 0:
+                continue
+
+            last = start + (count - 1) * step
+            if step > 0:
+                output.append(_make_run(start, last, step))
+            else:
+                output.append(_make_run(last, start, -step))
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def _make_run(start,
+              end,
+              step):
+    """
+    Builds a run tuple, normalizing single frame runs to a step of 1.
+
+    :param start: The first frame of the run.
+    :param end: The last frame of the run. Must be a member of the run.
+    :param step: The step between frames. Must be positive.
+
+    :return: A (start, end, step) tuple.
+    """
+
+    if start == end:
+        return start, end, 1
+    return start, end, step
+
+
+# ------------------------------------------------------------------------------
+def _run_count(run):
+    """
+    :param run: A (start, end, step) tuple.
+
+    :return: The number of frames in the run.
+    """
+
+    return (run[1] - run[0]) // run[2] + 1
+
+
+# ------------------------------------------------------------------------------
+def _run_contains(run,
+                  frame):
+    """
+    :param run: A (start, end, step) tuple.
+    :param frame: The frame number to test.
+
+    :return: True if the frame is a member of the run.
+    """
+
+    start, end, step = run
+    return start <= frame <= end and (frame - start) % step == 0
+
+
+# ------------------------------------------------------------------------------
+def _clip_run(run,
+              low,
+              high):
+    """
+    Limits a run to the frames that fall between low and high (inclusive).
+
+    :param run: A (start, end, step) tuple.
+    :param low: The lowest frame to keep.
+    :param high: The highest frame to keep.
+
+    :return: A new run, or None if no frames fall in the range.
+    """
+
+    start, end, step = run
+
+    first = start
+    if first < low:
+        first += ((low - start + step - 1) // step) * step
+
+    last = end
+    if last > high:
+        last = start + ((high - start) // step) * step
+
+    if first > last:
+        return None
+
+    return _make_run(first, last, step)
+
+
+# ------------------------------------------------------------------------------
+def _gcd(a,
+         b):
+    """
+    :return: The greatest common divisor of a and b.
+    """
+
+    while b:
+        a, b = b, a % b
+    return a
+
+
+# ------------------------------------------------------------------------------
+def _intersect_run_pair(run_a,
+                        run_b):
+    """
+    Intersects two runs. The intersection of two runs is always a run itself
+    (with a step of the least common multiple of the two steps).
+
+    :param run_a: A (start, end, step) tuple.
+    :param run_b: A (start, end, step) tuple.
+
+    :return: The run that holds the frames common to both, or None if there are
+             none.
+    """
+
+    start_a, end_a, step_a = run_a
+    start_b, end_b, step_b = run_b
+
+    low = max(start_a, start_b)
+    high = min(end_a, end_b)
+    if low > high:
+        return None
+
+    gcd = _gcd(step_a, step_b)
+    diff = start_b - start_a
+    if diff % gcd:
+        return None
+
+    # Solve start_a + step_a * t == start_b (mod step_b) for t.
+    modulus = step_b // gcd
+    t = 0
+    if modulus > 1:
+        t = (diff // gcd) * _mod_inverse((step_a // gcd) % modulus, modulus)
+        t %= modulus
+
+    step = step_a // gcd * step_b
+    first = start_a + step_a * t
+    first += ((low - first + step - 1) // step) * step
+    if first > high:
+        return None
+
+    last = first + ((high - first) // step) * step
+    return _make_run(first, last, step)
+
+
+# ------------------------------------------------------------------------------
+def _mod_inverse(value,
+                 modulus):
+    """
+    :return: The modular inverse of value (which must be coprime to modulus).
+    """
+
+    old_r, r = value, modulus
+    old_s, s = 1, 0
+    while r:
+        quotient = old_r // r
+        old_r, r = r, old_r - quotient * r
+        old_s, s = s, old_s - quotient * s
+    return old_s % modulus
+
+
+# ------------------------------------------------------------------------------
+def _run_is_subset(run_a,
+                   run_b):
+    """
+    :return: True if every frame of run_a is also in run_b.
+    """
+
+    if not _run_contains(run_b, run_a[0]) or not _run_contains(run_b, run_a[1]):
+        return False
+    return run_a[0] == run_a[1] or run_a[2] % run_b[2] == 0
+
+
+# ------------------------------------------------------------------------------
+def _runs_from_frames(frames):
+    """
+    Builds canonical runs from a sorted iterable of unique frames in a single
+    pass, holding no more than three frames at a time (see _canonical_runs for
+    the rules).
+
+    :param frames: A sorted iterable of unique frames.
+
+    :return: A list of canonical (start, end, step) tuples.
+    """
+
+    output = list()
+    pending = list()
+    run = None
+
+    for frame in frames:
+
+        if run:
+            if frame - run[1] == run[2]:
+                run[1] = frame
+                continue
+            output.append(tuple(run))
+            run = None
+
+        pending.append(frame)
+        if len(pending) == 3:
+            if pending[1] - pending[0] == pending[2] - pending[1]:
+                run = [pending[0], pending[2], pending[1] - pending[0]]
+                pending = list()
+            else:
+                output.append((pending[0], pending[0], 1))
+                pending = pending[1:]
+
+    if run:
+        output.append(tuple(run))
+    for frame in pending:
+        output.append((frame, frame, 1))
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def _combine_run_pair(run_a,
+                      run_b,
+                      operation):
+    """
+    Performs a set operation on two runs that cover the same range of frames.
+    Either run may be None (empty).
+
+    :param run_a: A (start, end, step) tuple or None.
+    :param run_b: A (start, end, step) tuple or None.
+    :param operation: One of "union", "intersection" or "difference".
+
+    :return: A list of sorted, non-overlapping runs.
+    """
+
+    if operation == "intersection":
+        if run_a is None or run_b is None:
+            return []
+        common = _intersect_run_pair(run_a, run_b)
+        return [common] if common else []
+
+    if operation == "union":
+        if run_a is None:
+            return [run_b]
+        if run_b is None or _run_is_subset(run_b, run_a):
+            return [run_a]
+        if _run_is_subset(run_a, run_b):
+            return [run_b]
+
+        # Two runs of the same step, offset by half a step (1-9x2 and 2-10x2).
+        if run_a[2] == run_b[2] and run_a[2] % 2 == 0:
+            merged = _make_run(min(run_a[0], run_b[0]),
+                               max(run_a[1], run_b[1]),
+                               run_a[2] // 2)
+            count = _run_count(run_a) + _run_count(run_b)
+            if (_run_is_subset(run_a, merged) and
+                    _run_is_subset(run_b, merged) and
+                    _run_count(merged) == count):
+                return [merged]
+
+        frames = sorted(set(range(run_a[0], run_a[1] + 1, run_a[2])) |
+                        set(range(run_b[0], run_b[1] + 1, run_b[2])))
+        return _runs_from_frames(frames)
+
+    # Difference
+    if run_a is None:
+        return []
+    if run_b is None:
+        return [run_a]
+
+    common = _intersect_run_pair(run_a, run_b)
+    if common is None:
+        return [run_a]
+    if _run_count(common) == _run_count(run_a):
+        return []
+
+    start, end, step = run_a
+    if common[2] == 2 * step:
+        first = start + step if _run_contains(common, start) else start
+        last = end - step if _run_contains(common, end) else end
+        return [_make_run(first, last, 2 * step)]
+
+    frames = range(start, end + 1, step)
+    return _runs_from_frames(f for f in frames if not _run_contains(common, f))
+
+
+# ------------------------------------------------------------------------------
+def _combine_runs(runs_a,
+                  runs_b,
+                  operation):
+    """
+    Performs a set operation on two lists of sorted, non-overlapping runs. The
+    frame range is cut into segments at the start and end of every run so that
+    each segment holds at most one run from each list. The operation is then
+    performed segment by segment.
+
+    :param runs_a: The first list of runs.
+    :param runs_b: The second list of runs.
+    :param operation: One of "union", "intersection" or "difference".
+
+    :return: A list of sorted, non-overlapping runs (not yet canonical).
+    """
+
+    bounds = set()
+    for start, end, step in runs_a:
+        bounds.add(start)
+        bounds.add(end + 1)
+    for start, end, step in runs_b:
+        bounds.add(start)
+        bounds.add(end + 1)
+    bounds = sorted(bounds)
+
+    output = list()
+    i_a = 0
+    i_b = 0
+
+    for i in range(len(bounds) - 1):
+
+        low = bounds[i]
+        high = bounds[i + 1] - 1
+
+        while i_a < len(runs_a) and runs_a[i_a][1] < low:
+            i_a += 1
+        while i_b < len(runs_b) and runs_b[i_b][1] < low:
+            i_b += 1
+
+        run_a = None
+        if i_a < len(runs_a):
+            run_a = _clip_run(runs_a[i_a], low, high)
+        run_b = None
+        if i_b < len(runs_b):
+            run_b = _clip_run(runs_b[i_b], low, high)
+
+        if run_a is None and run_b is None:
+            continue
+
+        output.extend(_combine_run_pair(run_a, run_b, operation))
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def _union_all_runs(runs):
+    """
+    Merges a list of possibly overlapping runs.
+
+    :param runs: A list of (start, end, step) tuples in any order.
+
+    :return: A list of sorted, non-overlapping runs (not yet canonical).
+    """
+
+    output = list()
+
+    for run in sorted(runs):
+
+        # Runs are visited in order of their start, so only the tail of the
+        # output can overlap the new run.
+        i = len(output)
+        while i > 0 and output[i - 1][1] >= run[0]:
+            i -= 1
+
+        if i == len(output):
+            output.append(run)
+        else:
+            output[i:] = _combine_runs(output[i:], [run], "union")
+
+    return output
+
+
+# ------------------------------------------------------------------------------
+def _next_frame(runs,
+                i,
+                frame):
+    """
+    Given a frame in runs[i], finds the next frame in a list of runs.
+
+    :return: A tuple of the index of the run and the next frame, or None if
+             there are no more frames.
+    """
+
+    start, end, step = runs[i]
+    if frame + step <= end:
+        return i, frame + step
+    if i + 1 < len(runs):
+        return i + 1, runs[i + 1][0]
+    return None
+
+
+# ------------------------------------------------------------------------------
+def _canonical_runs(runs):
+    """
+    Rebuilds a list of sorted, non-overlapping runs into their canonical form:
+    Starting with the lowest frame, each run is extended for as long as the
+    frames continue with the same step. A run must contain at least three
+    frames, otherwise its first frame becomes a run of its own. The frames are
+    never expanded. Whole runs are skipped over at once.
+
+    :param runs: A list of sorted, non-overlapping (start, end, step) tuples.
+
+    :return: A list of canonical runs.
+    """
+
+    output = list()
+    if not runs:
+        return output
+
+    i, frame = 0, runs[0][0]
+
+    while True:
+
+        following = _next_frame(runs, i, frame)
+        if following is None:
+            output.append((frame, frame, 1))
+            return output
+
+        j, next_frame = following
+        step = next_frame - frame
+
+        k, last, count = j, next_frame, 2
+        while True:
+            start, end, run_step = runs[k]
+            if run_step == step and end > last:
+                count += (end - last) // step
+                last = end
+            following = _next_frame(runs, k, last)
+            if following is None or following[1] - last != step:
+                break
+            k, last = following
+            count += 1
+
+        if count >= 3:
+            output.append((frame, last, step))
+            following = _next_frame(runs, k, last)
+            if following is None:
+                return output
+            i, frame = following
+        else:
+            output.append((frame, frame, 1))
+            i, frame = j, next_frame
@@ -0,0 +1,362 @@
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from bvzlib import cache
+from bvzlib import dircache
+
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS hashes (
+        dev INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        algorithm TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        digest BLOB NOT NULL,
+        PRIMARY KEY (dev, ino, algorithm)
+    );
+"""
+
+# The cache in use, or None if caching is disabled (the default).
+_ACTIVE_CACHE = None
+
+
+# ==============================================================================
+class HashCache(object):
+    """
+    A cache of file checksums, keyed on the device, inode, size and
+    modification time of each file. As long as none of these have changed, the
+    checksum is returned without reading the file. Checksums are held in a
+    bounded in-memory cache and, optionally, in a SQLite database on disk that
+    can be shared by several processes (and survives between them).
+
+    Files modified within the last dircache.RACY_SECONDS are never cached,
+    since they could be modified again without their modification time
+    changing.
+
+    Note: Like any cache keyed on the modification time, this can be fooled by
+    a program that rewrites a file and then restores its old modification time.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self,
+                 maxsize=4096,
+                 db_p=None,
+                 timeout=60.0):
+        """
+        Setup.
+
+        :param maxsize: The maximum number of checksums to hold in memory.
+               Defaults to 4096.
+        :param db_p: The path to a SQLite database to also store the checksums
+               in. It is created if it does not exist. If None, checksums are
+               only held in memory. Defaults to None.
+        :param timeout: How many seconds to wait for another process that is
+               writing to the database before giving up. Defaults to 60.
+
+        :return: Nothing.
+        """
+
+        self._memory = cache.LRUCache(maxsize, count=False)
+        self._lock = threading.Lock()
+        self.db_p = db_p
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+
+        self._connection = None
+        if db_p is not None:
+            self._connection = sqlite3.connect(db_p,
+                                               timeout=timeout,
+                                               check_same_thread=False)
+            with self._connection:
+                self._connection.executescript(SCHEMA)
+
+    # --------------------------------------------------------------------------
+    def close(self):
+        """
+        Closes the on-disk database (if any). The in-memory cache is kept.
+
+        :return: Nothing.
+        """
+
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    # --------------------------------------------------------------------------
+    def _count(self, counter):
+        """
+        Increments one of the counters.
+
+        :param counter: The name of the counter to increment.
+
+        :return: Nothing.
+        """
+
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    # --------------------------------------------------------------------------
+    def get(self,
+            stat,
+            algorithm):
+        """
+        Looks up the checksum of a file.
+
+        :param stat: The stat result of the file.
+        :param algorithm: The name of the checksum algorithm (i.e. "md5").
+
+        :return: The cached checksum, or None if there is no valid checksum.
+        """
+
+        key = (stat.st_dev, stat.st_ino, algorithm)
+        validator = (stat.st_size, dircache.mtime_ns(stat))
+
+        cached = self._memory.get(key)
+        if cached is not None and cached[0] == validator:
+            self._count("memory_hits")
+            return cached[1]
+
+        if self._connection is not None:
+            with self._lock:
+                row = self._connection.execute(
+                    "SELECT size, mtime_ns, digest FROM hashes "
+                    "WHERE dev = ? AND ino = ? AND algorithm = ?",
+                    key).fetchone()
+            if row is not None and tuple(row[:2]) == validator:
+                digest = bytes(row[2])
+                self._memory.set(key, (validator, digest))
+                self._count("disk_hits")
+                return digest
+
+        self._count("misses")
+        return None
+
+    # --------------------------------------------------------------------------
+    def set(self,
+            stat,
+            algorithm,
+            digest):
+        """
+        Stores the checksum of a file, unless the file was modified too
+        recently for its modification time to be trusted.
+
+        :param stat: The stat result of the file (taken before it was read).
+        :param algorithm: The name of the checksum algorithm (i.e. "md5").
+        :param digest: The checksum.
+
+        :return: Nothing.
+        """
+
+        if time.time() - stat.st_mtime < dircache.RACY_SECONDS:
+            self._count("uncacheable")
+            return
+
+        key = (stat.st_dev, stat.st_ino, algorithm)
+        validator = (stat.st_size, dircache.mtime_ns(stat))
+
+        self._memory.set(key, (validator, digest))
+
+        if self._connection is not None:
+            with self._lock:
+                with self._connection:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO hashes "
+                        "(dev, ino, algorithm, size, mtime_ns, digest) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        key + validator + (sqlite3.Binary(digest),))
+
+    # --------------------------------------------------------------------------
+    def digest(self,
+               file_p,
+               algorithm,
+               func,
+               *args):
+        """
+        Returns the checksum of a file from the cache, or calculates (and
+        caches) it.
+
+        :param file_p: The path to the file.
+        :param algorithm: The name of the checksum algorithm (i.e. "md5").
+        :param func: The function that calculates the checksum. It is called
+               with file_p followed by args.
+        :param args: Any additional arguments to pass to func.
+
+        :return: The checksum.
+        """
+
+        stat = os.stat(file_p)
+
+        output = self.get(stat, algorithm)
+        if output is None:
+            output = func(file_p, *args)
+            self.set_if_unchanged(file_p, stat, algorithm, output)
+
+        return output
+
+    # --------------------------------------------------------------------------
+    def set_if_unchanged(self,
+                         file_p,
+                         stat,
+                         algorithm,
+                         digest):
+        """
+        Stores the checksum of a file, but only if the file did not change
+        while it was being read.
+
+        :param file_p: The path to the file.
+        :param stat: The stat result of the file taken before it was read.
+        :param algorithm: The name of the checksum algorithm (i.e. "md5").
+        :param digest: The checksum.
+
+        :return: Nothing.
+        """
+
+        try:
+            after = os.stat(file_p)
+        except OSError:
+            return
+
+        if (after.st_ino, after.st_size, dircache.mtime_ns(after)) == (
+                stat.st_ino, stat.st_size, dircache.mtime_ns(stat)):
+            self.set(stat, algorithm, digest)
+
+    # --------------------------------------------------------------------------
+    def clear(self):
+        """
+        Empties the in-memory cache and the on-disk database.
+
+        :return: Nothing.
+        """
+
+        self._memory.clear()
+        if self._connection is not None:
+            with self._lock:
+                with self._connection:
+                    self._connection.execute("DELETE FROM hashes")
+
+    # --------------------------------------------------------------------------
+    def stats(self):
+        """
+        :return: A dictionary with the number of memory hits, disk hits,
+                 misses, checksums that were too recent to cache, and the
+                 current and maximum number of checksums held in memory.
+        """
+
+        with self._lock:
+            return {"memory_hits": self.memory_hits,
+                    "disk_hits": self.disk_hits,
+                    "misses": self.misses,
+                    "uncacheable": self.uncacheable,
+                    "size": len(self._memory),
+                    "maxsize": self._memory.maxsize}
+
+
+# ------------------------------------------------------------------------------
+def enable(maxsize=4096,
+           db_p=None):
+    """
+    Turns on checksum caching for every function in bvzlib that checksums
+    files. Replaces any cache that is already active.
+
+    :param maxsize: The maximum number of checksums to hold in memory.
+           Defaults to 4096.
+    :param db_p: The path to a SQLite database to also store the checksums in.
+           If None, checksums are only held in memory. Defaults to None.
+
+    :return: The active HashCache.
+    """
+
+    global _ACTIVE_CACHE
+
+    if _ACTIVE_CACHE is not None:
+        _ACTIVE_CACHE.close()
+    _ACTIVE_CACHE = HashCache(maxsize, db_p)
+
+    return _ACTIVE_CACHE
+
+
+# ------------------------------------------------------------------------------
+def disable():
+    """
+    Turns off checksum caching and discards the in-memory cache. The on-disk
+    database (if any) is closed but not deleted.
+
+    :return: Nothing.
+    """
+
+    global _ACTIVE_CACHE
+
+    if _ACTIVE_CACHE is not None:
+        _ACTIVE_CACHE.close()
+    _ACTIVE_CACHE = None
+
+
+# ------------------------------------------------------------------------------
+def active_cache():
+    """
+    :return: The active HashCache, or None if caching is disabled.
+    """
+
+    return _ACTIVE_CACHE
+
+
+# ------------------------------------------------------------------------------
+def stats():
+    """
+    :return: The statistics of the active cache (see HashCache.stats), or None
+             if caching is disabled.
+    """
+
+    if _ACTIVE_CACHE is None:
+        return None
+    return _ACTIVE_CACHE.stats()
+
+
+# ------------------------------------------------------------------------------
+def digest(file_p,
+           algorithm,
+           func,
+           *args):
+    """
+    Checksums a file, using the cache if caching is enabled.
+
+    :param file_p: The path to the file.
+    :param algorithm: The name of the checksum algorithm (i.e. "md5").
+    :param func: The function that calculates the checksum. It is called with
+           file_p followed by args.
+    :param args: Any additional arguments to pass to func.
+
+    :return: The checksum.
+    """
+
+    if _ACTIVE_CACHE is None:
+        return func(file_p, *args)
+    return _ACTIVE_CACHE.digest(file_p, algorithm, func, *args)
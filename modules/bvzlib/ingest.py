@@ -0,0 +1,536 @@
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import concurrent.futures
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from bvzlib import filesystem
+
+
+# Passed down a queue to tell the stage reading it that there is no more work.
+_DONE = object()
+
+# How often (in seconds) the hash stage checks for new files while it is also
+# waiting on checksums.
+POLL_SECONDS = 0.01
+
+
+# ------------------------------------------------------------------------------
+def ingest_files(items,
+                 data_d,
+                 data_sizes=None,
+                 dedup_index=None,
+                 hash_workers=4,
+                 copy_workers=2,
+                 queue_size=64,
+                 ver_prefix="v",
+                 num_digits=4,
+                 do_verified_copy=False,
+                 algorithm="md5",
+                 link_mode="symlink"):
+    """
+    Stores many files in a de-duplicated data directory at once, just like
+    calling filesystem.copy_file_deduplicated on each of them. The work is split
+    into stages that run at the same time, connected by bounded queues:
+
+    1) A pool of threads checksums the source files.
+    2) A single thread looks each checksum up in the data directory.
+    3) A pool of threads copies the files that are not stored yet.
+    4) A single thread creates the links in the destination directories.
+
+    So while one file is being copied, the next ones are already being
+    checksummed, and so on. Sources with identical contents within the same
+    batch are only copied once: the first one is copied, and the rest are
+    linked to that copy.
+
+    An error with one file (of any kind, so that a stage can never stop
+    early and leave the others waiting) does not stop the others. It is
+    recorded in that file's entry in the manifest.
+
+    :param items: A list of (source path, destination dir, destination name)
+           tuples. The destination name may be None to use the source's name.
+    :param data_d: The directory where the actual files will be stored.
+    :param data_sizes: A dictionary of all the files in data_d keyed on file
+           size (see filesystem.dir_files_keyed_by_size), or any other mapping
+           of sizes to lists of paths with a get method (a SizeIndex, for
+           example). Files copied into data_d are added to it if it is a
+           dictionary. May be None if dedup_index is given.
+    :param dedup_index: An optional dedupindex.DedupIndex for data_d. If given,
+           it is used instead of data_sizes, and its algorithm is used.
+           Defaults to None.
+    :param hash_workers: The number of files to checksum at once. Defaults to
+           4.
+    :param copy_workers: The number of files to copy at once. Defaults to 2.
+    :param queue_size: The maximum number of files waiting between any two
+           stages. Defaults to 64.
+    :param ver_prefix: See filesystem.copy_file_deduplicated. Defaults to "v".
+    :param num_digits: See filesystem.copy_file_deduplicated. Defaults to 4.
+    :param do_verified_copy: See filesystem.copy_file_deduplicated. Defaults to
+           False.
+    :param algorithm: The hashlib algorithm used to compare files (when no
+           dedup_index is given). Defaults to "md5".
+    :param link_mode: How each destination points at its stored file:
+           "symlink", "hardlink" or "reflink" (see filesystem.link_data_file).
+           Defaults to "symlink".
+
+    :return: A dictionary with two keys. "files" is a list with a dictionary
+             for each item (in the same order as items) holding: "source_p",
+             "link_p" (the link created), "link_mode" (the kind of link that
+             was actually made), "data_p" (the stored file),
+             "size", "digest", "status" (one of "copied", "deduplicated" if
+             the contents were already in data_d, "collapsed" if an earlier
+             item in the batch had the same contents, or "error"), "error"
+             (the error message or None) and "timings" (the seconds spent in
+             each stage). "elapsed" is the total time in seconds.
+    """
+
+    assert os.path.exists(data_d)
+    assert os.path.isdir(data_d)
+    assert dedup_index is not None or hasattr(data_sizes, "get")
+    assert type(hash_workers) is int and hash_workers > 0
+    assert type(copy_workers) is int and copy_workers > 0
+    assert type(queue_size) is int and queue_size > 0
+    assert link_mode in filesystem.LINK_MODES
+
+    if dedup_index is not None:
+        algorithm = dedup_index.algorithm
+
+    pipeline = _Pipeline(data_d, data_sizes, dedup_index, queue_size,
+                         ver_prefix, num_digits, do_verified_copy, algorithm,
+                         link_mode)
+
+    return pipeline.run(items, hash_workers, copy_workers)
+
+
+# ==============================================================================
+class _Pipeline(object):
+    """
+    The state shared by the stages of a single call to ingest_files.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self,
+                 data_d,
+                 data_sizes,
+                 dedup_index,
+                 queue_size,
+                 ver_prefix,
+                 num_digits,
+                 do_verified_copy,
+                 algorithm,
+                 link_mode):
+        """
+        Setup. See ingest_files for a description of the arguments.
+
+        :return: Nothing.
+        """
+
+        self.data_d = data_d
+        self.data_sizes = data_sizes
+        self.dedup_index = dedup_index
+        self.ver_prefix = ver_prefix
+        self.num_digits = num_digits
+        self.do_verified_copy = do_verified_copy
+        self.algorithm = algorithm
+        self.link_mode = link_mode
+
+        self.hash_queue = queue.Queue(queue_size)
+        self.lookup_queue = queue.Queue(queue_size)
+        self.copy_queue = queue.Queue(queue_size)
+        self.link_queue = queue.Queue(queue_size)
+
+        # (size, digest) -> {"data_p": stored path or None while it is being
+        # copied, "error": error message or None, "waiters": [manifest entries
+        # waiting on the copy]}.
+        self.contents = dict()
+        self.lock = threading.Lock()
+        self.manifest = list()
+
+    # --------------------------------------------------------------------------
+    def run(self,
+            items,
+            hash_workers,
+            copy_workers):
+        """
+        Starts every stage, feeds the items in, and waits for all of them to
+        finish. If iterating over items raises an error, the items fed so far
+        are still finished before the error is raised.
+
+        :param items: See ingest_files.
+        :param hash_workers: See ingest_files.
+        :param copy_workers: See ingest_files.
+
+        :return: The manifest (see ingest_files).
+        """
+
+        start = time.time()
+
+        threads = list()
+        threads.append(threading.Thread(target=self.hash_stage,
+                                        args=(hash_workers,)))
+        threads.append(threading.Thread(target=self.lookup_stage,
+                                        args=(copy_workers,)))
+        for i in range(copy_workers):
+            threads.append(threading.Thread(target=self.copy_stage))
+        threads.append(threading.Thread(target=self.link_stage,
+                                        args=(copy_workers,)))
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+
+            for source_p, dest_d, dest_n in items:
+                if not dest_n:
+                    dest_n = os.path.split(source_p)[1]
+                entry = {"source_p": source_p,
+                         "dest_d": dest_d,
+                         "dest_n": dest_n,
+                         "link_p": None,
+                         "link_mode": None,
+                         "data_p": None,
+                         "size": None,
+                         "digest": None,
+                         "status": None,
+                         "error": None,
+                         "timings": dict()}
+                self.manifest.append(entry)
+                self.hash_queue.put(entry)
+
+        finally:
+
+            self.hash_queue.put(_DONE)
+            for thread in threads:
+                thread.join()
+
+        for entry in self.manifest:
+            del entry["dest_d"]
+            del entry["dest_n"]
+
+        return {"files": self.manifest, "elapsed": time.time() - start}
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def fail(entry,
+             err):
+        """
+        Records an error for an item.
+
+        :param entry: The manifest entry of the item.
+        :param err: The exception (or error message).
+
+        :return: Nothing.
+        """
+
+        entry["status"] = "error"
+        entry["error"] = str(err)
+
+    # --------------------------------------------------------------------------
+    def hash_stage(self,
+                   hash_workers):
+        """
+        Checksums the source files until told to stop. Runs in one thread,
+        which hands each file to a pool of hash_workers threads as soon as it
+        arrives, and passes each checksum on as soon as it is done (even while
+        waiting for more files to arrive).
+
+        :param hash_workers: The number of files to checksum at once.
+
+        :return: Nothing.
+        """
+
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=hash_workers)
+
+        # Future -> the entry it is checksumming.
+        pending = dict()
+        fed_all = False
+
+        def finish(entry, err=None):
+            entry["timings"]["hash"] = time.time() - entry["timings"]["hash"]
+            if err is None:
+                self.lookup_queue.put(entry)
+            else:
+                self.fail(entry, err)
+
+        try:
+
+            while not fed_all or pending:
+
+                # Take new files while there is room in the pool. Only block
+                # waiting for one if there is nothing else to do.
+                while not fed_all and len(pending) < hash_workers * 2:
+                    try:
+                        entry = self.hash_queue.get(block=not pending)
+                    except queue.Empty:
+                        break
+                    if entry is _DONE:
+                        fed_all = True
+                        break
+                    entry["timings"]["hash"] = time.time()
+                    try:
+                        entry["size"] = os.path.getsize(entry["source_p"])
+                    except Exception as err:
+                        finish(entry, err)
+                        continue
+                    future = executor.submit(filesystem.hash_file,
+                                             entry["source_p"],
+                                             self.algorithm)
+                    pending[future] = entry
+
+                if not pending:
+                    continue
+
+                # Until every file has arrived, wake up now and then to take
+                # in new ones.
+                done, not_done = concurrent.futures.wait(
+                    pending,
+                    timeout=None if fed_all else POLL_SECONDS,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    entry = pending.pop(future)
+                    try:
+                        entry["digest"] = future.result()
+                    except Exception as err:
+                        finish(entry, err)
+                        continue
+                    finish(entry)
+
+        except Exception as err:
+            # Fail everything that is still pending, and everything still to
+            # come, so that the caller is never left blocked on a full queue.
+            for future, entry in pending.items():
+                future.cancel()
+                finish(entry, err)
+            pending.clear()
+            while not fed_all:
+                entry = self.hash_queue.get()
+                if entry is _DONE:
+                    break
+                entry["timings"]["hash"] = time.time()
+                finish(entry, err)
+
+        finally:
+            executor.shutdown(wait=True)
+            self.lookup_queue.put(_DONE)
+
+    # --------------------------------------------------------------------------
+    def lookup_stage(self,
+                     copy_workers):
+        """
+        Finds out whether the contents of each file are already stored (or are
+        being copied for an earlier item in the batch). Runs in one thread.
+
+        :param copy_workers: The number of copy threads to stop once all the
+               lookups are done.
+
+        :return: Nothing.
+        """
+
+        while True:
+
+            entry = self.lookup_queue.get()
+            if entry is _DONE:
+                break
+
+            start = time.time()
+            key = (entry["size"], entry["digest"])
+
+            with self.lock:
+                contents = self.contents.get(key)
+                if contents is not None:
+                    entry["status"] = "collapsed"
+                    if contents["data_p"] is None and contents["error"] is None:
+                        contents["waiters"].append(entry)
+                        entry["timings"]["lookup"] = time.time() - start
+                        continue
+
+            if contents is not None:
+                entry["timings"]["lookup"] = time.time() - start
+                self.release(entry, contents)
+                continue
+
+            try:
+                data_p = self.find_stored(entry)
+            except Exception as err:
+                self.fail(entry, err)
+                continue
+            finally:
+                entry["timings"]["lookup"] = time.time() - start
+
+            with self.lock:
+                self.contents[key] = {"data_p": data_p,
+                                      "error": None,
+                                      "waiters": list()}
+
+            if data_p is None:
+                self.copy_queue.put(entry)
+            else:
+                entry["status"] = "deduplicated"
+                entry["data_p"] = data_p
+                self.link_queue.put(entry)
+
+        for i in range(copy_workers):
+            self.copy_queue.put(_DONE)
+
+    # --------------------------------------------------------------------------
+    def find_stored(self,
+                    entry):
+        """
+        Looks for a file in data_d with the same contents as an item.
+
+        :param entry: The manifest entry of the item.
+
+        :return: The path to the stored file, or None.
+        """
+
+        if self.dedup_index is not None:
+            return self.dedup_index.lookup(entry["size"], entry["digest"])
+
+        with self.lock:
+            candidates_p = list(self.data_sizes.get(entry["size"], list()))
+
+        matched_p, digest = filesystem.find_duplicate_file(
+            entry["source_p"], candidates_p, self.algorithm,
+            digest=entry["digest"])
+
+        return matched_p
+
+    # --------------------------------------------------------------------------
+    def release(self,
+                entry,
+                contents):
+        """
+        Sends an item whose contents were stored (or failed to be stored) for
+        an earlier item on to the link stage.
+
+        :param entry: The manifest entry of the item.
+        :param contents: The dictionary describing the stored contents.
+
+        :return: Nothing.
+        """
+
+        if contents["error"] is not None:
+            self.fail(entry, contents["error"])
+            return
+
+        entry["data_p"] = contents["data_p"]
+        self.link_queue.put(entry)
+
+    # --------------------------------------------------------------------------
+    def copy_stage(self):
+        """
+        Copies files into data_d until told to stop. Runs in several threads.
+
+        :return: Nothing.
+        """
+
+        while True:
+
+            entry = self.copy_queue.get()
+            if entry is _DONE:
+                self.link_queue.put(_DONE)
+                return
+
+            start = time.time()
+            data_p = None
+            error = None
+
+            try:
+                data_p = filesystem.copy_and_add_ver_num(
+                    source_p=entry["source_p"],
+                    dest_d=self.data_d,
+                    dest_n=entry["dest_n"],
+                    ver_prefix=self.ver_prefix,
+                    num_digits=self.num_digits,
+                    do_verified_copy=self.do_verified_copy,
+                    digest=entry["digest"],
+                    algorithm=self.algorithm)
+                if self.dedup_index is not None:
+                    self.dedup_index.add(data_p, entry["digest"])
+            except Exception as err:
+                error = str(err)
+            finally:
+                entry["timings"]["copy"] = time.time() - start
+
+            key = (entry["size"], entry["digest"])
+
+            with self.lock:
+                contents = self.contents[key]
+                contents["data_p"] = data_p
+                contents["error"] = error
+                waiters = contents["waiters"]
+                contents["waiters"] = list()
+                if data_p is not None and isinstance(self.data_sizes, dict):
+                    self.data_sizes.setdefault(entry["size"], []).append(data_p)
+
+            if error is not None:
+                self.fail(entry, error)
+            else:
+                entry["status"] = "copied"
+                entry["data_p"] = data_p
+                self.link_queue.put(entry)
+
+            for waiter in waiters:
+                self.release(waiter, contents)
+
+    # --------------------------------------------------------------------------
+    def link_stage(self,
+                   copy_workers):
+        """
+        Creates the links to the stored files. Runs in one thread.
+
+        :param copy_workers: The number of copy threads (each of which sends a
+               _DONE when it stops).
+
+        :return: Nothing.
+        """
+
+        remaining = copy_workers
+
+        while remaining:
+
+            entry = self.link_queue.get()
+            if entry is _DONE:
+                remaining -= 1
+                continue
+
+            start = time.time()
+            try:
+                entry["link_p"], entry["link_mode"] = filesystem.link_data_file(
+                    entry["data_p"],
+                    entry["dest_d"],
+                    entry["dest_n"],
+                    self.link_mode)
+            except Exception as err:
+                self.fail(entry, err)
+            finally:
+                entry["timings"]["link"] = time.time() - start
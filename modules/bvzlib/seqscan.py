@@ -0,0 +1,107 @@
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import re
+
+from bvzlib import filesystem
+from bvzlib import framespec
+
+
+# ------------------------------------------------------------------------------
+def scan_sequences(root_d,
+                   workers=8,
+                   max_depth=None,
+                   include=None,
+                   exclude=None,
+                   udim_identifier=None,
+                   onerror=None):
+    """
+    Recursively scans a directory tree and groups the files in each directory
+    into sequences (see framespec.find_sequences). Directories are listed by a
+    pool of worker threads (see filesystem.walk_dirs) so that many listings
+    are in flight at once. This matters most on network filesystems where
+    every listing has to wait on the server. The results are yielded as each
+    directory finishes, in no particular order, so the caller can start
+    working on them right away.
+
+    Symlinks to directories are not followed.
+
+    :param root_d: The directory to start scanning in.
+    :param workers: The number of directories to list at the same time.
+           Defaults to 8.
+    :param max_depth: How many levels below root_d to descend. 0 will only scan
+           root_d itself, 1 will also scan its immediate sub-directories, etc.
+           If None, there is no limit. Defaults to None.
+    :param include: An optional regex pattern. If given, only files whose full
+           path matches this pattern (using re.search) will be included in the
+           sequences. Does not limit which directories are scanned. Defaults to
+           None.
+    :param exclude: An optional regex pattern. Files whose full path matches
+           this pattern (using re.search) are skipped, and directories whose
+           full path matches are not scanned at all. Defaults to None.
+    :param udim_identifier: The string that will replace the UDIM tile in the
+           prefix of a sequence. If None, then the pattern "<UDIM>" will be
+           used. Defaults to None.
+    :param onerror: An optional function that is called with the OSError if a
+           directory cannot be listed, or fails part way through being listed
+           (just like os.walk). If None, then directories that cannot be
+           listed are skipped silently. Defaults to None.
+
+    :return: A generator that yields a tuple for each directory scanned: The
+             path to the directory and a list of FileSequence objects (which
+             may be empty).
+    """
+
+    assert os.path.isdir(root_d)
+    assert type(workers) is int and workers > 0
+    assert max_depth is None or type(max_depth) is int
+    assert include is None or type(include) is str
+    assert exclude is None or type(exclude) is str
+
+    if include is not None:
+        include = re.compile(include)
+    if exclude is not None:
+        exclude = re.compile(exclude)
+
+    prune = None
+    if exclude is not None:
+        prune = lambda entry: exclude.search(entry.path) is not None
+
+    for dir_d, entries in filesystem.walk_dirs(root_d,
+                                               prune=prune,
+                                               max_depth=max_depth,
+                                               workers=workers,
+                                               onerror=onerror):
+
+        files_n = list()
+        for entry in entries:
+            if exclude is not None and exclude.search(entry.path):
+                continue
+            if include is not None and not include.search(entry.path):
+                continue
+            if entry.is_file():
+                files_n.append(entry.name)
+
+        yield dir_d, framespec.find_sequences(files_n,
+                                              udim_identifier=udim_identifier,
+                                              parent_d=dir_d)
@@ -0,0 +1,630 @@
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+
+from bvzlib import dircache
+from bvzlib import framespec
+
+
+# inotify constants (from <sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# The fixed size header of an inotify event: wd, mask, cookie, len.
+EVENT_HEADER = struct.Struct("iIII")
+
+
+# ==============================================================================
+class SequenceWatcher(object):
+    """
+    Keeps an in-memory index of the files in a single directory up to date as
+    files appear, are renamed, or are deleted, and answers which frames of a
+    pattern (in the same format as expand_files) are present or missing.
+
+    On Linux the directory is watched with inotify, so the directory is only
+    listed once. Everywhere else (or if inotify cannot be used, on a network
+    filesystem for example) the directory is re-listed every rescan_interval
+    seconds and only the differences are applied to the index.
+
+    Unlike expand_files, sub-directories are never counted as frames.
+
+    Queries are answered from the index without touching the filesystem. The
+    present and missing frames of each pattern are kept up to date as files
+    come and go, so a query does not depend on the number of files.
+
+    If the directory itself is deleted or moved away, the index is emptied,
+    the lost attribute is set (and on_lost is called), and the watcher falls
+    back to listing the path every rescan_interval seconds. Once a directory
+    exists at the path again, the watcher picks it up (and goes back to using
+    inotify, if it was using it before).
+
+    Use as a context manager, or call start() and stop():
+
+    with SequenceWatcher("/renders/shot") as watcher:
+        watcher.watch("/renders/shot/beauty.1-100####.exr")
+        watcher.missing("/renders/shot/beauty.1-100####.exr")
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self,
+                 dir_d,
+                 rescan_interval=5.0,
+                 use_inotify=None,
+                 require_close=False,
+                 on_lost=None):
+        """
+        Setup.
+
+        :param dir_d: The directory to watch.
+        :param rescan_interval: How many seconds to wait between listings when
+               inotify is not available. Defaults to 5.
+        :param use_inotify: If True, inotify is required (an OSError is raised
+               by start() if it cannot be used). If False, the directory is
+               always rescanned periodically. If None, inotify is used when
+               available. Defaults to None.
+        :param require_close: If True (and inotify is in use), a newly created
+               file only counts as present once the program writing it has
+               closed it (or it was moved into place). Useful for renderers
+               that write directly to the final file name. Defaults to False.
+        :param on_lost: An optional function that is called with the watcher
+               (from the background thread) when the directory is deleted or
+               moved away. Defaults to None.
+
+        :return: Nothing.
+        """
+
+        assert os.path.isdir(dir_d)
+
+        self.dir_d = os.path.abspath(dir_d)
+        self.rescan_interval = rescan_interval
+        self.use_inotify = use_inotify
+        self.require_close = require_close
+        self.on_lost = on_lost
+        self.lost = False
+
+        self._lock = threading.Lock()
+        self._names = set()
+        self._patterns = dict()
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._inotify_fd = None
+        self._rearm_inotify = False
+
+    # --------------------------------------------------------------------------
+    @property
+    def using_inotify(self):
+        """
+        :return: True if the watcher is running and is using inotify.
+        """
+
+        return self._inotify_fd is not None
+
+    # --------------------------------------------------------------------------
+    def start(self):
+        """
+        Lists the directory and starts watching it in a background thread.
+
+        :return: Nothing.
+        """
+
+        assert self._thread is None
+
+        self._stop_event.clear()
+
+        if self.use_inotify is not False:
+            try:
+                self._inotify_fd = _inotify_watch(self.dir_d)
+            except OSError:
+                if self.use_inotify:
+                    raise
+                self._inotify_fd = None
+
+        # List the directory after the watch is in place so no files are lost
+        # in between.
+        self.rescan()
+
+        self.lost = False
+        self._rearm_inotify = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # --------------------------------------------------------------------------
+    def stop(self):
+        """
+        Stops watching the directory. The index is kept and may still be
+        queried, but will no longer be updated.
+
+        :return: Nothing.
+        """
+
+        if self._thread is None:
+            return
+
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+    # --------------------------------------------------------------------------
+    def __enter__(self):
+        self.start()
+        return self
+
+    # --------------------------------------------------------------------------
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    # --------------------------------------------------------------------------
+    def watch(self,
+              user_pattern,
+              padding=None,
+              udim_identifier=None,
+              strict_udim_format=True,
+              match_hash_length=False):
+        """
+        Registers a pattern to be tracked. The pattern must point to a file in
+        the watched directory. Registering the same pattern twice has no
+        effect. Patterns are registered automatically the first time they are
+        queried, but registering them up front means the first query does not
+        have to index the directory.
+
+        :param user_pattern: The pattern, in the same format as expand_files.
+        :param padding: See expand_files. Defaults to None.
+        :param udim_identifier: See expand_files. Defaults to None.
+        :param strict_udim_format: See expand_files. Defaults to True.
+        :param match_hash_length: See expand_files. Defaults to False.
+
+        :return: Nothing.
+        """
+
+        key = (user_pattern, padding, udim_identifier, strict_udim_format,
+               match_hash_length)
+
+        with self._lock:
+            if key in self._patterns:
+                return
+
+        pattern_match = framespec._PatternMatch(user_pattern,
+                                                padding,
+                                                udim_identifier,
+                                                strict_udim_format,
+                                                match_hash_length)
+
+        assert pattern_match.parent_d == self.dir_d
+
+        pattern_match.index = dict()
+
+        with self._lock:
+            if key in self._patterns:
+                return
+            for file_n in self._names:
+                pattern_match.add_file(file_n)
+            present = pattern_match.frames & framespec.FrameSet(
+                pattern_match.index.keys())
+            self._patterns[key] = {"match": pattern_match,
+                                   "present": present,
+                                   "missing": pattern_match.frames - present}
+
+    # --------------------------------------------------------------------------
+    def unwatch(self,
+                user_pattern,
+                padding=None,
+                udim_identifier=None,
+                strict_udim_format=True,
+                match_hash_length=False):
+        """
+        Stops tracking a pattern.
+
+        :return: Nothing.
+        """
+
+        key = (user_pattern, padding, udim_identifier, strict_udim_format,
+               match_hash_length)
+
+        with self._lock:
+            self._patterns.pop(key, None)
+
+    # --------------------------------------------------------------------------
+    def _tracked(self, user_pattern, args):
+        """
+        Returns the tracking information for a pattern, registering it first
+        if needed.
+
+        :param user_pattern: The pattern.
+        :param args: A tuple of the remaining arguments to watch().
+
+        :return: The tracking dictionary.
+        """
+
+        key = (user_pattern,) + tuple(args)
+        with self._lock:
+            tracked = self._patterns.get(key)
+        if tracked is None:
+            self.watch(user_pattern, *args)
+            with self._lock:
+                tracked = self._patterns[key]
+        return tracked
+
+    # --------------------------------------------------------------------------
+    def present(self,
+                user_pattern,
+                padding=None,
+                udim_identifier=None,
+                strict_udim_format=True,
+                match_hash_length=False):
+        """
+        :param user_pattern: The pattern, in the same format as expand_files.
+               See watch() for the remaining arguments.
+
+        :return: A FrameSet of the frames of the pattern that are on disk.
+        """
+
+        args = (padding, udim_identifier, strict_udim_format, match_hash_length)
+        tracked = self._tracked(user_pattern, args)
+
+        with self._lock:
+            return tracked["present"]
+
+    # --------------------------------------------------------------------------
+    def missing(self,
+                user_pattern,
+                padding=None,
+                udim_identifier=None,
+                strict_udim_format=True,
+                match_hash_length=False):
+        """
+        :param user_pattern: The pattern, in the same format as expand_files.
+               See watch() for the remaining arguments.
+
+        :return: A FrameSet of the frames of the pattern that are not on disk.
+        """
+
+        args = (padding, udim_identifier, strict_udim_format, match_hash_length)
+        tracked = self._tracked(user_pattern, args)
+
+        with self._lock:
+            return tracked["missing"]
+
+    # --------------------------------------------------------------------------
+    def files(self,
+              user_pattern,
+              padding=None,
+              udim_identifier=None,
+              strict_udim_format=True,
+              match_hash_length=False,
+              structured=False):
+        """
+        :param user_pattern: The pattern, in the same format as expand_files.
+               See watch() for the remaining arguments.
+        :param structured: See expand_files. Defaults to False.
+
+        :return: The same tuple of files and missing frames that expand_files
+                 would return, built from the index.
+        """
+
+        args = (padding, udim_identifier, strict_udim_format, match_hash_length)
+        tracked = self._tracked(user_pattern, args)
+
+        with self._lock:
+            if structured:
+                return tracked["match"].structured_results()
+            return tracked["match"].results()
+
+    # --------------------------------------------------------------------------
+    def rescan(self):
+        """
+        Lists the directory and applies any differences to the index. Called
+        automatically when inotify is not available (or events were lost).
+
+        The lock is held while the directory is listed, so that no inotify
+        event can be applied in between and then undone by the listing.
+
+        :return: Nothing.
+        """
+
+        with self._lock:
+            names = set(entry.name for entry in
+                        dircache.scan_entries(self.dir_d) if not entry.is_dir)
+            for file_n in self._names - names:
+                self._remove(file_n)
+            for file_n in names - self._names:
+                self._add(file_n)
+
+    # --------------------------------------------------------------------------
+    def _add(self, file_n):
+        """
+        Adds a file to the index. The lock must be held.
+
+        :param file_n: The name of the file.
+
+        :return: Nothing.
+        """
+
+        if file_n in self._names:
+            return
+        self._names.add(file_n)
+        for tracked in self._patterns.values():
+            pattern_match = tracked["match"]
+            frames = [frame for frame in pattern_match.add_file(file_n)
+                      if len(pattern_match.index[frame]) == 1
+                      and frame in pattern_match.frames]
+            if frames:
+                frames = framespec.FrameSet(frames)
+                tracked["present"] = tracked["present"] | frames
+                tracked["missing"] = tracked["missing"] - frames
+
+    # --------------------------------------------------------------------------
+    def _remove(self, file_n):
+        """
+        Removes a file from the index. The lock must be held.
+
+        :param file_n: The name of the file.
+
+        :return: Nothing.
+        """
+
+        if file_n not in self._names:
+            return
+        self._names.discard(file_n)
+        for tracked in self._patterns.values():
+            pattern_match = tracked["match"]
+            frames = [frame for frame in pattern_match.remove_file(file_n)
+                      if frame not in pattern_match.index
+                      and frame in pattern_match.frames]
+            if frames:
+                frames = framespec.FrameSet(frames)
+                tracked["present"] = tracked["present"] - frames
+                tracked["missing"] = tracked["missing"] | frames
+
+    # --------------------------------------------------------------------------
+    def _run(self):
+        """
+        The background thread. Switches between the inotify and rescan loops
+        as the watch is lost and re-armed.
+
+        :return: Nothing.
+        """
+
+        while not self._stop_event.is_set():
+            if self._inotify_fd is not None:
+                self._inotify_loop()
+            else:
+                self._rescan_loop()
+
+    # --------------------------------------------------------------------------
+    def _set_lost(self):
+        """
+        Empties the index and reports that the directory is gone (once, until
+        it is found again).
+
+        :return: Nothing.
+        """
+
+        with self._lock:
+            for file_n in list(self._names):
+                self._remove(file_n)
+
+        if not self.lost:
+            self.lost = True
+            if self.on_lost is not None:
+                self.on_lost(self)
+
+    # --------------------------------------------------------------------------
+    def _rescan_loop(self):
+        """
+        Lists the directory every rescan_interval seconds. Used when inotify is
+        not available, or while the directory is lost. Returns once inotify is
+        re-armed (or the watcher is stopped).
+
+        :return: Nothing.
+        """
+
+        while not self._stop_event.wait(self.rescan_interval):
+
+            if self._rearm_inotify and os.path.isdir(self.dir_d):
+                try:
+                    self._inotify_fd = _inotify_watch(self.dir_d)
+                except OSError:
+                    pass
+                else:
+                    self._rearm_inotify = False
+
+            try:
+                self.rescan()
+            except OSError:
+                self._set_lost()
+            else:
+                self.lost = False
+
+            if self._inotify_fd is not None:
+                return
+
+    # --------------------------------------------------------------------------
+    def _rearm(self):
+        """
+        Replaces the inotify watch after the directory itself was deleted or
+        moved (which removes the watch). If there is no directory at the path
+        any more, the directory is reported as lost and the rescan loop takes
+        over.
+
+        :return: Nothing.
+        """
+
+        os.close(self._inotify_fd)
+        self._inotify_fd = None
+
+        try:
+            self._inotify_fd = _inotify_watch(self.dir_d)
+            self.rescan()
+        except OSError:
+            if self._inotify_fd is not None:
+                os.close(self._inotify_fd)
+                self._inotify_fd = None
+            self._rearm_inotify = True
+            self._set_lost()
+        else:
+            self.lost = False
+
+    # --------------------------------------------------------------------------
+    def _inotify_loop(self):
+        """
+        Reads and applies inotify events. Returns if the watch was lost (or the
+        watcher is stopped).
+
+        :return: Nothing.
+        """
+
+        fd = self._inotify_fd
+
+        while not self._stop_event.is_set():
+
+            readable, writable, failed = select.select([fd], [], [], 0.25)
+            if not readable:
+                continue
+
+            try:
+                data = os.read(fd, 65536)
+            except OSError as err:
+                if err.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+
+            rescan = False
+            watch_lost = False
+            with self._lock:
+                for mask, file_n in _parse_events(data):
+                    if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                        watch_lost = True
+                    elif mask & IN_Q_OVERFLOW:
+                        rescan = True
+                    elif mask & IN_ISDIR:
+                        continue
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        self._remove(file_n)
+                    elif mask & IN_MOVED_TO:
+                        self._add(file_n)
+                    elif mask & IN_CREATE and not self.require_close:
+                        self._add(file_n)
+                    elif mask & IN_CLOSE_WRITE:
+                        self._add(file_n)
+
+            # The directory itself was deleted or moved, which also removes the
+            # watch, so a new one has to be made (if there is still a directory
+            # at the path).
+            if watch_lost:
+                self._rearm()
+                return
+
+            # Events were lost, so the only way to get back in sync is to list
+            # the directory again.
+            if rescan:
+                try:
+                    self.rescan()
+                except OSError:
+                    pass
+
+
+# ------------------------------------------------------------------------------
+def _inotify_watch(dir_d):
+    """
+    Creates an inotify instance watching a single directory.
+
+    :param dir_d: The directory to watch.
+
+    :return: The inotify file descriptor.
+    """
+
+    if not sys.platform.startswith("linux"):
+        raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                       use_errno=True)
+
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+    mask = (IN_CREATE | IN_CLOSE_WRITE | IN_DELETE | IN_MOVED_FROM |
+            IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+    path = dir_d
+    if not isinstance(path, bytes):
+        path = path.encode(sys.getfilesystemencoding())
+
+    if libc.inotify_add_watch(fd, ctypes.c_char_p(path), mask) < 0:
+        err = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(err, os.strerror(err), dir_d)
+
+    return fd
+
+
+# ------------------------------------------------------------------------------
+def _parse_events(data):
+    """
+    Splits a buffer read from an inotify file descriptor into events.
+
+    :param data: The bytes read.
+
+    :return: A list of (mask, file name) tuples.
+    """
+
+    output = list()
+    offset = 0
+
+    while offset + EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        name = data[offset:offset + length].rstrip(b"\0")
+        offset += length
+        if str is not bytes:
+            # Python 3 only. Python 2 keeps names as byte strings (and has no
+            # surrogateescape error handler).
+            name = name.decode(sys.getfilesystemencoding(), "surrogateescape")
+        output.append((mask, name))
+
+    return output
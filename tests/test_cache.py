@@ -0,0 +1,103 @@
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "modules"))
+
+from bvzlib import cache
+from bvzlib import hashcache
+
+
+# ==============================================================================
+class MemoizeTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def test_equivalent_calls_share_an_entry(self):
+        lru_cache = cache.LRUCache()
+        calls = list()
+
+        @cache.memoize(lru_cache)
+        def add(a, b=2):
+            calls.append((a, b))
+            return a + b
+
+        self.assertEqual(add(1), 3)
+        self.assertEqual(add(1, 2), 3)
+        self.assertEqual(add(a=1), 3)
+        self.assertEqual(add(1, b=2), 3)
+        self.assertEqual(add(1, 3), 4)
+        self.assertEqual(calls, [(1, 2), (1, 3)])
+        self.assertEqual(len(lru_cache), 2)
+
+    # --------------------------------------------------------------------------
+    def test_functions_with_the_same_name(self):
+        lru_cache = cache.LRUCache()
+
+        def make(offset):
+            @cache.memoize(lru_cache)
+            def shift(value):
+                return value + offset
+            return shift
+
+        self.assertEqual(make(1)(1), 2)
+        self.assertEqual(make(10)(1), 11)
+
+
+# ==============================================================================
+class HashCacheStatsTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+        self.dir_d = tempfile.mkdtemp(prefix="bvzlib_test_")
+
+    # --------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.dir_d)
+
+    # --------------------------------------------------------------------------
+    def test_hits_are_counted_once(self):
+        file_p = os.path.join(self.dir_d, "a.txt")
+        with open(file_p, "w") as f:
+            f.write("data")
+        os.utime(file_p, (0, 0))
+        stat = os.stat(file_p)
+
+        checksum_cache = hashcache.HashCache()
+        self.assertEqual(checksum_cache.get(stat, "md5"), None)
+        checksum_cache.set(stat, "md5", b"digest")
+        self.assertEqual(checksum_cache.get(stat, "md5"), b"digest")
+
+        stats = checksum_cache.stats()
+        self.assertEqual((stats["memory_hits"], stats["misses"]), (1, 1))
+        memory_stats = checksum_cache._memory.stats()
+        self.assertEqual((memory_stats["hits"], memory_stats["misses"]),
+                         (0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "modules"))
+
+from bvzlib import dedupindex
+from bvzlib import filesystem
+
+
+# ==============================================================================
+class DedupIndexTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+        self.data_d = tempfile.mkdtemp(prefix="bvzlib_test_")
+        self.index = dedupindex.DedupIndex(self.data_d)
+
+    # --------------------------------------------------------------------------
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.data_d)
+
+    # --------------------------------------------------------------------------
+    def write(self, file_n, data, mtime=None):
+        file_p = os.path.join(self.data_d, file_n)
+        with open(file_p, "wb") as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(file_p, (mtime, mtime))
+        return file_p
+
+    # --------------------------------------------------------------------------
+    def test_lookup_after_same_size_rewrite(self):
+        file_p = self.write("a.v0001", b"original", mtime=1000000000)
+        self.index.add(file_p)
+        old_digest = filesystem.hash_file(file_p, self.index.algorithm)
+        self.assertEqual(self.index.lookup(8, old_digest), file_p)
+
+        # Rewritten in place with different data of the same size.
+        self.write("a.v0001", b"replaced", mtime=1000000100)
+        new_digest = filesystem.hash_file(file_p, self.index.algorithm)
+
+        self.assertIsNone(self.index.lookup(8, old_digest))
+        self.assertEqual(self.index.lookup(8, new_digest), file_p)
+        self.assertEqual(len(self.index), 1)
+
+    # --------------------------------------------------------------------------
+    def test_lookup_after_touch(self):
+        file_p = self.write("a.v0001", b"original", mtime=1000000000)
+        self.index.add(file_p)
+        digest = filesystem.hash_file(file_p, self.index.algorithm)
+
+        # Only the modification time changed, so the file still matches.
+        os.utime(file_p, (1000000100, 1000000100))
+        self.assertEqual(self.index.lookup(8, digest), file_p)
+        self.assertEqual(self.index.verify()["changed"], [])
+
+    # --------------------------------------------------------------------------
+    def test_lookup_after_delete(self):
+        file_p = self.write("a.v0001", b"original")
+        self.index.add(file_p)
+        digest = filesystem.hash_file(file_p, self.index.algorithm)
+
+        os.remove(file_p)
+        self.assertIsNone(self.index.lookup(8, digest))
+        self.assertEqual(len(self.index), 0)
+
+    # --------------------------------------------------------------------------
+    def test_sizes_skip_index_file(self):
+        file_p = self.write("a.v0001", b"original")
+        self.index.add(file_p)
+
+        for recursive in [False, True]:
+            sizes = filesystem.dir_files_keyed_by_size(self.data_d, recursive)
+            files_p = [path for paths in sizes.values() for path in paths]
+            self.assertEqual(files_p, [file_p])
+
+
+if __name__ == "__main__":
+    unittest.main()
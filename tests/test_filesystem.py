@@ -0,0 +1,804 @@
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import array
+import concurrent.futures
+import errno
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "modules"))
+
+from bvzlib import filesystem
+
+
+# ==============================================================================
+class PublishTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+        self.root_d = tempfile.mkdtemp(prefix="bvzlib_test_")
+        self.source_p = os.path.join(self.root_d, "asset.exr")
+        with open(self.source_p, "wb") as f:
+            f.write(b"x" * 100000)
+        self.dest_d = os.path.join(self.root_d, "dest")
+        os.mkdir(self.dest_d)
+
+    # --------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.root_d)
+
+    # --------------------------------------------------------------------------
+    def publish_many(self, count):
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            futures = [executor.submit(filesystem.copy_and_add_ver_num,
+                                       self.source_p, self.dest_d)
+                       for i in range(count)]
+            return [future.result() for future in futures]
+
+    # --------------------------------------------------------------------------
+    def check_published(self, published_p, count):
+        self.assertEqual(len(set(published_p)), count)
+        self.assertEqual(sorted(os.listdir(self.dest_d)),
+                         ["asset.v" + str(v).rjust(4, "0") + ".exr"
+                          for v in range(1, count + 1)])
+        for published in published_p:
+            self.assertEqual(os.path.getsize(published), 100000)
+
+    # --------------------------------------------------------------------------
+    def test_publish(self):
+        self.check_published(self.publish_many(20), 20)
+
+    # --------------------------------------------------------------------------
+    def test_publish_without_hard_links(self):
+        error = OSError(errno.EPERM, "Operation not permitted")
+        with mock.patch.object(filesystem.os, "link", side_effect=error):
+            self.check_published(self.publish_many(20), 20)
+
+    # --------------------------------------------------------------------------
+    def test_fallback_never_shows_an_empty_file(self):
+        temp_p = os.path.join(self.dest_d, ".asset.exr." + "0" * 32 + ".tmp")
+        shutil.copy(self.source_p, temp_p)
+        dest_p = os.path.join(self.dest_d, "asset.v0001.exr")
+        seen = list()
+
+        def rename(source_p, target_p):
+            # Whatever a reader would see right before the rename.
+            seen.append(os.path.lexists(target_p))
+            os_rename(source_p, target_p)
+
+        os_rename = os.rename
+        error = OSError(errno.EPERM, "Operation not permitted")
+        with mock.patch.object(filesystem.os, "link", side_effect=error):
+            with mock.patch.object(filesystem.os, "rename", side_effect=rename):
+                self.assertTrue(filesystem._publish_file(temp_p, dest_p))
+                self.assertFalse(filesystem._publish_file(temp_p, dest_p))
+
+        self.assertEqual(seen, [False])
+        self.assertEqual(os.path.getsize(dest_p), 100000)
+        self.assertEqual(os.listdir(self.dest_d), ["asset.v0001.exr"])
+
+    # --------------------------------------------------------------------------
+    def test_sizes_skip_publish_temp_files(self):
+        for file_n in [".asset.exr." + "0" * 32 + ".tmp",
+                       ".asset.v0002.exr.reserved"]:
+            shutil.copy(self.source_p, os.path.join(self.dest_d, file_n))
+        published_p = filesystem.copy_and_add_ver_num(self.source_p,
+                                                      self.dest_d)
+
+        for recursive in [False, True]:
+            sizes = filesystem.dir_files_keyed_by_size(self.dest_d, recursive)
+            self.assertEqual(sizes, {100000: [published_p]})
+
+    # --------------------------------------------------------------------------
+    def add_files(self, files_n):
+        for file_n in files_n:
+            open(os.path.join(self.dest_d, file_n), "w").close()
+
+    # --------------------------------------------------------------------------
+    def test_next_version_follows_the_highest(self):
+        self.add_files(["asset.v0001.exr", "asset.v0005.exr"])
+        with mock.patch.object(filesystem.dircache, "listdir",
+                               wraps=filesystem.dircache.listdir) as listdir:
+            published_p = filesystem.copy_and_add_ver_num(self.source_p,
+                                                          self.dest_d)
+        self.assertEqual(published_p,
+                         os.path.join(self.dest_d, "asset.v0006.exr"))
+        listdir.assert_called_once_with(self.dest_d)
+
+    # --------------------------------------------------------------------------
+    def test_versions_ignore_other_files(self):
+        self.add_files(["asset.v0002.exr", "asset.v0010.exr", "asset.v3.exr",
+                        "asset.v0020.tif", "asset_alt.v0030.exr",
+                        "asset.v0040.exr.bak", "asset.r0050.exr",
+                        "asset.vabc.exr", "other.asset.v0060.exr"])
+        self.assertEqual(filesystem.list_versions(self.dest_d, "asset.exr"),
+                         [(2, os.path.join(self.dest_d, "asset.v0002.exr")),
+                          (3, os.path.join(self.dest_d, "asset.v3.exr")),
+                          (10, os.path.join(self.dest_d, "asset.v0010.exr"))])
+        self.assertEqual(filesystem.latest_version(self.dest_d, "asset.exr"),
+                         (10, os.path.join(self.dest_d, "asset.v0010.exr")))
+        self.assertEqual(filesystem.latest_version(self.dest_d, "asset.exr",
+                                                   ver_prefix="r"),
+                         (50, os.path.join(self.dest_d, "asset.r0050.exr")))
+        self.assertEqual(filesystem.latest_version(self.dest_d, "none.exr"),
+                         None)
+
+        published_p = filesystem.copy_and_add_ver_num(self.source_p,
+                                                      self.dest_d,
+                                                      dest_n="asset_alt.exr")
+        self.assertEqual(os.path.basename(published_p), "asset_alt.v0031.exr")
+
+    # --------------------------------------------------------------------------
+    def test_version_beyond_the_padding(self):
+        self.add_files(["asset.v12345.exr"])
+        published_p = filesystem.copy_and_add_ver_num(self.source_p,
+                                                      self.dest_d)
+        self.assertEqual(os.path.basename(published_p), "asset.v12346.exr")
+
+
+# ==============================================================================
+@unittest.skipUnless(hasattr(os, "copy_file_range"), "needs copy_file_range")
+class KernelCopyTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+        self.root_d = tempfile.mkdtemp(prefix="bvzlib_test_")
+        self.source_p = os.path.join(self.root_d, "source.bin")
+        self.data = os.urandom(3 * 2**20)
+        with open(self.source_p, "wb") as f:
+            f.write(self.data)
+        self.dest_p = os.path.join(self.root_d, "dest.bin")
+        self.digest = filesystem.hash_file(self.source_p, "md5")
+
+    # --------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.root_d)
+
+    # --------------------------------------------------------------------------
+    def copy(self, copy_file_range):
+        with mock.patch.object(filesystem, "_clone_fd", return_value=False):
+            with mock.patch.object(filesystem.os, "copy_file_range",
+                                   side_effect=copy_file_range):
+                return filesystem.copy_file_hashed(self.source_p,
+                                                   self.dest_p,
+                                                   digest=self.digest)
+
+    # --------------------------------------------------------------------------
+    def test_nothing_copied_falls_back_to_reading(self):
+        self.copy(lambda *args: 0)
+        with open(self.dest_p, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    # --------------------------------------------------------------------------
+    def test_short_copy_raises(self):
+        calls = list()
+        copy_file_range = os.copy_file_range
+
+        def short_copy(source_fd, dest_fd, count, offset):
+            calls.append(offset)
+            if len(calls) > 1:
+                return 0
+            return copy_file_range(source_fd, dest_fd, 2**20, offset)
+
+        self.assertRaises(IOError, self.copy, short_copy)
+
+    # --------------------------------------------------------------------------
+    def test_copy_and_add_ver_num_uses_kernel_copy(self):
+        calls = list()
+        copy_file_range = os.copy_file_range
+
+        def counted_copy(*args):
+            calls.append(args)
+            return copy_file_range(*args)
+
+        dest_d = os.path.join(self.root_d, "dest")
+        os.mkdir(dest_d)
+        with mock.patch.object(filesystem.os, "copy_file_range",
+                               side_effect=counted_copy):
+            with mock.patch.object(filesystem, "_clone_fd",
+                                   return_value=False):
+                published_p = filesystem.copy_and_add_ver_num(self.source_p,
+                                                              dest_d)
+
+        self.assertTrue(calls)
+        with open(published_p, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+
+
+# ==============================================================================
+class LinkModeTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+        self.root_d = tempfile.mkdtemp(prefix="bvzlib_test_")
+        self.data_d = os.path.join(self.root_d, "data")
+        self.dest_d = os.path.join(self.root_d, "dest")
+        os.mkdir(self.data_d)
+        os.mkdir(self.dest_d)
+        self.source_p = os.path.join(self.root_d, "asset.exr")
+        with open(self.source_p, "wb") as f:
+            f.write(b"stored")
+
+    # --------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.root_d)
+
+    # --------------------------------------------------------------------------
+    def store(self, link_mode):
+        return filesystem.copy_file_deduplicated(self.source_p, self.dest_d,
+                                                 self.data_d, dict(),
+                                                 link_mode=link_mode,
+                                                 return_link=True)
+
+    # --------------------------------------------------------------------------
+    def test_symlink(self):
+        data_p, link_p, link_mode = self.store("symlink")
+        self.assertEqual(link_mode, "symlink")
+        self.assertTrue(os.path.islink(link_p))
+        self.assertEqual(os.path.realpath(link_p), os.path.realpath(data_p))
+
+    # --------------------------------------------------------------------------
+    def test_hardlink(self):
+        data_p, link_p, link_mode = self.store("hardlink")
+        self.assertEqual(link_mode, "hardlink")
+        self.assertFalse(os.path.islink(link_p))
+        self.assertTrue(os.path.samefile(link_p, data_p))
+
+    # --------------------------------------------------------------------------
+    def test_hardlink_falls_back_to_a_symlink(self):
+        error = OSError(errno.EXDEV, "Invalid cross-device link")
+        with mock.patch.object(filesystem.os, "link", side_effect=error):
+            data_p, link_p, link_mode = self.store("hardlink")
+        self.assertEqual(link_mode, "symlink")
+        self.assertTrue(os.path.islink(link_p))
+
+    # --------------------------------------------------------------------------
+    def test_reflink_never_falls_back_to_a_hardlink(self):
+        with mock.patch.object(filesystem, "_clone_fd", return_value=False):
+            data_p, link_p, link_mode = self.store("reflink")
+        self.assertEqual(link_mode, "symlink")
+        self.assertTrue(os.path.islink(link_p))
+        self.assertEqual(os.path.realpath(link_p), os.path.realpath(data_p))
+
+    # --------------------------------------------------------------------------
+    def test_reflink_is_an_independent_file(self):
+        data_p, link_p, link_mode = self.store("reflink")
+        if link_mode != "reflink":
+            self.skipTest("reflinks are not supported here")
+        self.assertFalse(os.path.samefile(link_p, data_p))
+        with open(link_p, "wb") as f:
+            f.write(b"changed")
+        with open(data_p, "rb") as f:
+            self.assertEqual(f.read(), b"stored")
+
+
+# ==============================================================================
+class HashFilesTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+        self.root_d = tempfile.mkdtemp(prefix="bvzlib_test_")
+        self.files_p = list()
+        for i in range(40):
+            file_p = os.path.join(self.root_d, "file_" + str(i) + ".bin")
+            with open(file_p, "wb") as f:
+                f.write(str(i).encode("ascii") * (i * 3001))
+            self.files_p.append(file_p)
+
+    # --------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.root_d)
+
+    # --------------------------------------------------------------------------
+    def expected(self, algorithm="md5"):
+        output = dict()
+        for file_p in self.files_p:
+            with open(file_p, "rb") as f:
+                output[file_p] = hashlib.new(algorithm, f.read()).digest()
+        return output
+
+    # --------------------------------------------------------------------------
+    def test_matches_hashlib(self):
+        for workers in (1, 4, 16):
+            for algorithm in ("md5", "sha1"):
+                results = list(filesystem.hash_files(self.files_p,
+                                                     workers=workers,
+                                                     algorithm=algorithm,
+                                                     block_size=4096))
+                self.assertEqual(len(results), len(self.files_p))
+                self.assertEqual(dict(results), self.expected(algorithm))
+
+    # --------------------------------------------------------------------------
+    def test_process_pool(self):
+        results = filesystem.hash_files(self.files_p, workers=4,
+                                        use_processes=True)
+        self.assertEqual(dict(results), self.expected())
+
+    # --------------------------------------------------------------------------
+    def test_pending_files_are_bounded(self):
+        consumed = [0]
+
+        def files_p():
+            for file_p in self.files_p:
+                consumed[0] += 1
+                yield file_p
+
+        received = 0
+        for result in filesystem.hash_files(files_p(), workers=4,
+                                            max_pending=5):
+            received += 1
+            self.assertLessEqual(consumed[0] - received, 5)
+        self.assertEqual(received, len(self.files_p))
+
+    # --------------------------------------------------------------------------
+    def test_unreadable_files_go_to_onerror(self):
+        missing_p = os.path.join(self.root_d, "missing.bin")
+        files_p = self.files_p[:20] + [missing_p] + self.files_p[20:]
+        errors = list()
+        results = filesystem.hash_files(files_p, workers=4,
+                                        onerror=errors.append)
+        self.assertEqual(dict(results), self.expected())
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].filename, missing_p)
+
+        self.assertRaises(EnvironmentError, list,
+                          filesystem.hash_files(files_p, workers=4))
+
+
+# ==============================================================================
+class FindDuplicateFileTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+        self.root_d = tempfile.mkdtemp(prefix="bvzlib_test_")
+        self.data = bytes(bytearray(i % 251 for i in range(1000)))
+        self.source_p = self.write("source.bin", self.data)
+        filesystem.reset_dedup_stats()
+
+    # --------------------------------------------------------------------------
+    def tearDown(self):
+        filesystem.reset_dedup_stats()
+        shutil.rmtree(self.root_d)
+
+    # --------------------------------------------------------------------------
+    def write(self, file_n, data):
+        file_p = os.path.join(self.root_d, file_n)
+        with open(file_p, "wb") as f:
+            f.write(data)
+        return file_p
+
+    # --------------------------------------------------------------------------
+    def changed(self, offset):
+        data = bytearray(self.data)
+        data[offset] ^= 0xff
+        return bytes(data)
+
+    # --------------------------------------------------------------------------
+    def candidates(self):
+        # With 16 byte samples the sample covers bytes 0-15, 492-507 and
+        # 984-999, so a change at byte 100 is only seen by the full checksum.
+        return [self.write("other_size.bin", self.data[:-1]),
+                self.write("other_head.bin", self.changed(0)),
+                self.write("other_middle.bin", self.changed(100)),
+                self.write("same.bin", self.data)]
+
+    # --------------------------------------------------------------------------
+    def test_each_stage_rules_out_candidates(self):
+        candidates_p = self.candidates()
+        matched_p, digest = filesystem.find_duplicate_file(self.source_p,
+                                                           candidates_p,
+                                                           sample_size=16)
+        self.assertEqual(matched_p, candidates_p[-1])
+        self.assertEqual(digest, hashlib.md5(self.data).digest())
+        self.assertEqual(filesystem.dedup_stats(),
+                         {"searches": 1,
+                          "matches": 1,
+                          "size_rejected": 1,
+                          "sampled": 3,
+                          "sample_rejected": 1,
+                          "full_hashed": 2,
+                          "full_rejected": 1,
+                          "bytes_sampled": 4 * 48,
+                          "bytes_hashed": 3 * 1000,
+                          "bytes_skipped": 1000 - 48})
+
+    # --------------------------------------------------------------------------
+    def test_no_match(self):
+        candidates_p = self.candidates()[:3]
+        matched_p, digest = filesystem.find_duplicate_file(self.source_p,
+                                                           candidates_p,
+                                                           sample_size=16)
+        self.assertEqual(matched_p, None)
+        self.assertEqual(digest, hashlib.md5(self.data).digest())
+        stats = filesystem.dedup_stats()
+        self.assertEqual(stats["matches"], 0)
+        self.assertEqual(stats["full_rejected"], 1)
+
+    # --------------------------------------------------------------------------
+    def test_no_candidate_of_the_same_size_reads_nothing(self):
+        candidates_p = self.candidates()[:1]
+        with mock.patch.object(filesystem, "hash_file") as hash_file:
+            with mock.patch.object(filesystem,
+                                   "sample_hash_file") as sample_hash_file:
+                self.assertEqual(filesystem.find_duplicate_file(
+                    self.source_p, candidates_p), (None, None))
+        self.assertFalse(hash_file.called)
+        self.assertFalse(sample_hash_file.called)
+
+    # --------------------------------------------------------------------------
+    def test_known_digest_is_not_recalculated(self):
+        digest = hashlib.md5(self.data).digest()
+        matched_p, output = filesystem.find_duplicate_file(self.source_p,
+                                                           self.candidates(),
+                                                           sample_size=16,
+                                                           digest=digest)
+        self.assertEqual(output, digest)
+        self.assertEqual(filesystem.dedup_stats()["bytes_hashed"], 2 * 1000)
+
+    # --------------------------------------------------------------------------
+    def test_small_files_are_only_sampled(self):
+        candidates_p = self.candidates()
+        matched_p, digest = filesystem.find_duplicate_file(self.source_p,
+                                                           candidates_p,
+                                                           algorithm="sha1")
+        self.assertEqual(matched_p, candidates_p[-1])
+        self.assertEqual(digest, hashlib.sha1(self.data).digest())
+        stats = filesystem.dedup_stats()
+        self.assertEqual(stats["sample_rejected"], 2)
+        self.assertEqual(stats["full_hashed"], 0)
+        self.assertEqual(stats["bytes_hashed"], 0)
+
+
+# ==============================================================================
+class FilesAreIdenticalTest(unittest.TestCase):
+
+    METHODS = ["stream", "mmap", "checksum"]
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+        self.root_d = tempfile.mkdtemp(prefix="bvzlib_test_")
+        self.data = bytes(bytearray(i % 251 for i in range(10000)))
+        self.file_p = self.write("file.bin", self.data)
+
+    # --------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.root_d)
+
+    # --------------------------------------------------------------------------
+    def write(self, file_n, data):
+        file_p = os.path.join(self.root_d, file_n)
+        with open(file_p, "wb") as f:
+            f.write(data)
+        return file_p
+
+    # --------------------------------------------------------------------------
+    def identical(self, other_p, method, **kwargs):
+        return filesystem.files_are_identical(self.file_p, other_p,
+                                              block_size=4096, method=method,
+                                              **kwargs)
+
+    # --------------------------------------------------------------------------
+    def test_identical_files(self):
+        copy_p = self.write("copy.bin", self.data)
+        empty_a_p = self.write("empty_a.bin", b"")
+        empty_b_p = self.write("empty_b.bin", b"")
+        for method in self.METHODS:
+            self.assertTrue(self.identical(copy_p, method))
+            self.assertTrue(filesystem.files_are_identical(empty_a_p,
+                                                           empty_b_p,
+                                                           method=method))
+
+    # --------------------------------------------------------------------------
+    def test_files_that_differ_in_the_tail(self):
+        # 10000 bytes in 4096 byte blocks: the last block is a partial one.
+        other_p = self.write("other.bin", self.data[:-1] + b"!")
+        for method in self.METHODS:
+            self.assertFalse(self.identical(other_p, method))
+
+    # --------------------------------------------------------------------------
+    def test_files_of_unequal_size(self):
+        longer_p = self.write("longer.bin", self.data + b"\0")
+        shorter_p = self.write("shorter.bin", self.data[:-1])
+        for method in self.METHODS:
+            self.assertFalse(self.identical(longer_p, method))
+            self.assertFalse(self.identical(shorter_p, method))
+
+    # --------------------------------------------------------------------------
+    def test_stream_stops_at_the_first_difference(self):
+        other_p = self.write("other.bin", b"!" + self.data[1:])
+        reads = list()
+
+        def counting_open(file_p, mode="r"):
+            f = io.open(file_p, mode)
+            read = f.read
+
+            def counted_read(size=-1):
+                reads.append(size)
+                return read(size)
+
+            f.read = counted_read
+            return f
+
+        with mock.patch.object(filesystem, "open", create=True,
+                               side_effect=counting_open):
+            self.assertFalse(self.identical(other_p, "stream"))
+        self.assertEqual(reads, [4096, 4096])
+
+    # --------------------------------------------------------------------------
+    def test_known_digest_only_reads_the_other_file(self):
+        copy_p = self.write("copy.bin", self.data)
+        other_p = self.write("other.bin", self.data[:-1] + b"!")
+        digest = hashlib.sha1(self.data).digest()
+        for method in self.METHODS:
+            with mock.patch.object(filesystem, "hash_file",
+                                   wraps=filesystem.hash_file) as hash_file:
+                self.assertTrue(self.identical(copy_p, method,
+                                               digest_a=digest,
+                                               algorithm="sha1"))
+                self.assertFalse(self.identical(other_p, method,
+                                                digest_a=digest,
+                                                algorithm="sha1"))
+            self.assertEqual([call[0][0] for call in hash_file.call_args_list],
+                             [copy_p, other_p])
+
+
+# ==============================================================================
+class SizeIndexTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def test_sorted_sizes_across_chunks(self):
+        sizes = array.array("q", [5, 3, 9, 3, 0, 5, 7, 3, 1, 9, 2])
+        pairs = list(filesystem._sorted_sizes(sizes, chunk_size=3))
+        self.assertEqual(pairs, sorted((size, i) for i, size in
+                                       enumerate(sizes)))
+
+    # --------------------------------------------------------------------------
+    def test_matches_a_dictionary(self):
+        files = [("/data/file_" + str(i) + ".bin", (i * 7) % 13)
+                 for i in range(200)]
+        expected = dict()
+        for file_p, size in files:
+            expected.setdefault(size, []).append(file_p)
+
+        index = filesystem.SizeIndex(files)
+        self.assertEqual(sorted(index.keys()), sorted(expected))
+        for size in expected:
+            self.assertEqual(sorted(index[size]), sorted(expected[size]))
+        self.assertEqual(index.get(99), None)
+        self.assertNotIn(99, index)
+        self.assertEqual(index.file_count(), len(files))
+
+
+# ==============================================================================
+class AncestorCacheTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+        self.root_d = tempfile.mkdtemp(prefix="bvzlib_test_")
+        self.dirs_d = list()
+        for parent_n in ("project", "other"):
+            for seq_n in ("seq_a", "seq_b"):
+                for shot_n in ("shot_1", "shot_2", "shot_3"):
+                    dir_d = os.path.join(self.root_d, parent_n, seq_n, shot_n)
+                    os.makedirs(dir_d)
+                    self.dirs_d.append(dir_d)
+        open(os.path.join(self.root_d, "project", ".project"), "w").close()
+        open(os.path.join(self.root_d, "project", "seq_b", ".sequence"),
+             "w").close()
+        self.files_n = [".sequence", ".project"]
+        self.paths_p = [os.path.join(dir_d, "frame." + str(i) + ".exr")
+                        for dir_d in self.dirs_d for i in range(20)]
+
+    # --------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.root_d)
+
+    # --------------------------------------------------------------------------
+    def single_lookup(self, path_p, depth=None, ancestor_cache=None):
+        # ancestor_contains_file starts at the parent of the (existing) path it
+        # is given, so "dir_d/." starts at dir_d just like a file in dir_d.
+        return filesystem.ancestor_contains_file(
+            os.path.join(os.path.dirname(path_p), "."), self.files_n, depth,
+            ancestor_cache)
+
+    # --------------------------------------------------------------------------
+    def expected(self, depth=None):
+        return dict((path_p, self.single_lookup(path_p, depth))
+                    for path_p in self.paths_p)
+
+    # --------------------------------------------------------------------------
+    def test_batch_matches_single_lookups(self):
+        for depth in (None, 1, 2, 3, 4):
+            results = filesystem.ancestors_contain_file(self.paths_p,
+                                                        self.files_n, depth)
+            self.assertEqual(results, self.expected(depth))
+
+        results = filesystem.ancestors_contain_file(self.paths_p, self.files_n)
+        self.assertEqual(results[self.paths_p[0]],
+                         os.path.join(self.root_d, "project"))
+        self.assertEqual(results[self.paths_p[-1]], None)
+        path_p = os.path.join(self.root_d, "project", "seq_b", "shot_1",
+                              "frame.0.exr")
+        self.assertEqual(results[path_p],
+                         os.path.join(self.root_d, "project", "seq_b"))
+
+    # --------------------------------------------------------------------------
+    def test_each_directory_is_checked_once(self):
+        ancestor_cache = filesystem.AncestorCache()
+        checked = list()
+
+        def exists(path_p):
+            checked.append(path_p)
+            return os_path_exists(path_p)
+
+        os_path_exists = os.path.exists
+        with mock.patch.object(filesystem.os.path, "exists",
+                               side_effect=exists):
+            filesystem.ancestors_contain_file(self.paths_p, self.files_n,
+                                              ancestor_cache=ancestor_cache)
+            filesystem.ancestors_contain_file(self.paths_p, self.files_n,
+                                              ancestor_cache=ancestor_cache)
+        self.assertEqual(len(checked), len(set(checked)))
+        self.assertEqual(ancestor_cache.stats()["checks"], len(checked))
+
+    # --------------------------------------------------------------------------
+    def test_invalidate(self):
+        ancestor_cache = filesystem.AncestorCache()
+        path_p = self.paths_p[-1]
+        other_d = os.path.join(self.root_d, "other")
+        lookup = lambda: filesystem.ancestors_contain_file(
+            [path_p], self.files_n, ancestor_cache=ancestor_cache)[path_p]
+
+        self.assertEqual(lookup(), None)
+        open(os.path.join(other_d, ".project"), "w").close()
+        self.assertEqual(lookup(), None)
+        ancestor_cache.invalidate(other_d + os.path.sep)
+        self.assertEqual(lookup(), other_d)
+        os.remove(os.path.join(other_d, ".project"))
+        ancestor_cache.invalidate()
+        self.assertEqual(lookup(), None)
+
+    # --------------------------------------------------------------------------
+    def test_shared_between_threads(self):
+        expected = self.expected()
+        # A small cache, so that directories are evicted while other threads
+        # are still using them.
+        ancestor_cache = filesystem.AncestorCache(maxsize=4)
+        calls = [0]
+        calls_lock = threading.Lock()
+        contains_any = ancestor_cache.contains_any
+
+        def counted_contains_any(dir_d, files_n):
+            with calls_lock:
+                calls[0] += 1
+            return contains_any(dir_d, files_n)
+
+        ancestor_cache.contains_any = counted_contains_any
+
+        def lookup(i):
+            paths_p = self.paths_p[i % 7::3]
+            results = filesystem.ancestors_contain_file(
+                paths_p, self.files_n, ancestor_cache=ancestor_cache)
+            for path_p in paths_p[:5]:
+                self.assertEqual(self.single_lookup(
+                    path_p, ancestor_cache=ancestor_cache), expected[path_p])
+            return results
+
+        with concurrent.futures.ThreadPoolExecutor(16) as executor:
+            for results in executor.map(lookup, range(200)):
+                for path_p in results:
+                    self.assertEqual(results[path_p], expected[path_p])
+
+        stats = ancestor_cache.stats()
+        self.assertEqual(stats["hits"] + stats["misses"], calls[0])
+        self.assertLessEqual(stats["size"], 4)
+
+
+# ==============================================================================
+class _Listing(object):
+    """
+    Stands in for a scandir iterator: yields some entries, then optionally
+    raises an error, and records whether it was closed.
+    """
+
+    # --------------------------------------------------------------------------
+    def __init__(self, entries, error=None):
+        self.entries = iter(entries)
+        self.error = error
+        self.closed = False
+
+    # --------------------------------------------------------------------------
+    def __iter__(self):
+        return self
+
+    # --------------------------------------------------------------------------
+    def __next__(self):
+        try:
+            return next(self.entries)
+        except StopIteration:
+            if self.error is not None:
+                raise self.error
+            raise
+
+    next = __next__
+
+    # --------------------------------------------------------------------------
+    def close(self):
+        self.closed = True
+
+
+# ==============================================================================
+class WalkFilesTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+        self.dir_d = tempfile.mkdtemp(prefix="bvzlib_test_")
+        for file_n in ("a.txt", "b.txt", "c.txt"):
+            open(os.path.join(self.dir_d, file_n), "w").close()
+
+    # --------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.dir_d)
+
+    # --------------------------------------------------------------------------
+    def listing(self, error=None):
+        return _Listing(list(filesystem.scandir(self.dir_d)), error)
+
+    # --------------------------------------------------------------------------
+    def test_abandoned_walk_closes_the_directory(self):
+        listing = self.listing()
+        with mock.patch.object(filesystem, "scandir", return_value=listing):
+            walk = filesystem.walk_files(self.dir_d)
+            next(walk)
+            walk.close()
+        self.assertTrue(listing.closed)
+
+    # --------------------------------------------------------------------------
+    def test_error_while_listing_goes_to_onerror(self):
+        error = OSError(errno.EIO, "Input/output error", self.dir_d)
+        listing = self.listing(error)
+        errors = list()
+        with mock.patch.object(filesystem, "scandir", return_value=listing):
+            files_n = [entry.name for entry in
+                       filesystem.walk_files(self.dir_d,
+                                             onerror=errors.append)]
+        self.assertEqual(sorted(files_n), ["a.txt", "b.txt", "c.txt"])
+        self.assertEqual(errors, [error])
+        self.assertTrue(listing.closed)
+
+
+if __name__ == "__main__":
+    unittest.main()
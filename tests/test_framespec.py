@@ -0,0 +1,380 @@
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "modules"))
+
+from bvzlib import framespec
+
+
+# ==============================================================================
+class FindSequencesTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+        self.dir_d = tempfile.mkdtemp(prefix="bvzlib_test_")
+
+    # --------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.dir_d)
+
+    # --------------------------------------------------------------------------
+    def find(self, files_n):
+        for file_n in files_n:
+            open(os.path.join(self.dir_d, file_n), "w").close()
+        return framespec.find_sequences(self.dir_d)
+
+    # --------------------------------------------------------------------------
+    def assert_round_trip(self, sequences, files_n):
+        found = list()
+        for sequence in sequences:
+            if sequence.frames:
+                files_p, missing = framespec.expand_files(sequence.pattern)
+                self.assertEqual(missing, [])
+            else:
+                files_p = [sequence.pattern]
+                self.assertTrue(os.path.exists(sequence.pattern))
+            found.extend(os.path.basename(file_p) for file_p in files_p)
+        self.assertEqual(sorted(found), sorted(files_n))
+
+    # --------------------------------------------------------------------------
+    def test_udim_tiles_with_the_same_frames(self):
+        files_n = ["tex_1001.0001.exr", "tex_1001.0002.exr",
+                   "tex_1002.0001.exr", "tex_1002.0002.exr"]
+        sequences = self.find(files_n)
+        self.assertEqual([os.path.basename(sequence.pattern)
+                          for sequence in sequences],
+                         ["tex_<UDIM>.1,2####.exr"])
+        self.assertEqual(sequences[0].udims, [1001, 1002])
+        self.assert_round_trip(sequences, files_n)
+
+    # --------------------------------------------------------------------------
+    def test_udim_tiles_with_different_frames(self):
+        files_n = ["tex_1001.0001.exr", "tex_1002.0002.exr"]
+        sequences = self.find(files_n)
+        self.assertEqual([os.path.basename(sequence.pattern)
+                          for sequence in sequences],
+                         ["tex_1001.1####.exr", "tex_1002.2####.exr"])
+        self.assert_round_trip(sequences, files_n)
+
+    # --------------------------------------------------------------------------
+    def test_udim_tiles_without_frames(self):
+        files_n = ["tex_1001.tif", "tex_1002.tif"]
+        self.assert_round_trip(self.find(files_n), files_n)
+
+    # --------------------------------------------------------------------------
+    def test_files_without_an_extension(self):
+        files_n = ["render.0001", "render.0002", "render.0003", "notes.7",
+                   "take.0005"]
+        sequences = self.find(files_n)
+        self.assertEqual([os.path.basename(sequence.pattern)
+                          for sequence in sequences],
+                         ["notes.7", "render.1-3####", "take.5####"])
+        self.assert_round_trip(sequences, files_n)
+
+    # --------------------------------------------------------------------------
+    def test_year_is_not_a_udim_tile(self):
+        files_n = ["shot_1999_plate.0001.exr", "shot_1999_plate.0002.exr"]
+        sequences = self.find(files_n)
+        self.assertEqual([os.path.basename(sequence.pattern)
+                          for sequence in sequences],
+                         ["shot_1999_plate.1,2####.exr"])
+        self.assertEqual(sequences[0].udims, [])
+        self.assert_round_trip(sequences, files_n)
+
+
+
+# ==============================================================================
+class ExpandFilesTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+        self.dir_d = tempfile.mkdtemp(prefix="bvzlib_test_")
+
+    # --------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.dir_d)
+
+    # --------------------------------------------------------------------------
+    def test_missing_frames_are_padded(self):
+        for frame in (1, 2, 5):
+            file_n = "plate.{0:04d}.exr".format(frame)
+            open(os.path.join(self.dir_d, file_n), "w").close()
+        pattern_p = os.path.join(self.dir_d, "plate.1-6.exr")
+        files_p, missing = framespec.expand_files(pattern_p, padding=4)
+        self.assertEqual([os.path.basename(file_p) for file_p in files_p],
+                         ["plate.0001.exr", "plate.0002.exr",
+                          "plate.0005.exr"])
+        self.assertEqual(missing, ["0003", "0004", "0006"])
+
+    # --------------------------------------------------------------------------
+    def test_literal_file_without_an_extension(self):
+        file_p = os.path.join(self.dir_d, "notes.2")
+        self.assertEqual(framespec.expand_files(file_p), ([file_p], []))
+
+    # --------------------------------------------------------------------------
+    def batch_patterns(self):
+        shots_d = os.path.join(self.dir_d, "shots")
+        os.mkdir(shots_d)
+        files_n = ["beauty.{0:04d}.exr".format(f) for f in (1, 2, 4)]
+        files_n += ["beauty_diffuse.{0:04d}.exr".format(f) for f in (1, 2, 3)]
+        files_n += ["beauty.{0}.exr".format(f) for f in (1, 2)]
+        files_n += ["tex_{0}.{1}.exr".format(t, f)
+                    for t, f in ((1001, 1), (1001, 2), (1002, 2))]
+        files_n += ["notes.txt"]
+        for file_n in files_n:
+            open(os.path.join(self.dir_d, file_n), "w").close()
+        for frame in (10, 11):
+            file_n = "cache.{0:03d}.vdb".format(frame)
+            open(os.path.join(shots_d, file_n), "w").close()
+        return [os.path.join(self.dir_d, "beauty.1-4.exr"),
+                os.path.join(self.dir_d, "beauty.1-4####.exr"),
+                os.path.join(self.dir_d, "beauty_diffuse.1-4.exr"),
+                os.path.join(self.dir_d, "tex_<UDIM>.1-2.exr"),
+                os.path.join(self.dir_d, "notes.txt"),
+                os.path.join(self.dir_d, "missing.1-2.exr"),
+                os.path.join(shots_d, "cache.9-12.vdb")]
+
+    # --------------------------------------------------------------------------
+    def test_batch_matches_single_expansion(self):
+        patterns = self.batch_patterns()
+        for padding in (None, 0, 4):
+            for structured in (False, True):
+                expected = [framespec.expand_files(pattern,
+                                                   padding=padding,
+                                                   structured=structured)
+                            for pattern in patterns]
+                results = framespec.expand_files_batch(patterns,
+                                                       padding=padding,
+                                                       structured=structured)
+                self.assertEqual(results, expected)
+
+    # --------------------------------------------------------------------------
+    def test_batch_lists_each_directory_once(self):
+        patterns = self.batch_patterns()
+        with mock.patch.object(framespec.dircache, "listdir",
+                               wraps=framespec.dircache.listdir) as listdir:
+            framespec.expand_files_batch(patterns)
+        listed = sorted(call[0][0] for call in listdir.call_args_list)
+        self.assertEqual(listed, sorted([self.dir_d,
+                                         os.path.join(self.dir_d, "shots")]))
+
+
+# ==============================================================================
+class FrameSetTest(unittest.TestCase):
+
+    SPECS = ["1-10", "1-100x2", "1-100x3,200", "5-9,1-5000x1",
+             "10-1x-1", "3,7,8,9,40-60x5", "2-20x4,3-21x6", ""]
+
+    # --------------------------------------------------------------------------
+    def as_set(self, spec):
+        return set(framespec.expand_frame_spec(spec))
+
+    # --------------------------------------------------------------------------
+    def assert_matches(self, frame_set, frames):
+        self.assertEqual(list(frame_set), sorted(frames))
+        self.assertEqual(len(frame_set), len(frames))
+        self.assertEqual(framespec.FrameSet(frame_set.to_framespec()),
+                         frame_set)
+
+    # --------------------------------------------------------------------------
+    def test_built_from_frames_or_a_framespec(self):
+        for spec in self.SPECS:
+            frames = self.as_set(spec)
+            self.assertEqual(framespec.FrameSet(spec),
+                             framespec.FrameSet(frames))
+            self.assert_matches(framespec.FrameSet(spec), frames)
+
+    # --------------------------------------------------------------------------
+    def test_large_spec_is_stored_as_a_single_run(self):
+        frame_set = framespec.FrameSet("1-1000000x1,5-9")
+        self.assertEqual(frame_set.runs, ((1, 1000000, 1),))
+        self.assertEqual(len(frame_set), 1000000)
+        self.assertIn(999999, frame_set)
+        self.assertNotIn(1000001, frame_set)
+
+    # --------------------------------------------------------------------------
+    def test_membership(self):
+        for spec in self.SPECS:
+            frames = self.as_set(spec)
+            frame_set = framespec.FrameSet(spec)
+            for frame in range(-2, 250):
+                self.assertEqual(frame in frame_set, frame in frames)
+
+    # --------------------------------------------------------------------------
+    def test_set_operations_match_python_sets(self):
+        for spec_a in self.SPECS:
+            for spec_b in self.SPECS:
+                set_a, set_b = self.as_set(spec_a), self.as_set(spec_b)
+                frames_a = framespec.FrameSet(spec_a)
+                frames_b = framespec.FrameSet(spec_b)
+                self.assert_matches(frames_a | frames_b, set_a | set_b)
+                self.assert_matches(frames_a & frames_b, set_a & set_b)
+                self.assert_matches(frames_a - frames_b, set_a - set_b)
+
+    # --------------------------------------------------------------------------
+    def test_indexing_and_slicing_match_a_sorted_list(self):
+        for spec in self.SPECS:
+            frames = sorted(self.as_set(spec))
+            frame_set = framespec.FrameSet(spec)
+            for index in range(-len(frames), min(len(frames), 120)):
+                self.assertEqual(frame_set[index], frames[index])
+            for index in (slice(1, 4), slice(None, None, 3), slice(-5, None),
+                          slice(2, 40, 7)):
+                self.assertEqual(list(frame_set[index]), frames[index])
+        self.assertRaises(IndexError, lambda: framespec.FrameSet("1-3")[3])
+
+    # --------------------------------------------------------------------------
+    def test_to_framespec(self):
+        frame_set = framespec.FrameSet([1, 3, 5, 7, 9, 20])
+        self.assertEqual(frame_set.to_framespec(), "1-9x2,20")
+        self.assertEqual(frame_set.to_framespec(padding=4), "1-9x2,20####")
+        self.assertEqual(framespec.FrameSet().to_framespec(padding=4), "")
+
+    # --------------------------------------------------------------------------
+    def test_accepted_by_expand_frame_sequence(self):
+        frame_set = framespec.expand_frame_spec("1-3,10", as_frameset=True)
+        self.assertIsInstance(frame_set, framespec.FrameSet)
+        self.assertEqual(framespec.calc_padding(frame_set, padding=0), 2)
+        self.assertEqual(framespec.expand_frame_sequence("a.1-3,10.exr", 0),
+                         ["a.01.exr", "a.02.exr", "a.03.exr", "a.10.exr"])
+
+
+# ==============================================================================
+class IterFrameSequenceTest(unittest.TestCase):
+
+    FILES_N = ["render.1-10.exr", "render.1-10x3,20.exr", "render.10-1x-1.exr",
+               "render.1-12####.exr", "render.1-3@@.exr", "render.5.exr",
+               "/tmp/render.998-1001.exr", "render.exr"]
+
+    # --------------------------------------------------------------------------
+    def test_matches_expand_frame_sequence(self):
+        for file_n in self.FILES_N:
+            for padding in (None, 0, 3):
+                self.assertEqual(
+                    list(framespec.iter_frame_sequence(file_n, padding)),
+                    framespec.expand_frame_sequence(file_n, padding))
+
+    # --------------------------------------------------------------------------
+    def test_padding(self):
+        files_n = framespec.iter_frame_sequence("render.8-10####.exr", 1)
+        self.assertEqual(list(files_n), ["render.0008.exr", "render.0009.exr",
+                                         "render.0010.exr"])
+        files_n = framespec.iter_frame_sequence("render.8-10.exr", padding=0)
+        self.assertEqual(list(files_n), ["render.08.exr", "render.09.exr",
+                                         "render.10.exr"])
+
+    # --------------------------------------------------------------------------
+    def test_is_lazy(self):
+        files_n = framespec.iter_frame_sequence("render.1-2000000000.exr")
+        self.assertEqual(next(files_n), "render.1.exr")
+        self.assertEqual(next(files_n), "render.2.exr")
+
+    # --------------------------------------------------------------------------
+    def test_chunks(self):
+        for file_n in self.FILES_N:
+            files_n = framespec.expand_frame_sequence(file_n, 0)
+            for chunk_size in (1, 3, 4, 100):
+                chunks = list(framespec.iter_frame_sequence_chunks(file_n,
+                                                                   chunk_size,
+                                                                   0))
+                self.assertEqual([n for chunk in chunks for n in chunk],
+                                 files_n)
+                self.assertTrue(all(len(chunk) == chunk_size
+                                    for chunk in chunks[:-1]))
+                self.assertTrue(0 < len(chunks[-1]) <= chunk_size)
+
+
+# ==============================================================================
+class AnalyzeFramesTest(unittest.TestCase):
+
+    CASES = [("1-10", [1, 2, 3, 6, 9, 10]),
+             ("1-100x2", [1, 3, 11, 13, 99]),
+             ("1-20,50-60", [1, "01", 2, 2, 12, 13, 55, 70]),
+             ("1-5", []),
+             ("1-5", [1, 2, 3, 4, 5]),
+             ("1-100000", list(range(1, 100001, 7)) + ["0007", "00007"])]
+
+    # --------------------------------------------------------------------------
+    def expected_analysis(self, spec, present):
+        expected = framespec.expand_frame_spec(spec)
+        counts = dict()
+        for frame in present:
+            counts[int(frame)] = counts.get(int(frame), 0) + 1
+        found = set(counts)
+        missing = [frame for frame in expected if frame not in found]
+        gaps = list()
+        for i, frame in enumerate(expected):
+            if frame not in found:
+                if i and expected[i - 1] not in found:
+                    gaps[-1] = (gaps[-1][0], frame, gaps[-1][2] + 1)
+                else:
+                    gaps.append((frame, frame, 1))
+        duplicates = [frame for frame in found if counts[frame] > 1]
+        return {"missing": framespec.FrameSet(missing),
+                "duplicates": framespec.FrameSet(duplicates),
+                "extra": framespec.FrameSet(found - set(expected)),
+                "gaps": gaps}
+
+    # --------------------------------------------------------------------------
+    def assert_analysis(self, use_numpy):
+        for spec, present in self.CASES:
+            self.assertEqual(framespec.analyze_frames(spec, present,
+                                                      use_numpy=use_numpy),
+                             self.expected_analysis(spec, present))
+
+    # --------------------------------------------------------------------------
+    def test_without_numpy(self):
+        self.assert_analysis(use_numpy=False)
+
+    # --------------------------------------------------------------------------
+    @unittest.skipIf(framespec.numpy is None, "NumPy is not installed")
+    def test_with_numpy(self):
+        self.assert_analysis(use_numpy=True)
+
+    # --------------------------------------------------------------------------
+    @unittest.skipIf(framespec.numpy is not None, "NumPy is installed")
+    def test_numpy_required(self):
+        self.assertRaises(ImportError, framespec.analyze_frames, "1-5", [1],
+                          use_numpy=True)
+
+    # --------------------------------------------------------------------------
+    def test_results_are_ranges(self):
+        result = framespec.analyze_frames("1-100000", [1, 100000],
+                                          use_numpy=False)
+        self.assertEqual(result["missing"].runs, ((2, 99999, 1),))
+        self.assertEqual(result["gaps"], [(2, 99999, 99998)])
+
+
+if __name__ == "__main__":
+    unittest.main()
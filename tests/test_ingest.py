@@ -0,0 +1,130 @@
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "modules"))
+
+from bvzlib import filesystem
+from bvzlib import ingest
+
+
+# ==============================================================================
+class IngestTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+        self.root_d = tempfile.mkdtemp()
+        self.source_d = os.path.join(self.root_d, "source")
+        self.data_d = os.path.join(self.root_d, "data")
+        self.dest_d = os.path.join(self.root_d, "dest")
+        for dir_d in (self.source_d, self.data_d, self.dest_d):
+            os.mkdir(dir_d)
+
+    # --------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.root_d)
+
+    # --------------------------------------------------------------------------
+    def write(self, dir_d, file_n, data):
+        file_p = os.path.join(dir_d, file_n)
+        with open(file_p, "wb") as f:
+            f.write(data)
+        return file_p
+
+    # --------------------------------------------------------------------------
+    def test_statuses(self):
+        a_p = self.write(self.source_d, "a.txt", b"same")
+        b_p = self.write(self.source_d, "b.txt", b"same")
+        c_p = self.write(self.source_d, "c.txt", b"other")
+        missing_p = os.path.join(self.source_d, "missing.txt")
+        items = [(a_p, self.dest_d, None),
+                 (b_p, self.dest_d, None),
+                 (c_p, self.dest_d, None),
+                 (missing_p, self.dest_d, None),
+                 (a_p, self.dest_d, "again.txt")]
+        result = ingest.ingest_files(items, self.data_d, data_sizes=dict(),
+                                     hash_workers=2)
+        statuses = [entry["status"] for entry in result["files"]]
+        self.assertEqual(statuses[3], "error")
+        self.assertEqual(sorted(statuses[:3] + statuses[4:]),
+                         ["collapsed", "collapsed", "copied", "copied"])
+        with open(os.path.join(self.dest_d, "again.txt"), "rb") as f:
+            self.assertEqual(f.read(), b"same")
+
+    # --------------------------------------------------------------------------
+    def test_size_index(self):
+        stored_p = self.write(self.data_d, "a.txt", b"stored")
+        source_p = self.write(self.source_d, "a.txt", b"stored")
+        sizes = filesystem.dir_files_keyed_by_size(self.data_d, compact=True)
+        result = ingest.ingest_files([(source_p, self.dest_d, None)],
+                                     self.data_d, data_sizes=sizes)
+        entry = result["files"][0]
+        self.assertEqual(entry["status"], "deduplicated")
+        self.assertEqual(entry["data_p"], stored_p)
+
+    # --------------------------------------------------------------------------
+    def test_files_move_on_while_items_are_slow(self):
+        a_p = self.write(self.source_d, "a.txt", b"first")
+        b_p = self.write(self.source_d, "b.txt", b"second")
+        link_p = os.path.join(self.dest_d, "a.txt")
+        linked = list()
+
+        def items():
+            yield a_p, self.dest_d, None
+            # The first file should be stored and linked before the next
+            # item arrives.
+            deadline = time.time() + 5
+            while not os.path.lexists(link_p) and time.time() < deadline:
+                time.sleep(0.01)
+            linked.append(os.path.lexists(link_p))
+            yield b_p, self.dest_d, None
+
+        result = ingest.ingest_files(items(), self.data_d, data_sizes=dict())
+        self.assertEqual(linked, [True])
+        self.assertEqual([entry["status"] for entry in result["files"]],
+                         ["copied", "copied"])
+
+    # --------------------------------------------------------------------------
+    def test_items_error_stops_workers(self):
+        source_p = self.write(self.source_d, "a.txt", b"data")
+
+        def items():
+            yield source_p, self.dest_d, None
+            raise ValueError("bad item")
+
+        before = threading.active_count()
+        self.assertRaises(ValueError, ingest.ingest_files, items(),
+                          self.data_d, data_sizes=dict())
+        self.assertEqual(threading.active_count(), before)
+        self.assertTrue(os.path.exists(os.path.join(self.dest_d, "a.txt")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "modules"))
+
+from bvzlib import filesystem
+from bvzlib import seqscan
+
+
+# ==============================================================================
+class ScanSequencesTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+        self.root_d = tempfile.mkdtemp(prefix="bvzlib_test_")
+        self.files_p = ["shot_a/render.0001.exr",
+                        "shot_a/render.0002.exr",
+                        "shot_a/comp/comp.0001.exr",
+                        "shot_b/plate.0010.dpx",
+                        "shot_b/plate.0011.dpx",
+                        "shot_b/notes.txt",
+                        "skip/render.0001.exr"]
+        for file_p in self.files_p:
+            file_p = os.path.join(self.root_d, file_p)
+            if not os.path.isdir(os.path.dirname(file_p)):
+                os.makedirs(os.path.dirname(file_p))
+            open(file_p, "w").close()
+        os.mkdir(os.path.join(self.root_d, "empty"))
+
+    # --------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.root_d)
+
+    # --------------------------------------------------------------------------
+    def scan(self, **kwargs):
+        output = dict()
+        for dir_d, sequences in seqscan.scan_sequences(self.root_d, **kwargs):
+            relative_d = os.path.relpath(dir_d, self.root_d)
+            self.assertNotIn(relative_d, output)
+            output[relative_d] = sorted(os.path.basename(sequence.pattern)
+                                        for sequence in sequences)
+        return output
+
+    # --------------------------------------------------------------------------
+    def test_scan(self):
+        for workers in (1, 4):
+            self.assertEqual(self.scan(workers=workers),
+                             {".": [],
+                              "empty": [],
+                              "shot_a": ["render.1,2####.exr"],
+                              os.path.join("shot_a", "comp"):
+                                  ["comp.1####.exr"],
+                              "shot_b": ["plate.10,11####.dpx"],
+                              "skip": ["render.1####.exr"]})
+
+    # --------------------------------------------------------------------------
+    def test_include_exclude_and_depth(self):
+        found = self.scan(include=r"\.exr\Z", exclude=r"skip", max_depth=1)
+        self.assertEqual(found, {".": [],
+                                 "empty": [],
+                                 "shot_a": ["render.1,2####.exr"],
+                                 "shot_b": []})
+
+    # --------------------------------------------------------------------------
+    def test_errors_go_to_onerror(self):
+        broken_d = os.path.join(self.root_d, "shot_b")
+        scandir = filesystem.scandir
+
+        def fake_scandir(dir_d):
+            if dir_d == broken_d:
+                raise OSError(errno.EACCES, "Permission denied", dir_d)
+            return scandir(dir_d)
+
+        errors = list()
+        with mock.patch.object(filesystem, "scandir", fake_scandir):
+            found = self.scan(onerror=errors.append)
+        self.assertNotIn("shot_b", found)
+        self.assertIn("shot_a", found)
+        self.assertEqual([err.filename for err in errors], [broken_d])
+
+
+if __name__ == "__main__":
+    unittest.main()
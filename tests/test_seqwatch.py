@@ -0,0 +1,150 @@
+"""
+License
+--------------------------------------------------------------------------------
+bvzlib is released under version 3 of the GNU General Public License.
+
+bvzlib
+Copyright (C) 2019  Bernhard VonZastrow
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "modules"))
+
+from bvzlib import framespec
+from bvzlib import seqwatch
+
+
+# ------------------------------------------------------------------------------
+def wait_for(test,
+             timeout=5.0):
+    """
+    Waits for a condition that is met by the watcher's background thread.
+
+    :param test: A function that returns True once the condition is met.
+    :param timeout: How many seconds to wait. Defaults to 5.
+
+    :return: True if the condition was met in time.
+    """
+
+    end = time.time() + timeout
+    while time.time() < end:
+        if test():
+            return True
+        time.sleep(0.02)
+    return test()
+
+
+# ==============================================================================
+class SequenceWatcherTest(unittest.TestCase):
+
+    # --------------------------------------------------------------------------
+    def setUp(self):
+        self.root_d = tempfile.mkdtemp(prefix="bvzlib_test_")
+        self.dir_d = os.path.join(self.root_d, "shot")
+        os.mkdir(self.dir_d)
+        self.pattern = os.path.join(self.dir_d, "beauty.1-10####.exr")
+
+    # --------------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.root_d)
+
+    # --------------------------------------------------------------------------
+    def touch(self, frame):
+        file_n = "beauty.%04d.exr" % frame
+        with open(os.path.join(self.dir_d, file_n), "w"):
+            pass
+
+    # --------------------------------------------------------------------------
+    def check_present_and_missing(self, use_inotify):
+        for frame in [1, 2, 3]:
+            self.touch(frame)
+
+        with seqwatch.SequenceWatcher(self.dir_d,
+                                      rescan_interval=0.05,
+                                      use_inotify=use_inotify) as watcher:
+
+            watcher.watch(self.pattern)
+            self.assertEqual(watcher.present(self.pattern),
+                             framespec.FrameSet("1-3"))
+
+            self.touch(5)
+            os.remove(os.path.join(self.dir_d, "beauty.0002.exr"))
+
+            expected = framespec.FrameSet([1, 3, 5])
+            self.assertTrue(wait_for(
+                lambda: watcher.present(self.pattern) == expected))
+            self.assertEqual(watcher.missing(self.pattern),
+                             framespec.FrameSet([2, 4, 6, 7, 8, 9, 10]))
+
+    # --------------------------------------------------------------------------
+    def test_present_and_missing_rescan(self):
+        self.check_present_and_missing(False)
+
+    # --------------------------------------------------------------------------
+    @unittest.skipUnless(sys.platform.startswith("linux"), "needs inotify")
+    def test_present_and_missing_inotify(self):
+        self.check_present_and_missing(True)
+
+    # --------------------------------------------------------------------------
+    def check_directory_deleted(self, use_inotify):
+        self.touch(1)
+        lost = list()
+
+        with seqwatch.SequenceWatcher(self.dir_d,
+                                      rescan_interval=0.05,
+                                      use_inotify=use_inotify,
+                                      on_lost=lost.append) as watcher:
+
+            watcher.watch(self.pattern)
+            shutil.rmtree(self.dir_d)
+
+            self.assertTrue(wait_for(lambda: watcher.lost))
+            self.assertEqual(lost, [watcher])
+            self.assertFalse(watcher.present(self.pattern))
+            self.assertFalse(watcher.using_inotify)
+
+            # The directory comes back, and so should the watcher.
+            os.mkdir(self.dir_d)
+            self.touch(4)
+            self.assertTrue(wait_for(
+                lambda: watcher.present(self.pattern) == framespec.FrameSet(
+                    [4])))
+            self.assertFalse(watcher.lost)
+            self.assertEqual(watcher.using_inotify, use_inotify)
+
+            self.touch(6)
+            self.assertTrue(wait_for(
+                lambda: 6 in watcher.present(self.pattern)))
+
+    # --------------------------------------------------------------------------
+    def test_directory_deleted_rescan(self):
+        self.check_directory_deleted(False)
+
+    # --------------------------------------------------------------------------
+    @unittest.skipUnless(sys.platform.startswith("linux"), "needs inotify")
+    def test_directory_deleted_inotify(self):
+        self.check_directory_deleted(True)
+
+
+if __name__ == "__main__":
+    unittest.main()